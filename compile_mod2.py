@@ -5,128 +5,402 @@ import sys
 import yaml
 import glob
 import re
-from lib.x4lib import get_config
+import json
+import bisect
+import hashlib
+from lib.x4lib import get_config, glob_to_regex
 from lib.patched_element_tree import ElementTree
+from lib.patch_xml import diff
+import copy
 import itertools
+import functools
 import logging
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
 logger = logging.getLogger('x4.' + __name__)
 
+Task = namedtuple('Task', 'filepathname modifiers yaml_filename pat plan')
 
-def modify_attrib_value(modifier, attrib_val):
+
+@functools.lru_cache(maxsize=4096)
+def parse_modifier(modifier):
     """
-    modifier: 
-        first char indicates action =, *, /
-        followed by a decimal or float value
-        eg. *1.2 would take existing attribute value and muliply it by 1.2
-    attrib_val: string containing integer or floating point number
+    Parse modifier string into an operation (op, value), see modify_attrib_value
+    (cached, so modifiers formatted from the same template are only parsed once)
     """
-    if modifier.startswith('='):
-        return modifier[1:]
-    elif modifier.startswith('+'):
-        if attrib_val is None:
-            return None
-        return f'{float(attrib_val) + float(modifier[1:]):1.1f}'
-    elif modifier.startswith('-'):
-        if attrib_val is None:
-            return None
-        return f'{float(attrib_val) - float(modifier[1:]):1.1f}'
-    elif modifier.startswith('*'):
-        if attrib_val is None:
-            return None
-        return f'{float(attrib_val) * float(modifier[1:]):1.1f}'
-    elif modifier.startswith('/'):
-        if attrib_val is None:
-            return None
-        return f'{float(attrib_val) / float(modifier[1:]):1.1f}'
-    elif modifier.startswith('['):  # list
+    op = modifier[:1]
+    if op == '=':
+        return op, modifier[1:]
+    elif op and op in '+-*/':
+        return op, float(modifier[1:])
+    elif op == '[':  # list
+        return op, tuple((modifier2[:1], modifier2.strip()[1:]) for modifier2 in modifier[1:].strip(' []').split(' '))
+
+    raise Exception(f'Unexpected modifier: {modifier}')
+
+
+def apply_operation(operation, attrib_val):
+    op, value = operation
+    if op == '=':
+        return value
+    elif op == '[':
         attrib_val_list = attrib_val.strip().split(' ')
-        modifier_list = modifier[1:].strip(' []').split(' ')
-        for modifier2 in modifier_list:
-            modifier2_val = modifier2.strip()[1:]
-            if modifier2.startswith('?'):
+        for op2, modifier2_val in value:
+            if op2 == '?':
                 # check if value exists, if not present then leave this tag unchanged
                 if modifier2_val not in attrib_val_list:
                     return attrib_val
-            elif modifier2.startswith('+'):
+            elif op2 == '+':
                 # append value if present
                 if modifier2_val not in attrib_val_list:
                     attrib_val_list.append(modifier2_val)
-            elif modifier2.startswith('-'):
+            elif op2 == '-':
                 # remove value if present
                 if modifier2_val in attrib_val_list:
                     attrib_val_list.remove(modifier2_val)
         return ' '.join(attrib_val_list)
+    elif attrib_val is None:
+        return None
+    elif op == '+':
+        return f'{float(attrib_val) + value:1.1f}'
+    elif op == '-':
+        return f'{float(attrib_val) - value:1.1f}'
+    elif op == '*':
+        return f'{float(attrib_val) * value:1.1f}'
+    elif op == '/':
+        return f'{float(attrib_val) / value:1.1f}'
 
-    raise Exception(f'Unexpected modifier: {modifier} for value {attrib_val}')
+
+def modify_attrib_value(modifier, attrib_val):
+    """
+    modifier: 
+        first char indicates action =, *, /
+        followed by a decimal or float value
+        eg. *1.2 would take existing attribute value and muliply it by 1.2
+    attrib_val: string containing integer or floating point number
+    """
+    return apply_operation(parse_modifier(modifier), attrib_val)
 
 
 APPEND_PAT = "APPEND"
 CLONE_PAT = "CLONE"
+ATTRIB_PAT = re.compile(r'.*\@[a-z0-9]+$')
 
 
-
-def clone_els_iter(src_els, clone_modifiers, loop):
-    clone_modifiers_iter = itertools.cycle(clone_modifiers if isinstance(clone_modifiers, list) else [clone_modifiers])
-    for src_el in (itertools.cycle(src_els) if loop else src_els):
-        clone_modifiers = next(clone_modifiers_iter)
-        yield src_el, clone_modifiers        
-
-
-def clone_el(src_el, clone_modifiers, kwargs):
-    new_el = ElementTree.fromstring(ElementTree.tostring(src_el))
-    find_and_replace(new_el, clone_modifiers, kwargs)
-    new_el.tail = '\n'
-    return new_el
-
-
-def find_and_replace(xml, modifiers, kwargs={}):
+def compile_modifiers(modifiers):
+    """
+    Compile yaml modifiers into a plan (list of steps), so selectors and modifier strings are parsed once
+    instead of for every element/file they are applied to:
+        ('attrib', path, attrib, operations): operations are parsed (op, value) modifiers,
+                                              or (None, template) for modifiers formatted with kwargs, eg. "={i}"
+        ('clone', clone_limit, [(path, [plan, ...]), ...])
+        ('nested', path, plan)
+    Plans are plain tuples/lists, so they can be sent to worker processes.
+    """
+    plan = []
     modifiers_list = modifiers if isinstance(modifiers, list) else [modifiers]
     for modifiers in modifiers_list:
         for pat, val in modifiers.items():
-            if re.match(r'.*\@[a-z0-9]+$', pat):
+            if ATTRIB_PAT.match(pat):
                 # modify an attribute
-                val_list = [val] if isinstance(val, str) else val 
+                val_list = [val] if isinstance(val, str) else val
                 pat2, attrib = pat.rsplit('@', 1)
-                els = xml.findall(f'./{pat2}')
-                for el in els:
-                    attrib_val = el.attrib.get(attrib, None)
-                    for val2 in val_list:
-                        if attrib_val or val2.startswith('='):
-                            el.attrib[attrib] = attrib_val = modify_attrib_value(modifier=val2.format(**kwargs), attrib_val=attrib_val)
+                operations = [(None, val2) if '{' in val2 else parse_modifier(val2) for val2 in val_list]
+                plan.append(('attrib', f'./{pat2}', attrib, operations))
 
             elif pat.startswith(CLONE_PAT):
                 # clone and alter an element
                 clone_limit = int(pat.rsplit('-', 1)[-1]) if '-' in pat else None
-                clone_count = 0
-                clone_iter_list = []
-                clone_iter_exhausted = 0
-            
+                clones = []
                 clone_pat_list = val if isinstance(val, list) else [val]
                 for clone_pat_entry in clone_pat_list:
                     for src_el_pat, clone_modifiers in clone_pat_entry.items():
-                        src_els = xml.findall(f'./{src_el_pat}')
-                        if src_els:
-                            clone_iter_list.append(clone_els_iter(src_els, clone_modifiers, loop=clone_limit))
-                       
-                while clone_iter_exhausted < len(clone_iter_list):
-                    for clone_iter in clone_iter_list:
-                        if clone_limit is not None and clone_count >= clone_limit:
-                            clone_iter_exhausted = 999
-                            break
-
-                        src_el, clone_modifiers = next(clone_iter, (None, None))
-                        if src_el:
-                            clone_count +=1
-                            xml.append(clone_el(src_el, clone_modifiers, {"i": clone_count}))
-                        else: 
-                            clone_iter_exhausted += 1
-                
+                        if not isinstance(clone_modifiers, list):
+                            clone_modifiers = [clone_modifiers]
+                        clones.append((f'./{src_el_pat}', [compile_modifiers(m) for m in clone_modifiers]))
+                plan.append(('clone', clone_limit, clones))
+
             else:
                 # follow nested modifier patterns
-                elements = xml.findall(f'./{pat}')
+                plan.append(('nested', f'./{pat}', compile_modifiers(val)))
+    return plan
+
+
+def clone_els_iter(src_els, clone_plans, loop):
+    clone_plans_iter = itertools.cycle(clone_plans)
+    for src_el in (itertools.cycle(src_els) if loop else src_els):
+        yield src_el, next(clone_plans_iter)
+
+
+def clone_el(src_el, clone_plan, kwargs, single_pass=True):
+    new_el = ElementTree.fromstring(ElementTree.tostring(src_el))
+    apply_plan(new_el, clone_plan, kwargs, single_pass)
+    new_el.tail = '\n'
+    return new_el
+
+
+class Selector(object):
+    """
+    Child axis path of a plan step (eg. ./component/connections/connection[@tags='[small shield]'])
+    split into (tag, predicates) steps, for matching many selectors in one tree walk (see SelectorTrie).
+    Predicates are compiled with the (patched) ElementPath predicate parser, so they match the same as findall.
+    Paths using other axes (//, ..), positional predicates or a trailing / (findall('./') selects the children,
+    findall('a/') nothing) are not supported, findall is used for them.
+    """
+    STEP_RE = re.compile(r'''([^/\[\]]+)((?:\[(?:'[^']*'|"[^"]*"|[^\]'"])*\])*)(?:/|$)''')
+    PREDICATE_RE = re.compile(r'''\[(?:'[^']*'|"[^"]*"|[^\]'"])*\]''')
+    POSITION_RE = re.compile(r'\[\s*(-?\d+|last\(\))')
+    ATTRIB_RE = re.compile(r'@([^\s=\]]+)')
+
+    def __init__(self, path):
+        self.path = path
+        self.steps = []
+        self.attribs = set()
+        self.supported = bool(path) and not path.endswith('/')
+        if not self.supported:
+            return
+        pos = 0
+        while pos < len(path):
+            match = self.STEP_RE.match(path, pos)
+            if not match or match.group(1) in ('..', '//'):
+                self.supported = False
+                return
+            tag, predicates = match.group(1), tuple(self.PREDICATE_RE.findall(match.group(2)))
+            if any(self.POSITION_RE.match(predicate) for predicate in predicates):
+                self.supported = False
+                return
+            for predicate in predicates:
+                self.attribs.update(self.ATTRIB_RE.findall(predicate))
+            if tag != '.' or predicates:
+                self.steps.append((tag, predicates))
+            pos = match.end()
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def compile_predicate(predicate):
+        """
+        :return: ElementPath select function, select(context, elements) yields the elements matching predicate
+        """
+        tokens = ElementTree.ElementPath.xpath_tokenizer(predicate)
+        return ElementTree.ElementPath.ops['['](tokens.__next__, next(tokens))
+
+
+class SelectorTrie(object):
+    """
+    Selectors merged into a trie of steps, so shared path prefixes are resolved once and the children of matched
+    elements are scanned once (grouped by tag) for all selectors, instead of a findall per selector.
+    """
+
+    def __init__(self, selectors):
+        self.selectors = selectors
+        self.root = {'ends': [], 'children': {}}
+        for n, selector in enumerate(selectors):
+            if not selector.supported:
+                continue
+            node = self.root
+            for tag, predicates in selector.steps:
+                node = node['children'].setdefault((tag, predicates), {'ends': [], 'children': {}})
+            node['ends'].append(n)
+
+    @staticmethod
+    def select(elements, predicates):
+        for predicate in predicates:
+            elements = list(Selector.compile_predicate(predicate)(None, elements))
+        return elements
+
+    def match(self, xml):
+        """
+        :return: list of matched elements (in document order) for each selector
+        """
+        if isinstance(xml, ElementTree.ElementTree):
+            # same as ElementTree.findall, paths are relative to the root element
+            xml = xml.getroot()
+        results = [None if selector.supported else xml.findall(selector.path) for selector in self.selectors]
+        pending = [(self.root, [xml])]
+        while pending:
+            node, elements = pending.pop()
+            for n in node['ends']:
+                results[n] = elements
+            if not node['children']:
+                continue
+            tags = {tag for tag, predicates in node['children']} - {'.', '*'}
+            if len(tags) > 1:
+                children_by_tag = {}
                 for el in elements:
-                    find_and_replace(el, val, kwargs)
+                    for child_el in el:
+                        children_by_tag.setdefault(child_el.tag, []).append(child_el)
+            elif tags:
+                tag = tags.pop()
+                children_by_tag = {tag: [child_el for el in elements for child_el in el if child_el.tag == tag]}
+            for (tag, predicates), child in node['children'].items():
+                if tag == '.':
+                    candidates = elements
+                elif tag == '*':
+                    candidates = [child_el for el in elements for child_el in el if isinstance(child_el.tag, str)]
+                else:
+                    candidates = children_by_tag.get(tag, [])
+                pending.append((child, self.select(candidates, predicates)))
+        return [[] if elements is None else elements for elements in results]
+
+
+def step_paths(step):
+    if step[0] == 'clone':
+        return [path for path, clone_plans in step[2]]
+    return [step[1]]
+
+
+def step_effects(step):
+    """
+    :return: (set) attribute names modified by step, (bool) if step adds elements
+    """
+    if step[0] == 'attrib':
+        return {step[2]}, False
+    elif step[0] == 'clone':
+        return set(), True
+    attribs, structure = set(), False
+    for nested_step in step[2]:
+        nested_attribs, nested_structure = step_effects(nested_step)
+        attribs |= nested_attribs
+        structure = structure or nested_structure
+    return attribs, structure
+
+
+PLAN_BATCHES = {}
+
+
+def plan_batches(plan):
+    """
+    Split plan into batches of consecutive steps whose selectors can all be resolved before the batch is applied
+    with the same result as resolving each selector right before its step: a step starts a new batch if its
+    selectors test an attribute modified earlier in the batch, or the batch added (cloned) elements.
+    :return: list of (steps, SelectorTrie of their selectors)
+    """
+    cached = PLAN_BATCHES.get(id(plan))
+    if cached is not None and cached[0] is plan:
+        return cached[1]
+
+    batches = []
+    steps, selectors, modified, structure = [], [], set(), False
+    for step in plan:
+        step_selectors = [Selector(path) for path in step_paths(step)]
+        depends = set().union(*(selector.attribs for selector in step_selectors))
+        if steps and (structure or depends & modified or not all(selector.supported for selector in step_selectors)):
+            batches.append((steps, SelectorTrie(selectors)))
+            steps, selectors, modified, structure = [], [], set(), False
+        steps.append(step)
+        selectors.extend(step_selectors)
+        step_attribs, step_structure = step_effects(step)
+        modified |= step_attribs
+        structure = structure or step_structure
+    if steps:
+        batches.append((steps, SelectorTrie(selectors)))
+
+    if len(PLAN_BATCHES) > 4096:
+        PLAN_BATCHES.clear()
+    PLAN_BATCHES[id(plan)] = plan, batches
+    return batches
+
+
+def apply_step(xml, step, matches, kwargs, single_pass):
+    """
+    Apply a plan step to the elements its selector(s) matched
+    """
+    if step[0] == 'attrib':
+        _, path, attrib, operations = step
+        for el in matches[0]:
+            attrib_val = el.attrib.get(attrib, None)
+            for operation in operations:
+                if operation[0] is None:
+                    operation = parse_modifier(operation[1].format(**kwargs))
+                if attrib_val or operation[0] == '=':
+                    el.attrib[attrib] = attrib_val = apply_operation(operation, attrib_val)
+
+    elif step[0] == 'clone':
+        _, clone_limit, clones = step
+        clone_count = 0
+        clone_iter_list = []
+        clone_iter_exhausted = 0
+
+        for (path, clone_plans), src_els in zip(clones, matches):
+            if src_els:
+                clone_iter_list.append(clone_els_iter(src_els, clone_plans, loop=clone_limit))
+
+        while clone_iter_exhausted < len(clone_iter_list):
+            for clone_iter in clone_iter_list:
+                if clone_limit is not None and clone_count >= clone_limit:
+                    clone_iter_exhausted = 999
+                    break
+
+                src_el, clone_plan = next(clone_iter, (None, None))
+                if src_el:
+                    clone_count +=1
+                    xml.append(clone_el(src_el, clone_plan, {"i": clone_count}, single_pass))
+                else: 
+                    clone_iter_exhausted += 1
+
+    else:
+        _, path, nested_plan = step
+        for el in matches[0]:
+            apply_plan(el, nested_plan, kwargs, single_pass)
+
+
+def apply_plan(xml, plan, kwargs={}, single_pass=True):
+    """
+    Apply compiled plan (see compile_modifiers) to xml element
+    single_pass: resolve the selectors of (batches of) steps in one tree walk (see plan_batches),
+                 otherwise with a findall per selector right before each step
+    """
+    if not single_pass:
+        for step in plan:
+            apply_step(xml, step, [xml.findall(path) for path in step_paths(step)], kwargs, single_pass)
+        return
+
+    for steps, trie in plan_batches(plan):
+        matches = trie.match(xml)
+        for step in steps:
+            count = len(step_paths(step))
+            apply_step(xml, step, matches[:count], kwargs, single_pass)
+            matches = matches[count:]
+
+
+def find_and_replace(xml, modifiers, kwargs={}):
+    apply_plan(xml, compile_modifiers(modifiers), kwargs)
+
+
+class SrcIndex(object):
+    """
+    In-memory index of the files in src path (by filename), built once per compile run.
+    Yaml file patterns are matched against it instead of walking the whole src tree with a recursive glob
+    for every pattern, only filenames starting with the pattern's literal prefix are checked.
+    """
+
+    def __init__(self, src_path):
+        self.src_path = src_path
+        self.files = {}
+        for path, dirs, filenames in os.walk(src_path):
+            # like glob, skip hidden dirs/files
+            dirs[:] = [dirname for dirname in dirs if not dirname.startswith('.')]
+            rel_path = path[len(src_path):].strip('/')
+            for filename in filenames:
+                if not filename.startswith('.'):
+                    self.files.setdefault(filename, []).append(f'{rel_path}/{filename}' if rel_path else filename)
+        self.filenames = sorted(self.files)
+
+    def glob(self, pat):
+        """
+        Same files as glob.glob(src_path+'/**/'+pat, recursive=True) (but sorted)
+        """
+        regex = glob_to_regex('**/' + pat)
+        filename_pat = pat.rsplit('/', 1)[-1]
+        prefix = re.split(r'[*?\[]', filename_pat, 1)[0]
+        if prefix == filename_pat:
+            filenames = [prefix] if prefix in self.files else []
+        else:
+            start = bisect.bisect_left(self.filenames, prefix)
+            filenames = itertools.takewhile(lambda filename: filename.startswith(prefix), self.filenames[start:])
+        paths = [path for filename in filenames for path in self.files[filename] if regex.match(path)]
+        return [f'{self.src_path}/{path}' for path in sorted(paths)]
 
 
 def write_xml(filename, xml):
@@ -149,48 +423,216 @@ def write_index_file(filepathname, entries):
     write_xml(filepathname, ElementTree.ElementTree(root))
 
 
-def apply_yaml(entries, yaml_data, src_path, mod_path):
+def transform_file(filepathname, plan, out_filename, as_diff=False):
+    """
+    as_diff: write RFC 5261 diff patch of the changes (see lib.patch_xml.diff) instead of the modified file,
+             no patch is written (and a previous one is removed) when nothing changed
+    returns out_filename, None if nothing changed in diff mode
+    """
+    xml = ElementTree.parse(filepathname)
+    base_xml = copy.deepcopy(xml) if as_diff else None
+    apply_plan(xml, plan)
+    if as_diff:
+        xml = diff(base_xml, xml)
+        if not len(xml.getroot()):
+            if os.path.exists(out_filename):
+                os.remove(out_filename)
+            return None
+    write_xml(out_filename, xml)
+    return out_filename
+
+
+def report_unchanged(tasks, results):
+    """
+    Print the src files of tasks that changed nothing (results of run_tasks)
+    """
+    for (out_filename, task), result in zip(tasks.items(), results):
+        if result is None:
+            print(f'\t{task.filepathname} unchanged, no diff written')
+
+
+def run_tasks(tasks, jobs=1, as_diff=False):
+    """
+    Run transform_file for tasks, in a process pool of jobs workers if jobs > 1
+    tasks: dict of out_filename -> Task
+    """
+    args = [(task.filepathname, task.plan, out_filename, as_diff) for out_filename, task in tasks.items()]
+    if jobs > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(transform_file, *zip(*args), chunksize=max(1, len(args) // (jobs * 4))))
+    return [transform_file(*arg) for arg in args]
+
+
+def diff_filename(src_path, mod_path, filepathname):
+    """
+    Mod path of the diff patch for src file, the same path the file has in the game (or in its extension),
+    eg. src/base/assets/x/y.xml -> mod/assets/x/y.xml,
+        src/ego_dlc_split/assets/x/y.xml -> mod/extensions/ego_dlc_split/assets/x/y.xml
+    """
+    ext, path = os.path.relpath(filepathname, src_path).split(os.sep, 1)
+    if ext == 'base':
+        return f'{mod_path}/{path}'
+    return f'{mod_path}/extensions/{ext}/{path}'
+
+
+def apply_yaml(entries, yaml_data, src_path, mod_path, src_index=None, tasks=None, yaml_filename=None,
+               as_diff=False):
+    """
+    Apply yaml modifiers to matched src files
+    tasks: dict to collect out_filename -> Task in (see run_tasks) instead of transforming the files right away.
+           When a file is updated twice the later task replaces the earlier one,
+           same as the later write would discard the earlier one.
+    yaml_filename: yaml file of yaml_data (recorded in tasks)
+    as_diff: write diff patches of the changes at the game paths of the src files (see diff_filename)
+             instead of modified copies of the files registered in the index (entries)
+    """
     mod_name = mod_path.rsplit('/', 1)[-1]
+    src_index = src_index or SrcIndex(src_path)
 
     yaml_data_list = yaml_data if isinstance(yaml_data, list) else [yaml_data]
     for yaml_data in yaml_data_list:
         for pat, modifiers in yaml_data.items():
             file_type = 'macros' if 'macro' in pat else f'components'
-            files = glob.glob(src_path+'/**/'+pat, recursive=True)
+            plan = compile_modifiers(modifiers)
+            files = src_index.glob(pat)
             print(f'\tApplying pattern {pat:65}: {len(files):3} files matched')
             for filepathname in files:
                 filename = filepathname.rsplit('/', 1)[-1]
                 entry_name = filename.rsplit('.',1)[0]
                 print(f'\t\tprocessing {filename}')
-                out_filename = f'{mod_path}/{file_type}/{filename}'
-                entry = (entry_name, f'extensions\\{mod_name}\\{file_type}\\{entry_name}')
-                if entry in entries:
+                if as_diff:
+                    out_filename = diff_filename(src_path, mod_path, filepathname)
+                    entry = None
+                else:
+                    out_filename = f'{mod_path}/{file_type}/{filename}'
+                    entry = (entry_name, f'extensions\\{mod_name}\\{file_type}\\{entry_name}')
+                if entry in entries or (as_diff and tasks and out_filename in tasks):
                     print(f'\t\t{filepathname} -> {out_filename}')
                     print("\t\t\tWarning: trying update the same file twice, currently this will discard whatever modification was applied earlier")
 
-                xml = ElementTree.parse(filepathname)
-                find_and_replace(xml, modifiers)
-                write_xml(out_filename, xml)
-                entries.add(entry)
+                if tasks is None:
+                    if transform_file(filepathname, plan, out_filename, as_diff) is None:
+                        print(f'\t\t\t{filepathname} unchanged, no diff written')
+                else:
+                    tasks[out_filename] = Task(filepathname, modifiers, yaml_filename, pat, plan)
+                if entry:
+                    entries.add(entry)
                 # print(f'\t\tAdding {filepathname} -> {out_filename}')
 
 
-def compile_mod(src_path, mod_path, pat):
+def load_deps(deps_filename):
+    """
+    Load dependency graph of a previous compile:
+    outputs: out_filename -> dep (see task_dep), entries: index entries written
+    """
+    if not os.path.exists(deps_filename):
+        return {'outputs': {}, 'entries': None}
+    try:
+        with open(deps_filename) as deps_file:
+            return json.load(deps_file)
+    except ValueError:
+        logger.warning('invalid deps file %s, compiling all files', deps_filename)
+        return {'outputs': {}, 'entries': None}
+
+
+def save_deps(deps_filename, deps):
+    os.makedirs(os.path.dirname(deps_filename), exist_ok=True)
+    with open(deps_filename + '.tmp', 'w') as deps_file:
+        json.dump(deps, deps_file)
+    os.replace(deps_filename + '.tmp', deps_filename)
+
+
+def task_dep(task, previous=None):
+    """
+    Inputs of an output file: yaml file, pattern and src file that produced it, with hashes of modifiers and src.
+    The src md5 of the previous dep is reused if the src file's size and mtime didn't change.
+    """
+    stat = os.stat(task.filepathname)
+    src_stat = [stat.st_size, stat.st_mtime_ns]
+    if previous and previous['src'] == task.filepathname and previous['src_stat'] == src_stat:
+        src_md5 = previous['src_md5']
+    else:
+        with open(task.filepathname, 'rb') as src_file:
+            src_md5 = hashlib.md5(src_file.read()).hexdigest()
+    modifiers = json.dumps(task.modifiers, sort_keys=True, default=str).encode('utf-8')
+    return {
+        'yaml': task.yaml_filename,
+        'pattern': task.pat,
+        'modifiers_md5': hashlib.md5(modifiers).hexdigest(),
+        'src': task.filepathname,
+        'src_stat': src_stat,
+        'src_md5': src_md5,
+    }
+
+
+def same_inputs(dep, previous):
+    # src_stat only tells if src_md5 can be reused, a touched but unchanged src file doesn't need compiling
+    return previous is not None and all(dep[key] == previous.get(key) for key in dep if key != 'src_stat')
+
+
+def compile_mod(src_path, mod_path, pat, jobs=1, deps_filename=None, as_diff=False):
+    """
+    as_diff: write diff patches of the changes instead of modified copies of src files (see apply_yaml)
+    deps_filename: json file to keep the dependency graph of compiled files in, for incremental compiles
+                   (only files whose yaml modifiers or src changed are compiled again,
+                   files no longer produced are removed), None: compile all files
+    """
     entries = set()
+    tasks = {}
+    src_index = SrcIndex(src_path)
     for cfg_filename in glob.glob(f'{mod_path}/mod_*.yaml'):
         if pat and pat not in cfg_filename:
             continue
         with open(cfg_filename) as cfg_file:
-            yaml_data = yaml.load(cfg_file)
+            yaml_data = yaml.safe_load(cfg_file)
         print(f'Applying {cfg_filename}:')
-        apply_yaml(entries, yaml_data, src_path, mod_path)
+        apply_yaml(entries, yaml_data, src_path, mod_path, src_index, tasks, cfg_filename, as_diff)
         print()
 
     macros_list = sorted(entry for entry in entries if 'macros' in entry[1])
     components_list = sorted(entry for entry in entries if 'components' in entry[1])
-
-    write_index_file(f'{mod_path}/index/macros.xml', macros_list)
-    write_index_file(f'{mod_path}/index/components.xml', components_list)
+    index_filenames = [f'{mod_path}/index/macros.xml', f'{mod_path}/index/components.xml']
+
+    # diff patches are at the game paths of their files, which are already in the game index files
+    write_index = not as_diff
+    if deps_filename is None:
+        report_unchanged(tasks, run_tasks(tasks, jobs, as_diff))
+        if write_index:
+            write_index_file(index_filenames[0], macros_list)
+            write_index_file(index_filenames[1], components_list)
+    else:
+        deps = load_deps(deps_filename)
+        previous = deps['outputs']
+        outputs = {out_filename: task_dep(task, previous.get(out_filename)) for out_filename, task in tasks.items()}
+        # unchanged: no diff patch was written since the modifiers changed nothing
+        changed = {out_filename: task for out_filename, task in tasks.items()
+                   if not same_inputs(outputs[out_filename], previous.get(out_filename))
+                   or not (os.path.exists(out_filename) or previous[out_filename].get('unchanged'))}
+        print(f'{len(changed)} of {len(tasks)} files changed')
+        results = run_tasks(changed, jobs, as_diff)
+        report_unchanged(changed, results)
+        for out_filename, result in zip(changed, results):
+            if result is None:
+                outputs[out_filename]['unchanged'] = True
+        for out_filename in tasks:
+            if out_filename not in changed and previous[out_filename].get('unchanged'):
+                outputs[out_filename]['unchanged'] = True
+
+        for out_filename, dep in previous.items():
+            if out_filename in outputs:
+                continue
+            if pat and pat not in dep['yaml']:
+                # yaml not compiled this time
+                outputs[out_filename] = dep
+            elif os.path.exists(out_filename):
+                print(f'\tRemoving {out_filename}')
+                os.remove(out_filename)
+
+        index_entries = [list(entry) for entry in macros_list + components_list]
+        if write_index and (index_entries != deps['entries'] or not all(map(os.path.exists, index_filenames))):
+            write_index_file(index_filenames[0], macros_list)
+            write_index_file(index_filenames[1], components_list)
+        save_deps(deps_filename, {'outputs': outputs, 'entries': index_entries})
     
     print (f'Compiled {len(macros_list)} macros, {len(components_list)} components')
         
@@ -199,15 +641,18 @@ if __name__ == '__main__':
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.INFO)
 
-    args = sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
     if len(args) < 1:
-        logger.info("%s <mod_name>", sys.argv[0])
+        logger.info("%s <mod_name> <pat> <--jobs=N> <--incremental> <--diff>", sys.argv[0])
         exit(0)
 
     mod_name=args[0]
     pat = args[1] if len(args)>1 else None
+    jobs = [int(arg.split('=', 1)[1]) for arg in sys.argv if arg.startswith('--jobs=')]
     config=get_config()
-    compile_mod(src_path=config.SRC, mod_path=f'{config.MODS}/{mod_name}', pat=pat)
+    deps_filename = f'{config.PWD}/cache/compile_{mod_name}.json' if '--incremental' in sys.argv else None
+    compile_mod(src_path=config.SRC, mod_path=f'{config.MODS}/{mod_name}', pat=pat, jobs=jobs[-1] if jobs else 1,
+                deps_filename=deps_filename, as_diff='--diff' in sys.argv)
 
 
 
@@ -5,35 +5,61 @@ Extract xml scripts into source dir
 Use: python extract_x4.py --extract
 """
 
+import io
 import os
+import re
 import sys
+import glob
+import json
+import mmap
+import time
+import struct
+import hashlib
 import os.path
 import logging
-from lib.x4lib import get_config, require_python_version
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from lib.x4lib import get_config, require_python_version, glob_to_regex
 
 require_python_version(3, 5)
 logger = logging.getLogger('x4.' + __name__)
 
+# single file entry of a cat file (offset is the position of the file data in the matching dat file)
+CatEntry = namedtuple('CatEntry', 'filename offset size timestamp md5hex')
+
 
 class CatParser(object):
     SCRIPTS_EXT = ('.xml', '.xsd', '.xsl', '.dtd', '.lua')
+    MANIFEST_FILENAME = '.x4_manifest.json'
+    COPY_BUFFER_SIZE = 1024 * 1024
+    EMPTY_MD5HEX = ('00000000000000000000000000000000', hashlib.md5().hexdigest())
 
     @staticmethod
-    def parse_line(line):
+    def parse_line_full(line):
         """
-        Parse/split a single line from cat file
+        Parse/split a single line from cat file, keeping all the fields
         :param line: (str) line from a cat file
-        :return: (str, int)
+        :return: (str, int, int, str) filename, size, timestamp, md5hex
         """
         try:
             # since filename can have spaces in it, we want to rsplit, and the are 4 fields so expect 3 split chars
             # Note: filenames can have spaces in them
             out_filename, out_size, timestamp, md5hex = line.rsplit(' ', 3)
             out_size = int(out_size)
+            timestamp = int(timestamp)
         except ValueError:
             logger.exception('parse line error!', extra=dict(line=line))
             raise
-        return out_filename, out_size
+        return out_filename, out_size, timestamp, md5hex.strip()
+
+    @classmethod
+    def parse_line(cls, line):
+        """
+        Parse/split a single line from cat file
+        :param line: (str) line from a cat file
+        :return: (str, int)
+        """
+        return cls.parse_line_full(line)[:2]
 
     @classmethod
     def is_script_file(cls, filename):
@@ -54,45 +80,269 @@ class CatParser(object):
         return filename.endswith('.sig')
 
     @classmethod
-    def cat_files_iterator(cls, cat_filename):
+    def cat_entries_iterator(cls, cat_filename):
         """
-        Return an iterator for each file in the cat file
+        Return an iterator for each file entry in the cat file
         :param cat_filename: path/name of cat file
-        :return: yields (filename, offset, size)
+        :return: yields CatEntry(filename, offset, size, timestamp, md5hex)
         """
         offset = 0
         with open(cat_filename, "r") as cat_file:
             for line in cat_file:
-                filename, size = cls.parse_line(line)
-                yield filename, offset, size
+                filename, size, timestamp, md5hex = cls.parse_line_full(line)
+                yield CatEntry(filename, offset, size, timestamp, md5hex)
                 offset += size
 
     @classmethod
-    def extract_file(cls, dat_file, out_file_path, offset, size):
+    def cat_files_iterator(cls, cat_filename):
+        """
+        Return an iterator for each file in the cat file
+        :param cat_filename: path/name of cat file
+        :return: yields (filename, offset, size)
+        """
+        for entry in cls.cat_entries_iterator(cat_filename):
+            yield entry.filename, entry.offset, entry.size
+
+    @classmethod
+    def copy_range(cls, dat_fd, out_fd, offset, size):
+        """
+        Copy a range of dat file into out file (at its current position) in constant memory
+        - os.copy_file_range copies inside the kernel (and can share/reflink blocks on some filesystems)
+        - os.sendfile is the fallback when copy_file_range is not available/supported
+        - chunked positional reads into a single reused buffer are the last resort
+        All dat reads are positional, so the same dat fd can be used by several threads.
+        :param dat_fd: (int) file descriptor of dat file
+        :param out_fd: (int) file descriptor of file to write to
+        :param offset: (int) offset of range in dat file
+        :param size: (int) size of range
+        :return: (int) number of bytes copied
+        """
+        copied = 0
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while copied < size:
+                    count = os.copy_file_range(dat_fd, out_fd, size - copied, offset + copied)
+                    if not count:
+                        break
+                    copied += count
+            except OSError:
+                # eg. cross filesystem copy on older kernels, or fs not supporting it
+                pass
+        if copied < size and hasattr(os, 'sendfile'):
+            try:
+                while copied < size:
+                    count = os.sendfile(out_fd, dat_fd, offset + copied, size - copied)
+                    if not count:
+                        break
+                    copied += count
+            except OSError:
+                pass
+        if copied < size:
+            buffer = memoryview(bytearray(min(cls.COPY_BUFFER_SIZE, size - copied)))
+            while copied < size:
+                chunk = buffer[:min(len(buffer), size - copied)]
+                count = os.preadv(dat_fd, [chunk], offset + copied)
+                if not count:
+                    break
+                written = 0
+                while written < count:
+                    written += os.write(out_fd, chunk[written:count])
+                copied += count
+        if copied < size:
+            logger.error('dat file too short: %d of %d bytes copied from offset %d', copied, size, offset)
+        return copied
+
+    @classmethod
+    def extract_file(cls, dat_fd, out_file_path, offset, size, make_dirs=True):
         """
         Extract a single file from dat file
-        :param dat_file: (file) file pointer to dat file
+        :param dat_fd: (int) file descriptor of dat file
         :param out_file_path: (str) path/name of file to extract
         :param offset: (int) offset of file in dat file
         :param size: (int) size of file to extract
+        :param make_dirs: (bool) create the dir of out_file_path (False if it's known to exist)
         :return: None
         """
-        dat_file.seek(offset)
-        data = dat_file.read(size)
-        os.makedirs(out_file_path.rsplit('/', 1)[0], exist_ok=True)
-        with open(out_file_path, 'wb') as out_file:
-            out_file.write(data)
+        if make_dirs:
+            os.makedirs(out_file_path.rsplit('/', 1)[0], exist_ok=True)
+        with open(out_file_path, 'wb', buffering=0) as out_file:
+            cls.copy_range(dat_fd, out_file.fileno(), offset, size)
 
-    def __init__(self, out_path=None, scripts_only=True, signatures=False):
+    @classmethod
+    def extract_worker(cls, dat_filename, out_path, entries):
+        """
+        Extract a batch of files from dat file, using worker's own dat file handle
+        (dirs of the files are expected to exist already, see make_dirs)
+        :param dat_filename: (str) file/path of dat file
+        :param out_path: (str) path to extract to
+        :param entries: (list) of CatEntry
+        :return: (int, int) number of files and bytes extracted
+        """
+        dat_fd = os.open(dat_filename, os.O_RDONLY)
+        try:
+            for entry in entries:
+                out_file_path = '{}/{}'.format(out_path, entry.filename)
+                cls.extract_file(dat_fd, out_file_path, entry.offset, entry.size, make_dirs=False)
+                logger.info('\t%s', out_file_path)
+        finally:
+            os.close(dat_fd)
+        return len(entries), sum(entry.size for entry in entries)
+
+    @classmethod
+    def verify_cat(cls, cat_filename):
+        """
+        Verify dat file contents against md5 hashes in cat file
+        The dat file is streamed once, in order, and each file's md5 is computed over its exact range
+        in fixed size chunks (reusing one buffer), so memory use doesn't depend on file sizes.
+        :param cat_filename: (str) file/path of cat file
+        :return: (list) of (filename, expected md5hex, actual md5hex) for files that don't match
+        """
+        mismatches = []
+        buffer = memoryview(bytearray(cls.COPY_BUFFER_SIZE))
+        dat_filename = cat_filename[:-4] + '.dat'
+        with open(dat_filename, 'rb', buffering=0) as dat_file:
+            # entries are stored back to back in cat order, so the dat is read sequentially
+            for entry in cls.cat_entries_iterator(cat_filename):
+                md5 = hashlib.md5()
+                remaining = entry.size
+                while remaining:
+                    count = dat_file.readinto(buffer[:min(len(buffer), remaining)])
+                    if not count:
+                        break
+                    md5.update(buffer[:count])
+                    remaining -= count
+                md5hex = md5.hexdigest() if not remaining else 'truncated'
+                if entry.size == 0 and entry.md5hex in cls.EMPTY_MD5HEX:
+                    continue
+                if md5hex != entry.md5hex:
+                    mismatches.append((entry.filename, entry.md5hex, md5hex))
+        return mismatches
+
+    @staticmethod
+    def split_entries(entries, jobs):
+        """
+        Split entries into (at most) jobs batches of contiguous dat ranges with about the same number of bytes,
+        so each worker reads its part of the dat file sequentially
+        :param entries: (list) of CatEntry, in dat file order
+        :param jobs: (int) number of batches
+        :return: (list) of lists of entries
+        """
+        total = sum(entry.size for entry in entries) or 1
+        batches = [[] for _ in range(jobs)]
+        done = 0
+        for entry in entries:
+            batches[min(jobs - 1, done * jobs // total)].append(entry)
+            done += entry.size
+        return [batch for batch in batches if batch]
+
+    @staticmethod
+    def compile_filter(pattern):
+        """
+        Compile include/exclude filter pattern into a match function
+        - patterns starting with ^ are regexes (same convention as the patched ElementTree attribute predicates)
+        - other patterns are globs, matched against the whole path if they contain a /, else against the filename
+        eg. '^assets/units/.*_main-lod0\\.xmf$', 'assets/units/**/*.xmf', '*_main-lod0.xmf'
+        :param pattern: (str) regex or glob pattern
+        :return: (callable) match(filename) -> truthy if filename matches
+        """
+        if pattern.startswith('^'):
+            return re.compile(pattern).match
+        match = glob_to_regex(pattern).match
+        if '/' in pattern:
+            return match
+        return lambda filename: match(filename.rsplit('/', 1)[-1])
+
+    def __init__(self, out_path=None, scripts_only=True, signatures=False, jobs=1, incremental=False,
+                 include=(), exclude=()):
         """
         Init parser
         :param out_path: (str) path to extract to
         :param scripts_only: (bool) extract/list only scripts
         :param signatures: (bool) include signatures in extraction/listing
+        :param jobs: (int) number of extraction worker threads (1 = extract serially)
+        :param incremental: (bool) skip files unchanged since the last extraction (per out_path manifest)
+        :param include: (list) of glob/regex patterns, only list/extract files matching one of them (if any given)
+        :param exclude: (list) of glob/regex patterns, don't list/extract files matching any of them
         """
         self.out_path = out_path
         self.scripts_only = scripts_only
         self.signatures = signatures
+        self.jobs = jobs
+        self.incremental = incremental
+        self.include = [self.compile_filter(pattern) for pattern in include or ()]
+        self.exclude = [self.compile_filter(pattern) for pattern in exclude or ()]
+        self.manifest = None
+        self.created_dirs = set()
+        self.stats = Counter()
+
+    def make_dirs(self, entries):
+        """
+        Create output dirs for entries up front, each dir is created only once per parser
+        (instead of an os.makedirs per extracted file)
+        :param entries: (list) of CatEntry
+        :return: None
+        """
+        dirs = {'{}/{}'.format(self.out_path, entry.filename).rsplit('/', 1)[0] for entry in entries}
+        new_dirs = dirs - self.created_dirs
+        for path in sorted(new_dirs):
+            os.makedirs(path, exist_ok=True)
+        self.created_dirs |= new_dirs
+        self.stats['makedirs'] += len(new_dirs)
+        self.stats['makedirs_saved'] += len(entries) - len(new_dirs)
+
+    def load_manifest(self):
+        """
+        Load manifest of previously extracted files from out_path
+        :return: (dict) filename -> [size, timestamp, md5hex]
+        """
+        manifest_filename = '{}/{}'.format(self.out_path, self.MANIFEST_FILENAME)
+        if not os.path.exists(manifest_filename):
+            return {}
+        try:
+            with open(manifest_filename, 'r') as manifest_file:
+                return json.load(manifest_file)
+        except ValueError:
+            logger.warning('invalid manifest %s, extracting all files', manifest_filename)
+            return {}
+
+    def save_manifest(self):
+        """
+        Save manifest of extracted files into out_path (written to a temp file first, so it's never left half written)
+        :return: None
+        """
+        manifest_filename = '{}/{}'.format(self.out_path, self.MANIFEST_FILENAME)
+        os.makedirs(self.out_path, exist_ok=True)
+        with open(manifest_filename + '.tmp', 'w') as manifest_file:
+            json.dump(self.manifest, manifest_file, sort_keys=True, separators=(',', ':'))
+        os.replace(manifest_filename + '.tmp', manifest_filename)
+
+    def is_unchanged(self, entry):
+        """
+        Was entry already extracted with the same cat metadata (and is the extracted file still there)
+        :param entry: (CatEntry) cat entry
+        :return: (bool) True if extraction can be skipped else False
+        """
+        if self.manifest.get(entry.filename) != [entry.size, entry.timestamp, entry.md5hex]:
+            return False
+        try:
+            return os.stat('{}/{}'.format(self.out_path, entry.filename)).st_size == entry.size
+        except OSError:
+            return False
+
+    def is_selected(self, filename):
+        """
+        Should filename be listed/extracted with current parser settings
+        :param filename: (str) filename
+        :return: (bool) True if selected else False
+        """
+        if self.scripts_only:
+            if not self.is_script_file(filename):
+                return False
+        elif not self.signatures and self.is_sig_file(filename):
+            return False
+        if self.include and not any(match(filename) for match in self.include):
+            return False
+        return not any(match(filename) for match in self.exclude)
 
     def list(self, cat_filename):
         """
@@ -100,14 +350,16 @@ class CatParser(object):
         :param cat_filename: (str) file/path of cat file
         :return: None
         """
-        files_iter = self.cat_files_iterator(cat_filename)
+        self.list_files(self.cat_files_iterator(cat_filename))
+
+    def list_files(self, files_iter):
+        """
+        List files
+        :param files_iter: (iterable) of (filename, offset, size)
+        :return: None
+        """
         for filename, offset, size in files_iter:
-            if self.scripts_only:
-                if self.is_script_file(filename):
-                    logger.info('%60s (%10d)', filename, size)
-            else:
-                if not self.signatures and self.is_sig_file(filename):
-                    continue
+            if self.is_selected(filename):
                 logger.info('%60s (%10d)', filename, size)
 
     def extract(self, cat_filename):
@@ -121,26 +373,516 @@ class CatParser(object):
             - offset for each file is the cumulative sum of sizes of previous files in the cat file
 
         :param cat_filename: (str) file/path of cat file
-        :return:
+        :return: None
+        """
+        entries = [entry for entry in self.cat_entries_iterator(cat_filename) if self.is_selected(entry.filename)]
+        self.extract_entries(cat_filename, entries)
+
+    def extract_index(self, cat_index):
+        """
+        Extract files of a merged cat index, each path is extracted once (from the cat that wins in load order)
+        :param cat_index: (CatIndex) merged index
+        :return: None
+        """
+        for cat_filename, entries in cat_index.entries_by_cat():
+            self.extract_entries(cat_filename, [entry for entry in entries if self.is_selected(entry.filename)])
+
+    def extract_entries(self, cat_filename, entries):
+        """
+        Extract given entries from cat/dat file
+        :param cat_filename: (str) file/path of cat file
+        :param entries: (list) of CatEntry to extract, in dat file order
+        :return: None
         """
         dat_filename = cat_filename[:-4] + ".dat"
-        files_iter = self.cat_files_iterator(cat_filename)
-        with open(dat_filename, "rb") as dat_file:
-            for filename, offset, size in files_iter:
-                if self.scripts_only:
-                    if self.is_script_file(filename):
-                        out_file_path = '{}/{}'.format(self.out_path, filename)
-                        self.extract_file(dat_file, out_file_path, offset, size)
-                        logger.info('%60s | %10s', cat_filename, out_file_path)
+        start_time = time.perf_counter()
+        if self.incremental:
+            if self.manifest is None:
+                self.manifest = self.load_manifest()
+            selected_count = len(entries)
+            entries = [entry for entry in entries if not self.is_unchanged(entry)]
+            self.stats['skipped'] += selected_count - len(entries)
+
+        self.make_dirs(entries)
+        if self.jobs > 1:
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                futures = [executor.submit(self.extract_worker, dat_filename, self.out_path, batch)
+                           for batch in self.split_entries(entries, self.jobs)]
+                for future in futures:
+                    files, size = future.result()
+                    self.stats['files'] += files
+                    self.stats['bytes'] += size
+        elif entries:
+            with open(dat_filename, "rb") as dat_file:
+                for entry in entries:
+                    out_file_path = '{}/{}'.format(self.out_path, entry.filename)
+                    self.extract_file(dat_file.fileno(), out_file_path, entry.offset, entry.size, make_dirs=False)
+                    logger.info('%60s | %10s', cat_filename, out_file_path)
+                    self.stats['files'] += 1
+                    self.stats['bytes'] += entry.size
+
+        if self.incremental and entries:
+            self.manifest.update((entry.filename, [entry.size, entry.timestamp, entry.md5hex]) for entry in entries)
+            self.save_manifest()
+        self.stats['seconds'] += time.perf_counter() - start_time
+
+
+class CatIndex(object):
+    """
+    Merged index of several cat files, resolved the way the game loads them:
+    cats are loaded in load order (01.cat, 02.cat, ... 10.cat) and when a path is in more cats, the last one wins
+    """
+
+    def __init__(self):
+        self.files = {}  # filename -> (cat_filename, CatEntry)
+        self.cat_filenames = []
+        self.overridden = 0
+
+    @staticmethod
+    def load_order_key(cat_filename):
+        """
+        Sort key for cat files in game load order (numbers are compared as numbers, so 9.cat < 10.cat)
+        :param cat_filename: (str) file/path of cat file
+        :return: (tuple) sort key
+        """
+        name = cat_filename.rsplit('/', 1)[-1]
+        return tuple(int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name))
+
+    @classmethod
+    def from_cats(cls, cat_filenames):
+        """
+        Build merged index from cat files
+        :param cat_filenames: (iterable) of cat file/paths (in any order)
+        :return: (CatIndex)
+        """
+        index = cls()
+        for cat_filename in sorted(cat_filenames, key=cls.load_order_key):
+            index.add_cat(cat_filename)
+        return index
+
+    def add_cat(self, cat_filename):
+        """
+        Add cat file to index, its entries override entries of previously added cats
+        :param cat_filename: (str) file/path of cat file
+        :return: None
+        """
+        self.cat_filenames.append(cat_filename)
+        for entry in CatParser.cat_entries_iterator(cat_filename):
+            if entry.filename in self.files:
+                self.overridden += 1
+            self.files[entry.filename] = (cat_filename, entry)
+
+    def lookup(self, filename):
+        """
+        Find file by path
+        :param filename: (str) filename as listed in the cat file
+        :return: (str, CatEntry) cat_filename, entry of the last cat (in load order) with the file, or None
+        """
+        return self.files.get(filename)
+
+    def which(self, filename):
+        """
+        Which cat supplies the file
+        :param filename: (str) filename as listed in the cat file
+        :return: (str) file/path of cat file or None if not found
+        """
+        cat_filename, entry = self.files.get(filename, (None, None))
+        return cat_filename
+
+    def __iter__(self):
+        """
+        :return: yields (cat_filename, CatEntry) of the winning entries
+        """
+        return iter(self.files.values())
+
+    def entries_by_cat(self):
+        """
+        Winning entries grouped by cat (in load order), each group sorted by offset for sequential dat reads
+        :return: yields (cat_filename, list of CatEntry)
+        """
+        groups = {cat_filename: [] for cat_filename in self.cat_filenames}
+        for cat_filename, entry in self.files.values():
+            groups[cat_filename].append(entry)
+        for cat_filename, entries in groups.items():
+            if entries:
+                yield cat_filename, sorted(entries, key=lambda entry: entry.offset)
+
+
+class CatIndexCache(object):
+    """
+    Persistent binary index of cat files, built once (per game version) and memory mapped when used,
+    so listing and by-path lookups don't need to re-parse all the text cat files.
+    The cache is rebuilt when the set of cat files, or the size/mtime of any of them, changes.
+
+    File layout:
+    - header: magic, version, number of cats, number of entries
+    - cats: (size, mtime_ns, name length) + name, for each cat in load order
+    - entries: (cat no, name offset, name length, offset, size, timestamp, md5) for each file, in cat order
+    - hashes: (path hash, entry no) sorted by path hash, for binary search lookups by path
+    - names: utf-8 filenames
+    """
+    MAGIC = b'X4CI'
+    VERSION = 1
+    HEADER = struct.Struct('<4sIII')
+    CAT = struct.Struct('<qqH')
+    ENTRY = struct.Struct('<IIHQQq16s')
+    HASH = struct.Struct('<QI')
+
+    def __init__(self, cache_filename, cat_filenames):
+        """
+        Init cache (use load() to get an opened cache)
+        :param cache_filename: (str) file/path of cache file
+        :param cat_filenames: (iterable) of cat file/paths to index
+        """
+        self.cache_filename = cache_filename
+        self.cat_filenames = sorted(cat_filenames, key=CatIndex.load_order_key)
+        self.data = None
+        self.entry_count = 0
+        self.entries_start = self.hashes_start = self.names_start = 0
+
+    @classmethod
+    def load(cls, cache_filename, cat_filenames):
+        """
+        Open cache, (re)building it if it's missing or stale
+        :param cache_filename: (str) file/path of cache file
+        :param cat_filenames: (iterable) of cat file/paths to index
+        :return: (CatIndexCache)
+        """
+        cache = cls(cache_filename, cat_filenames)
+        if not cache.open():
+            logger.info('building cat index cache %s', cache_filename)
+            cache.build()
+            cache.open()
+        return cache
+
+    @staticmethod
+    def path_hash(filename):
+        """
+        64bit hash of a path
+        :param filename: (str) filename as listed in the cat file
+        :return: (int)
+        """
+        return int.from_bytes(hashlib.blake2b(filename.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def cat_stats(self):
+        """
+        :return: (list) of (cat_filename, size, mtime_ns) used to detect a stale cache
+        """
+        stats = []
+        for cat_filename in self.cat_filenames:
+            stat = os.stat(cat_filename)
+            stats.append((cat_filename, stat.st_size, stat.st_mtime_ns))
+        return stats
+
+    def build(self):
+        """
+        Parse all cat files and write the cache file (to a temp file first, so it's never left half written)
+        :return: None
+        """
+        cat_stats = self.cat_stats()
+        entries = []
+        hashes = []
+        names = bytearray()
+        for cat_no, cat_filename in enumerate(self.cat_filenames):
+            for entry in CatParser.cat_entries_iterator(cat_filename):
+                name = entry.filename.encode('utf-8')
+                hashes.append((self.path_hash(entry.filename), len(entries)))
+                entries.append(self.ENTRY.pack(cat_no, len(names), len(name), entry.offset, entry.size,
+                                               entry.timestamp, bytes.fromhex(entry.md5hex)))
+                names += name
+        hashes.sort()
+
+        os.makedirs(os.path.dirname(self.cache_filename) or '.', exist_ok=True)
+        with open(self.cache_filename + '.tmp', 'wb') as cache_file:
+            cache_file.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(cat_stats), len(entries)))
+            for cat_filename, size, mtime_ns in cat_stats:
+                name = cat_filename.encode('utf-8')
+                cache_file.write(self.CAT.pack(size, mtime_ns, len(name)) + name)
+            cache_file.write(b''.join(entries))
+            cache_file.write(b''.join(self.HASH.pack(*path_hash) for path_hash in hashes))
+            cache_file.write(names)
+        os.replace(self.cache_filename + '.tmp', self.cache_filename)
+
+    def open(self):
+        """
+        Memory map cache file if it's valid for the current cat files
+        :return: (bool) True if opened, False if cache file is missing or stale
+        """
+        self.close()
+        try:
+            with open(self.cache_filename, 'rb') as cache_file:
+                data = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        try:
+            magic, version, cat_count, entry_count = self.HEADER.unpack_from(data, 0)
+            if magic != self.MAGIC or version != self.VERSION:
+                raise ValueError('unsupported cache file')
+            position = self.HEADER.size
+            cat_stats = []
+            for _ in range(cat_count):
+                size, mtime_ns, name_len = self.CAT.unpack_from(data, position)
+                position += self.CAT.size
+                cat_stats.append((data[position:position + name_len].decode('utf-8'), size, mtime_ns))
+                position += name_len
+            if cat_stats != self.cat_stats():
+                raise ValueError('stale cache file')
+        except (struct.error, ValueError) as e:
+            logger.info('cat index cache %s: %s', self.cache_filename, e)
+            data.close()
+            return False
+
+        self.data = data
+        self.entry_count = entry_count
+        self.entries_start = position
+        self.hashes_start = self.entries_start + entry_count * self.ENTRY.size
+        self.names_start = self.hashes_start + entry_count * self.HASH.size
+        return True
+
+    def entry(self, entry_no):
+        """
+        Get entry by number
+        :param entry_no: (int) entry number (entries are in cat load order, and in cat order for each cat)
+        :return: (str, CatEntry) cat_filename, entry
+        """
+        cat_no, name_offset, name_len, offset, size, timestamp, md5 = self.ENTRY.unpack_from(
+            self.data, self.entries_start + entry_no * self.ENTRY.size)
+        name_start = self.names_start + name_offset
+        filename = self.data[name_start:name_start + name_len].decode('utf-8')
+        return self.cat_filenames[cat_no], CatEntry(filename, offset, size, timestamp, md5.hex())
+
+    def lookup(self, filename):
+        """
+        Find file by path, with binary search over the sorted path hashes
+        :param filename: (str) filename as listed in the cat file
+        :return: (str, CatEntry) cat_filename, entry of the last cat (in load order) with the file, or None
+        """
+        path_hash = self.path_hash(filename)
+        low, high = 0, self.entry_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.HASH.unpack_from(self.data, self.hashes_start + middle * self.HASH.size)[0] < path_hash:
+                low = middle + 1
+            else:
+                high = middle
+        found = None
+        for hash_no in range(low, self.entry_count):
+            entry_hash, entry_no = self.HASH.unpack_from(self.data, self.hashes_start + hash_no * self.HASH.size)
+            if entry_hash != path_hash:
+                break
+            cat_filename, entry = self.entry(entry_no)
+            if entry.filename == filename:
+                found = cat_filename, entry
+        return found
+
+    def which(self, filename):
+        """
+        Which cat supplies the file
+        :param filename: (str) filename as listed in the cat file
+        :return: (str) file/path of cat file or None if not found
+        """
+        found = self.lookup(filename)
+        return found and found[0]
+
+    def __len__(self):
+        return self.entry_count
+
+    def __iter__(self):
+        for entry_no in range(self.entry_count):
+            yield self.entry(entry_no)
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+        self.data = None
+
+
+class CatArchive(object):
+    """
+    Read-only access to the files of a single cat/dat pair, the dat file is memory mapped on first read
+    """
+
+    def __init__(self, cat_filename):
+        """
+        Load cat index
+        :param cat_filename: (str) file/path of cat file
+        """
+        self.cat_filename = cat_filename
+        self.dat_filename = cat_filename[:-4] + '.dat'
+        self.entries = {entry.filename: entry for entry in CatParser.cat_entries_iterator(cat_filename)}
+        self.dat_mmap = None
+
+    def get_mmap(self):
+        """
+        Memory map dat file (once)
+        :return: (mmap|bytes) mapped dat file (empty dat files can't be mapped, so b'' is used for those)
+        """
+        if self.dat_mmap is None:
+            with open(self.dat_filename, 'rb') as dat_file:
+                if os.fstat(dat_file.fileno()).st_size:
+                    self.dat_mmap = mmap.mmap(dat_file.fileno(), 0, access=mmap.ACCESS_READ)
                 else:
-                    if not self.signatures and self.is_sig_file(filename):
-                        continue
-                    out_file_path = '{}/{}'.format(self.out_path, filename)
-                    self.extract_file(dat_file, out_file_path, offset, size)
-                    logger.info('\t%s', out_file_path)
+                    self.dat_mmap = b''
+        return self.dat_mmap
+
+    def read_entry(self, entry):
+        """
+        Read file data of a cat entry
+        :param entry: (CatEntry) cat entry of this archive
+        :return: (bytes) file data
+        """
+        return self.get_mmap()[entry.offset:entry.offset + entry.size]
+
+    def read(self, filename):
+        """
+        Read file data
+        :param filename: (str) filename as listed in the cat file
+        :return: (bytes) file data
+        """
+        return self.read_entry(self.entries[filename])
+
+    def close(self):
+        if self.dat_mmap:
+            self.dat_mmap.close()
+        self.dat_mmap = None
+
+
+class CatFS(object):
+    """
+    Read-only virtual filesystem over cat/dat archives
+    Files are addressed by '{prefix}/{filename in cat}' (eg. base/libraries/wares.xml, ego_dlc_split/index/macros.xml),
+    which is the same layout extract_x4.py uses for the src dir, so tools can work from the game dir without extracting.
+    When more archives have the same path, the archive added last wins.
+    """
+
+    def __init__(self):
+        self.archives = []
+        self.files = {}
+
+    @classmethod
+    def from_game(cls, game_path):
+        """
+        Load cat indexes of the base game (as base/...) and all ego_dlc_* extensions (as ego_dlc_*/...)
+        in game load order (see CatIndex.load_order_key)
+        :param game_path: (str) path of the X4 game dir
+        :return: (CatFS)
+        """
+        fs = cls()
+        for cat_filename in sorted(glob.iglob(f'{game_path}/*.cat'), key=CatIndex.load_order_key):
+            fs.add_cat(cat_filename, prefix='base')
+        for dlc_path in sorted(glob.iglob(f'{game_path}/extensions/ego_dlc_*')):
+            dlc = dlc_path.rsplit('/', 1)[-1]
+            for cat_filename in sorted(glob.iglob(f'{dlc_path}/*.cat'), key=CatIndex.load_order_key):
+                fs.add_cat(cat_filename, prefix=dlc)
+        return fs
+
+    def add_cat(self, cat_filename, prefix):
+        """
+        Add cat/dat archive files to filesystem
+        :param cat_filename: (str) file/path of cat file
+        :param prefix: (str) path prefix for files in this archive
+        :return: (CatArchive)
+        """
+        archive = CatArchive(cat_filename)
+        self.archives.append(archive)
+        for filename, entry in archive.entries.items():
+            self.files[f'{prefix}/{filename}'] = (archive, entry)
+        return archive
+
+    def exists(self, path):
+        return path in self.files
+
+    def getsize(self, path):
+        return self.files[path][1].size
+
+    def read(self, path):
+        """
+        Read file data
+        :param path: (str) '{prefix}/{filename}'
+        :return: (bytes) file data
+        """
+        try:
+            archive, entry = self.files[path]
+        except KeyError:
+            raise FileNotFoundError(path)
+        return archive.read_entry(entry)
+
+    def open(self, path):
+        """
+        Open file for reading (eg. to pass to ElementTree.parse)
+        :param path: (str) '{prefix}/{filename}'
+        :return: (io.BytesIO) file object
+        """
+        return io.BytesIO(self.read(path))
+
+    def glob(self, pattern):
+        """
+        Find files by glob pattern (`**/` matches any number of dirs, like glob.glob(..., recursive=True))
+        :param pattern: (str) glob pattern, eg. '*/index/macros.xml', '**/ship_*_macro.xml'
+        :return: (list) sorted list of matching paths
+        """
+        match = glob_to_regex(pattern).match
+        return sorted(path for path in self.files if match(path))
+
+    def close(self):
+        for archive in self.archives:
+            archive.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def log_throughput(stats):
+    """
+    Log aggregate extraction throughput
+    :param stats: (Counter) parser stats (files, bytes, seconds)
+    :return: None
+    """
+    mbytes = stats['bytes'] / 1024 / 1024
+    seconds = stats['seconds']
+    logger.warning('Extracted %d files, %.1f MB in %.2fs (%.1f MB/s)',
+                   stats['files'], mbytes, seconds, mbytes / seconds if seconds else 0)
+    if stats['skipped']:
+        logger.warning('Skipped %d unchanged files', stats['skipped'])
+
 
+def log_stats(stats):
+    """
+    Log extraction stats summary (--stats)
+    :param stats: (Counter) parser stats
+    :return: None
+    """
+    # an os.makedirs(exist_ok=True) on an existing dir costs a mkdir (EEXIST) and a stat syscall
+    logger.warning('Created %d dirs, saved %d os.makedirs calls (~%d mkdir/stat syscalls)',
+                   stats['makedirs'], stats['makedirs_saved'], stats['makedirs_saved'] * 2)
+
+
+def verify_cats(cat_filenames, jobs=None):
+    """
+    Verify dat files of cats against their md5 hashes, one process per cat
+    :param cat_filenames: (iterable) of cat file/paths
+    :param jobs: (int) number of processes (default: number of cpus)
+    :return: (dict) cat_filename -> list of (filename, expected md5hex, actual md5hex) for cats with mismatches
+    """
+    # biggest dat files first, so one big dat doesn't end up running alone at the end
+    cat_filenames = sorted(cat_filenames, key=lambda cat: -os.path.getsize(cat[:-4] + '.dat'))
+    failed = {}
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        for cat_filename, mismatches in zip(cat_filenames, executor.map(CatParser.verify_cat, cat_filenames)):
+            logger.info('%60s | %s', cat_filename, 'FAILED' if mismatches else 'OK')
+            for filename, md5hex, actual_md5hex in mismatches:
+                logger.error('%s: %s md5 mismatch (expected %s, got %s)', cat_filename, filename, md5hex, actual_md5hex)
+            if mismatches:
+                failed[cat_filename] = mismatches
+    return failed
 
-def extract_x4(cat_path, out_path, extract, scripts_only, signatures=False):
+
+def extract_x4(cat_path, out_path, extract, scripts_only, signatures=False, jobs=1, incremental=False,
+               include=(), exclude=()):
     """
     Extract all x4 cat files
     :param cat_path: path to game .cat/.dat files
@@ -148,50 +890,90 @@ def extract_x4(cat_path, out_path, extract, scripts_only, signatures=False):
     :param extract: (bool) extract if True else list (bool)
     :param scripts_only: (bool) extract only script files if True else all files
     :param signatures: (bool) extract signature files if True (default False)
-    :return: None
+    :param jobs: (int) number of extraction worker threads
+    :param incremental: (bool) only extract files whose cat metadata changed since the last extraction
+    :param include: (list) of glob/regex patterns, only extract files matching one of them (if any given)
+    :param exclude: (list) of glob/regex patterns, don't extract files matching any of them
+    :return: (Counter) extraction stats
     """
     
-    cats = sorted(f for f in os.listdir(cat_path) if f.endswith('.cat'))
+    cats = sorted((f for f in os.listdir(cat_path) if f.endswith('.cat')), key=CatIndex.load_order_key)
     parser = CatParser(
         out_path=out_path,
         scripts_only=scripts_only,
         signatures=signatures,
+        jobs=jobs,
+        incremental=incremental,
+        include=include,
+        exclude=exclude,
     )
-    method = parser.extract if extract else parser.list
-    for f in cats:
-        method(cat_filename='{}/{}'.format(cat_path, f))
+    if extract:
+        cat_index = CatIndex.from_cats('{}/{}'.format(cat_path, f) for f in cats)
+        logger.info('%s: %d files in %d cats (%d overridden by later cats)',
+                    cat_path, len(cat_index.files), len(cats), cat_index.overridden)
+        parser.extract_index(cat_index)
+    else:
+        for f in cats:
+            parser.list(cat_filename='{}/{}'.format(cat_path, f))
+    return parser.stats
 
 
 if __name__ == '__main__':
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.INFO)
 
-    args = set(sys.argv[1:])
+    argv = sys.argv[1:]
+    args = set(argv)
     if not args:
-        logger.info("%s <--extract | --list> <--all>", sys.argv[0])
+        logger.info("%s <--extract | --list> <--all> <--incremental> <--jobs N> <--stats> "
+                    "<--include PATTERN> <--exclude PATTERN>", sys.argv[0])
         exit(0)
 
+    jobs = int(argv[argv.index('--jobs') + 1]) if '--jobs' in args else 1
+    include = [argv[i + 1] for i, arg in enumerate(argv[:-1]) if arg == '--include']
+    exclude = [argv[i + 1] for i, arg in enumerate(argv[:-1]) if arg == '--exclude']
+
     if args & {'--extract', '--list'}:
         config=get_config()
-        extract_x4(
+        stats = Counter()
+        stats.update(extract_x4(
             extract='--extract' in args,
             scripts_only='--all' not in args,
             cat_path=config.X4,
             out_path=f'{config.SRC}/base',
-        )
+            jobs=jobs,
+            incremental='--incremental' in args,
+            include=include,
+            exclude=exclude,
+        ))
         dlcs = (f for f in os.listdir(f'{config.X4}/extensions') if f.startswith('ego_dlc_'))
         for dlc in dlcs:
-            extract_x4(
+            stats.update(extract_x4(
                 extract='--extract' in args,
                 scripts_only='--all' not in args,
                 cat_path=f'{config.X4}/extensions/{dlc}',
                 out_path=f'{config.SRC}/{dlc}',
-            )
-        
+                jobs=jobs,
+                incremental='--incremental' in args,
+                include=include,
+                exclude=exclude,
+            ))
+        if '--extract' in args:
+            log_throughput(stats)
+            if '--stats' in args:
+                log_stats(stats)
+
 
     else:
         config = get_config()
-        CatParser(
+        parser = CatParser(
             out_path='{}/custom'.format(config.PWD),
             scripts_only=False,
-        ).extract(cat_filename=sys.argv[1])
+            jobs=jobs,
+            include=include,
+            exclude=exclude,
+        )
+        parser.extract(cat_filename=sys.argv[1])
+        log_throughput(parser.stats)
+        if '--stats' in args:
+            log_stats(parser.stats)
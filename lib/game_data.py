@@ -0,0 +1,131 @@
+"""
+# Resolved game data
+
+Extensions (ego_dlc_*, ...) change the library, index and t files of the base game with RFC 5261 diffs
+(see lib.patch_xml), eg. src/ego_dlc_split/libraries/wares.xml adds the split wares to src/base/libraries/wares.xml
+
+resolve() applies the files of all extensions in src to the base file in load order, and keeps the merged file
+in a cache dir (with a hash of the inputs as key), so tools load one pre-merged file instead of patching it
+on each start, until one of the inputs changes (eg. after extracting a game update).
+"""
+import os
+import glob
+import json
+import hashlib
+import logging
+from lib.patched_element_tree import ElementTree
+from lib.patch_xml import patch, PatchTarget
+
+logger = logging.getLogger('x4.' + __name__)
+
+RESOLVED_DIRS = ('libraries', 'index', 't')
+KEYS_FILENAME = 'resolved.json'
+
+
+def extensions(src_path):
+    """
+    :return: extension dirs in src_path in load order, ego_dlc_* first then the others (each sorted by name)
+    """
+    names = sorted(name for name in os.listdir(src_path) if name != 'base' and os.path.isdir(f'{src_path}/{name}'))
+    return [name for name in names if name.startswith('ego_dlc_')] + \
+        [name for name in names if not name.startswith('ego_dlc_')]
+
+
+def input_filenames(src_path, rel_path):
+    """
+    :return: base file and extension files of rel_path (eg. libraries/wares.xml) in load order
+    """
+    filenames = (f'{src_path}/{ext}/{rel_path}' for ext in ['base'] + extensions(src_path))
+    return [filename for filename in filenames if os.path.isfile(filename)]
+
+
+def inputs_key(filenames):
+    md5 = hashlib.md5()
+    for filename in filenames:
+        stat = os.stat(filename)
+        md5.update(f'{filename}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode('utf-8'))
+    return md5.hexdigest()
+
+
+def merge(filenames):
+    """
+    Merge files, the first one is the base: <diff> files are applied to it (see lib.patch_xml.patch),
+    elements of other files (eg. t files of extensions adding their pages) are appended to it
+    :return: ElementTree of merged files, None if there is no base file (only diffs)
+    """
+    merged = target = None
+    for filename in filenames:
+        xml = ElementTree.parse(filename)
+        root = xml.getroot()
+        if merged is None:
+            if root.tag == 'diff':
+                logger.warning('%s: no base file to apply diff to', filename)
+                continue
+            merged, target = xml, PatchTarget(xml)
+        elif root.tag == 'diff':
+            patch(merged, xml, target)
+        else:
+            merged.getroot().extend(root)
+            target.changed_children(merged.getroot())
+    return merged
+
+
+def load_keys(cache_path):
+    try:
+        with open(f'{cache_path}/{KEYS_FILENAME}') as keys_file:
+            return json.load(keys_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_keys(cache_path, keys):
+    os.makedirs(cache_path, exist_ok=True)
+    with open(f'{cache_path}/{KEYS_FILENAME}.tmp', 'w') as keys_file:
+        json.dump(keys, keys_file, indent=1, sort_keys=True)
+    os.replace(f'{cache_path}/{KEYS_FILENAME}.tmp', f'{cache_path}/{KEYS_FILENAME}')
+
+
+def resolve(src_path, rel_path, cache_path=None):
+    """
+    Load rel_path with the files of all extensions applied
+    :param src_path: (str) src path (with base and extension dirs)
+    :param rel_path: (str) eg. libraries/wares.xml
+    :param cache_path: (str) dir to keep merged files in, reused while their inputs don't change,
+                       None: merge in memory
+    :return: ElementTree, None if rel_path isn't in any of the src dirs
+    """
+    filenames = input_filenames(src_path, rel_path)
+    if len(filenames) < 2 or cache_path is None:
+        return merge(filenames)
+
+    key = inputs_key(filenames)
+    keys = load_keys(cache_path)
+    cache_filename = f'{cache_path}/{rel_path}'
+    if keys.get(rel_path) == key and os.path.exists(cache_filename):
+        return ElementTree.parse(cache_filename)
+
+    xml = merge(filenames)
+    if xml is not None:
+        logger.info('resolved %s from %d files', rel_path, len(filenames))
+        os.makedirs(os.path.dirname(cache_filename), exist_ok=True)
+        xml.write(cache_filename + '.tmp', encoding='utf-8', xml_declaration=True)
+        os.replace(cache_filename + '.tmp', cache_filename)
+        keys = load_keys(cache_path)
+        keys[rel_path] = key
+        save_keys(cache_path, keys)
+    return xml
+
+
+def resolve_all(src_path, cache_path, dirs=RESOLVED_DIRS):
+    """
+    Resolve (see resolve) all xml files in dirs of base and extensions into cache_path
+    (files without extension files are loaded from base, they aren't copied)
+    :return: (list) of rel paths resolved
+    """
+    rel_paths = sorted({
+        os.path.relpath(filename, src_path).split(os.sep, 1)[1]
+        for path in dirs for filename in glob.iglob(f'{src_path}/*/{path}/*.xml')
+    })
+    for rel_path in rel_paths:
+        resolve(src_path, rel_path, cache_path)
+    return rel_paths
@@ -5,12 +5,10 @@ Logic to pull in base xml data and patched additions and changes per RFC 5261
 
 ref: https://datatracker.ietf.org/doc/html/rfc5261
 
-Looks like for X4 we only need <Add> tag for assets
-but RFC 5261 supports <Replace sel="..."> and <Remove sel="..." /> tags
-it might be good to implement those as well at some point
-
-
-WORK IN PROGRESS
+Supported ops (see patch):
+    <add sel="..."> elements (pos="prepend|before|after", appended by default), <add sel="..." type="@attrib">
+    <replace sel="..."> element, <replace sel=".../@attrib">
+    <remove sel="..."/> element, <remove sel=".../@attrib"/>
 
 
 eg.
@@ -43,32 +41,359 @@ eg. ego_dlc_terran libraries/wares.xml
 
 
 """
+import re
+import logging
+import functools
+from lib.patched_element_tree import ElementTree, invalidate_attribs
 
+logger = logging.getLogger('x4.' + __name__)
 
+# attributes that usually identify an element among its siblings, used for diff selectors before positions
+DIFF_KEY_ATTRIBS = ('name', 'id', 'macro', 'ref')
+DIFF_SEL_KEY_RE = re.compile(r'''\[@([\w.:-]+)=(?:'[^']*'|"[^"]*")\]$''')
 
-def patch(base_xml, patch_xml):
-    base = base_xml.getroot()
-    base_tag = base.tag
-    for add_el in patch_xml.findall('./add'):
-        sel =  add_el.attrib['sel']
-        if not sel.startswith(f'/{base_tag}'):
-            print(f'Invalid diff tag path {sel} does not start with /{base_tag}')
-            continue
-        sel2 = sel.replace(f'/{base_tag}', '.')
-        base_el = base.find(sel2)
-        #
-        if base_el is None:
-            if add_el.get('silent') == "1":  
-                # this is not part of rfc but seems to be what X4 uses 
+
+SEL_ATTRIB_RE = re.compile(r'/@([\w.:-]+)$')
+SEL_STEP_RE = re.compile(r'''/([\w.:-]+|\*)((?:\[(?:'[^']*'|"[^"]*"|[^\]'"])*\])*)''')
+SEL_PREDICATE_RE = re.compile(r'''\[\s*(?:@([\w.:-]+)\s*(?:=\s*(?:'([^']*)'|"([^"]*)")\s*)?'''
+                              r'''|(\d+)\s*|(last\(\))\s*)\]''')
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_selector(sel):
+    """
+    Parse sel (eg. /wares/ware[@id='energycells']/owner[2]/@faction) into child steps
+    :return: (steps, attrib), steps: list of (tag, predicates), None if sel isn't an absolute path of child steps
+             with [@attrib], [@attrib='value'], [n] or [last()] predicates (see PatchTarget.find),
+             predicates: ('@', attrib, value or None) or ('#', index) (-1 for last()),
+             attrib: attribute selected by sel (or None if sel selects elements)
+    """
+    attrib = None
+    match = SEL_ATTRIB_RE.search(sel)
+    if match:
+        attrib, sel = match.group(1), sel[:match.start()]
+    sel = sel.rstrip('/') if len(sel) > 1 else sel
+    steps, pos = [], 0
+    while pos < len(sel):
+        match = SEL_STEP_RE.match(sel, pos)
+        if not match:
+            return None, attrib
+        predicates, predicates_pos = [], 0
+        while predicates_pos < len(match.group(2)):
+            predicate = SEL_PREDICATE_RE.match(match.group(2), predicates_pos)
+            if not predicate:
+                return None, attrib
+            key, value1, value2, index, last = predicate.groups()
+            if key:
+                predicates.append(('@', key, value1 if value1 is not None else value2))
+            else:
+                predicates.append(('#', int(index) - 1 if index else -1))
+            predicates_pos = predicate.end()
+        steps.append((match.group(1), tuple(predicates)))
+        pos = match.end()
+    return (steps or None), attrib
+
+
+class PatchTarget(object):
+    """
+    Base document patches are applied to (see patch).
+    Selectors are resolved step by step with indexes of the children of elements (by tag, and by tag + attribute
+    value for [@attrib='value'] predicates) built on first use, so a patch with many ops selecting among thousands
+    of siblings (eg. /wares/ware[@id='...']) doesn't scan all of them for each op. Indexes of an element are dropped
+    when its children or their (indexed) attributes change, the rest are kept for the next ops and patches.
+    """
+
+    def __init__(self, base_xml):
+        self.tree = base_xml if isinstance(base_xml, ElementTree.ElementTree) else ElementTree.ElementTree(base_xml)
+        self.children_index = {}  # parent el -> {tag: [child els]}
+        self.attrib_index = {}  # parent el -> {(tag, attrib): {value: [child els]}}
+
+    def children(self, parent, tag):
+        index = self.children_index.get(parent)
+        if index is None:
+            index = self.children_index[parent] = {}
+            for child in parent:
+                index.setdefault(child.tag, []).append(child)
+        if tag == '*':
+            return [child for child in parent if isinstance(child.tag, str)]
+        return index.get(tag, [])
+
+    def children_by_attrib(self, parent, tag, key, value):
+        index = self.attrib_index.setdefault(parent, {})
+        values = index.get((tag, key))
+        if values is None:
+            values = index[(tag, key)] = {}
+            for child in self.children(parent, tag):
+                child_value = child.get(key)
+                if child_value is not None:
+                    values.setdefault(child_value, []).append(child)
+        return values.get(value, [])
+
+    def changed_children(self, parent):
+        self.children_index.pop(parent, None)
+        self.attrib_index.pop(parent, None)
+        invalidate_attribs(self.tree)
+
+    def changed_attrib(self, parent, key):
+        index = self.attrib_index.get(parent, {})
+        for index_key in [index_key for index_key in index if index_key[1] == key]:
+            del index[index_key]
+        invalidate_attribs(self.tree, key)
+
+    @staticmethod
+    def select(els, predicates):
+        for predicate in predicates:
+            if predicate[0] == '@':
+                key, value = predicate[1:]
+                els = [el for el in els if (el.get(key) is not None if value is None else el.get(key) == value)]
+            else:
+                index = predicate[1]
+                els = els[index:index + 1 or None]
+        return els
+
+    def step(self, parent, tag, predicates):
+        if tag != '*' and predicates and predicates[0][0] == '@' and predicates[0][2] is not None:
+            els = self.children_by_attrib(parent, tag, predicates[0][1], predicates[0][2])
+            predicates = predicates[1:]
+        else:
+            els = self.children(parent, tag)
+        return self.select(els, predicates)
+
+    def find(self, sel):
+        """
+        Resolve sel
+        Selectors other than absolute paths of child steps (eg. //ware[@id='x'], ware[contains(...)]) are resolved
+        with (patched, see lib.patched_element_tree) ElementPath, so only the syntax it supports works for them.
+        :return: (list of (parent el or None for root, el) matched, attribute selected or None)
+        """
+        steps, attrib = parse_selector(sel)
+        root = self.tree.getroot()
+        if steps is None:
+            path = sel[:-len(attrib) - 2] if attrib else sel
+            if path.startswith(f'/{root.tag}/') or path == f'/{root.tag}':
+                path = path[len(root.tag) + 1:]
+            parents = {child: parent for parent in root.iter() for child in parent}
+            try:
+                els = root.findall(f'.{path}') if path else [root]
+            except SyntaxError as e:
+                logger.error('unsupported selector %s: %s', sel, e)
+                return [], attrib
+            return [(parents.get(el), el) for el in els], attrib
+
+        (tag, predicates), steps = steps[0], steps[1:]
+        matches = [(None, root)] if tag in (root.tag, '*') and self.select([root], predicates) else []
+        for tag, predicates in steps:
+            matches = [(parent, el) for _, parent in matches for el in self.step(parent, tag, predicates)]
+        return matches, attrib
+
+    def apply(self, op_els):
+        """
+        Apply patch op (<add>, <replace>, <remove>), op_els: op, or consecutive <add> ops of the same sel and pos
+        (their elements are added together)
+        :return: (bool) if applied
+        """
+        op_el = op_els[0]
+        sel = op_el.get('sel')
+        if op_el.tag not in ('add', 'replace', 'remove') or not sel:
+            logger.error('invalid patch op <%s sel="%s">', op_el.tag, sel)
+            return False
+        matches, attrib = self.find(sel)
+        if len(matches) != 1:
+            if not matches and op_el.get('silent') in ('1', 'true'):
+                # this is not part of rfc but seems to be what X4 uses
                 # to suppress errors for missing wares from DLCs player might not have.
-                print(f'Element {sel} not found, but allowed to fail silently.')
-                continue
+                logger.info('patch op <%s sel="%s">: no element matched, allowed to fail silently', op_el.tag, sel)
             else:
-                print(f'Element {sel} not found!')
-                break
-        for add_el_child in add_el.findall('./*'):
-            base_el.append(add_el_child)
+                logger.error('patch op <%s sel="%s">: %s elements matched', op_el.tag, sel, len(matches) or 'no')
+            return False
+        parent, el = matches[0]
+        return getattr(self, op_el.tag)(op_els, parent, el, attrib)
+
+    def add(self, op_els, parent, el, attrib):
+        op_el = op_els[0]
+        add_type = op_el.get('type')
+        if attrib:
+            logger.error('patch op <add sel="%s">: can only add to an element', op_el.get('sel'))
+            return False
+        if add_type:
+            if not add_type.startswith('@') or el.get(add_type[1:]) is not None:
+                logger.error('patch op <add sel="%s" type="%s">: unsupported type or attribute exists',
+                             op_el.get('sel'), add_type)
+                return False
+            el.set(add_type[1:], op_el.text or '')
+            self.changed_attrib(parent, add_type[1:])
+            return True
+
+        new_els = [new_el for op_el in op_els for new_el in op_el if isinstance(new_el.tag, str)]
+        pos = op_el.get('pos')
+        if pos in ('before', 'after'):
+            if parent is None:
+                logger.error('patch op <add sel="%s" pos="%s">: can\'t add next to root', op_el.get('sel'), pos)
+                return False
+            index = list(parent).index(el) + (pos == 'after')
+            parent[index:index] = new_els
+            self.changed_children(parent)
+        else:
+            index = 0 if pos == 'prepend' else len(el)
+            el[index:index] = new_els
+            self.changed_children(el)
+        return True
+
+    def replace(self, op_els, parent, el, attrib):
+        op_el = op_els[0]
+        if attrib:
+            if el.get(attrib) is None:
+                logger.error('patch op <replace sel="%s">: attribute not found', op_el.get('sel'))
+                return False
+            el.set(attrib, op_el.text or '')
+            self.changed_attrib(parent, attrib)
+            return True
+
+        new_els = [new_el for new_el in op_el if isinstance(new_el.tag, str)]
+        if len(new_els) != 1:
+            logger.error('patch op <replace sel="%s">: expected one element, got %s', op_el.get('sel'), len(new_els))
+            return False
+        new_el = new_els[0]
+        new_el.tail = el.tail
+        if parent is None:
+            invalidate_attribs(self.tree)
+            self.tree._setroot(new_el)
+            self.children_index, self.attrib_index = {}, {}
+        else:
+            parent[list(parent).index(el)] = new_el
+            self.changed_children(parent)
+        return True
+
+    def remove(self, op_els, parent, el, attrib):
+        op_el = op_els[0]
+        if attrib:
+            if el.get(attrib) is None:
+                logger.error('patch op <remove sel="%s">: attribute not found', op_el.get('sel'))
+                return False
+            del el.attrib[attrib]
+            self.changed_attrib(parent, attrib)
+            return True
+
+        if parent is None:
+            logger.error('patch op <remove sel="%s">: can\'t remove root', op_el.get('sel'))
+            return False
+        parent.remove(el)
+        self.changed_children(parent)
+        return True
+
+
+def batch_ops(ops):
+    """
+    Group consecutive <add> ops appending elements to the same sel (and same silent),
+    so the sel is resolved once for all of them.
+    Ops with pos (prepend/before/after) aren't grouped, each of them inserts at the position of its own
+    (eg. two pos="after" adds put the second op's elements before the first op's).
+    """
+    batch = []
+    for op_el in ops:
+        if not isinstance(op_el.tag, str):
+            continue
+        key = op_el.tag, op_el.get('sel'), op_el.get('silent'), op_el.get('pos'), op_el.get('type')
+        if batch and (key[0] != 'add' or key[-2] or key[-1] or key != batch_key):
+            yield batch
+            batch = []
+        batch.append(op_el)
+        batch_key = key
+    if batch:
+        yield batch
 
+
+def patch(base_xml, patch_xml, target=None):
+    """
+    Apply RFC 5261 patch (<diff> of <add>, <replace> and <remove> ops) to base_xml
+    Ops that fail (eg. sel matches no or more than one element) are logged and skipped, like X4 does.
+    Elements of patch_xml are moved into base_xml, not copied.
+    :param base_xml: ElementTree to patch (in place)
+    :param patch_xml: ElementTree or Element of the <diff>
+    :param target: PatchTarget of base_xml to reuse (with its indexes) when applying many patches to it
+    :return: base_xml
+    """
+    target = target or PatchTarget(base_xml)
+    ops = patch_xml.getroot() if isinstance(patch_xml, ElementTree.ElementTree) else patch_xml
+    for op_els in batch_ops(ops):
+        target.apply(op_els)
     return base_xml
 
 
+def diff_selector(parent_sel, siblings, el, new_siblings=()):
+    """
+    Selector of el (child of the element at parent_sel) in the base document,
+    eg. /macros/macro[@name='ship_macro']/properties, by tag if unique, key attribute or position otherwise
+    new_siblings: siblings in the new document, a key attribute value is only used if no other sibling
+                  has it in the base or the new document (the ops of the siblings are applied before its ops)
+    """
+    same_tag = [sibling for sibling in siblings if sibling.tag == el.tag]
+    if len(same_tag) == 1:
+        return f'{parent_sel}/{el.tag}'
+    position = siblings.index(el)
+    others = [sibling for n, sibling in enumerate(list(siblings) + list(new_siblings[:len(siblings)]))
+              if sibling.tag == el.tag and n % len(siblings) != position]
+    for key in DIFF_KEY_ATTRIBS:
+        value = el.get(key)
+        if value is not None and all(sibling.get(key) != value for sibling in others):
+            quote = '"' if "'" in value else "'"
+            return f'{parent_sel}/{el.tag}[@{key}={quote}{value}{quote}]'
+    return f'{parent_sel}/{el.tag}[{same_tag.index(el) + 1}]'
+
+
+def diff_op(ops, op, sel, text=None, **attribs):
+    op_el = ElementTree.SubElement(ops, op, sel=sel, **attribs)
+    op_el.text = text
+    op_el.tail = '\n'
+    return op_el
+
+
+def diff_el(ops, base_el, new_el, sel):
+    base_children, new_children = list(base_el), list(new_el)
+    if (base_el.tag != new_el.tag or (base_el.text or '').strip() != (new_el.text or '').strip()
+            or len(new_children) < len(base_children)
+            or any(base_child.tag != new_child.tag for base_child, new_child in zip(base_children, new_children))):
+        replace_el = diff_op(ops, 'replace', sel)
+        replace_el.append(new_el)
+        return
+
+    # descendants first, their selectors might use attributes of base_el changed below
+    for base_child, new_child in zip(base_children, new_children):
+        diff_el(ops, base_child, new_child, diff_selector(sel, base_children, base_child, new_children))
+    if len(new_children) > len(base_children):
+        add_el = diff_op(ops, 'add', sel)
+        add_el.text = base_el.text
+        add_el.extend(new_children[len(base_children):])
+
+    # the attribute sel selects base_el by (if any) is changed last, the other ops still need to match by it
+    sel_key = DIFF_SEL_KEY_RE.search(sel)
+    sel_key = sel_key and sel_key.group(1)
+    keys = list(new_el.attrib) + [key for key in base_el.attrib if key not in new_el.attrib]
+    for key in sorted(keys, key=lambda key: key == sel_key):
+        value = new_el.get(key)
+        if key not in base_el.attrib:
+            diff_op(ops, 'add', sel, value, type=f'@{key}')
+        elif value is None:
+            diff_op(ops, 'remove', f'{sel}/@{key}')
+        elif base_el.attrib[key] != value:
+            diff_op(ops, 'replace', f'{sel}/@{key}', value)
+
+
+def diff(base_xml, new_xml):
+    """
+    Compute RFC 5261 patch that turns base_xml into new_xml (eg. a src file modified by compile_mod2),
+    so a mod only needs to ship the changes instead of a full copy of the file:
+        changed/added/removed attributes: <replace sel=".../@attrib">, <add sel="..." type="@attrib">,
+                                          <remove sel=".../@attrib"/>
+        elements appended to an element: <add sel="...">
+        any other change of an element (tag, text, removed or reordered children): <replace sel="..."> of it
+    :param base_xml: ElementTree or Element of the original document
+    :param new_xml: ElementTree or Element of the modified document (elements are reused in the patch, not copied)
+    :return: ElementTree of the <diff> patch (without ops if the documents are the same)
+    """
+    base_el = base_xml.getroot() if isinstance(base_xml, ElementTree.ElementTree) else base_xml
+    new_el = new_xml.getroot() if isinstance(new_xml, ElementTree.ElementTree) else new_xml
+    ops = ElementTree.Element('diff')
+    ops.text = '\n'
+    diff_el(ops, base_el, new_el, f'/{base_el.tag}')
+    return ElementTree.ElementTree(ops)
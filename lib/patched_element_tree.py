@@ -1,4 +1,7 @@
 import re
+import bisect
+import functools
+import weakref
 from xml.etree import ElementTree
 from xml.etree import ElementPath
 """
@@ -8,9 +11,162 @@ by starting the @attrib value with ^  (note: this isn't per xpath spec)
 eg. xml.findall('ware[@id="^ship_.+_scout_"]')   
     (find all wares where id is of a scout ship, would match ship_par_s_scout_01_b, etc)
 
+Documents searched many times (eg. wares.xml) can have an attribute index (see index_attribs),
+so tag[@attrib='value'] and tag[@attrib='^regex'] steps look up the matching elements instead of testing every child.
 """
 
 
+class AttribIndex(object):
+    """
+    Index of the elements of a document by attribute value (attribute -> value -> elements in document order),
+    built on first lookup of each attribute.
+    It isn't updated when the document changes, invalidate_attribs has to be called after changing it
+    (lib.patch_xml does that for the documents it patches).
+    The root element isn't referenced (only its id), so the index is dropped with the document (see ATTRIB_INDEXES).
+    """
+
+    def __init__(self):
+        self.parents = None  # el -> id of parent el
+        self.positions = None  # el -> position in document
+        self.values = {}  # attrib -> {value: [els]}
+        self.sorted_values = {}  # attrib -> sorted values
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.parents = self.positions = None
+            self.values, self.sorted_values = {}, {}
+        else:
+            self.values.pop(key, None)
+            self.sorted_values.pop(key, None)
+
+    def lookup(self, root, key):
+        values = self.values.get(key)
+        if values is None:
+            if self.parents is None:
+                self.parents = {child: id(parent) for parent in root.iter() for child in parent}
+                self.positions = {el: n for n, el in enumerate(root.iter()) if el is not root}
+            values = self.values[key] = {}
+            for el in root.iter():
+                value = el.get(key)
+                if value is not None and el is not root:
+                    values.setdefault(value, []).append(el)
+        return values
+
+    def lookup_regex(self, root, key, regex):
+        """
+        :return: elements with key attribute matching (compiled) regex, only values starting with its literal prefix
+                 (see regex_prefix) are matched
+        """
+        values = self.lookup(root, key)
+        sorted_values = self.sorted_values.get(key)
+        if sorted_values is None:
+            sorted_values = self.sorted_values[key] = sorted(values)
+        prefix = regex_prefix(regex.pattern)
+        els = []
+        for value in sorted_values[bisect.bisect_left(sorted_values, prefix):]:
+            if not value.startswith(prefix):
+                break
+            if regex.match(value):
+                els.extend(values[value])
+        return sorted(els, key=self.positions.__getitem__)
+
+    def select_children(self, parents, tag, els):
+        """
+        :return: els (in document order) that are tag children of parents, in the order the child step yields them
+        """
+        children = {}
+        for el in els:
+            if el.tag == tag:
+                children.setdefault(self.parents[el], []).append(el)
+        for parent in parents:
+            yield from children.get(id(parent), ())
+
+
+ATTRIB_INDEXES = weakref.WeakKeyDictionary()
+
+
+def index_attribs(xml):
+    """
+    Enable attribute index (see AttribIndex) for find(all) calls on xml (ElementTree or Element)
+    """
+    root = xml.getroot() if isinstance(xml, ElementTree.ElementTree) else xml
+    if root not in ATTRIB_INDEXES:
+        ATTRIB_INDEXES[root] = AttribIndex()
+    return ATTRIB_INDEXES[root]
+
+
+def invalidate_attribs(xml, key=None):
+    """
+    Invalidate attribute index of xml after it was changed, key: only the index of this attribute (if only it changed)
+    """
+    root = xml.getroot() if isinstance(xml, ElementTree.ElementTree) else xml
+    index = ATTRIB_INDEXES.get(root)
+    if index is not None:
+        index.invalidate(key)
+
+
+@functools.lru_cache(maxsize=4096)
+def tag_set(value):
+    """
+    Space separated values of an attribute (eg. tags="small shield standard") as a set, cached by value
+    (a document has few distinct tags values, but they are tested over and over)
+    """
+    return frozenset(value.strip().split(' '))
+
+
+@functools.lru_cache(maxsize=1024)
+def regex_prefix(pattern):
+    """
+    :return: literal prefix of all values matching pattern (^regex), eg. ^ship_.+_scout_ -> ship_
+    """
+    if '|' in pattern:
+        return ''
+    prefix = []
+    for char in pattern[1:]:
+        if char in '.^$*+?{}[]\\|()':
+            if char in '*?{' and prefix:
+                prefix.pop()
+            break
+        prefix.append(char)
+    return ''.join(prefix)
+
+
+class ChildSelection(object):
+    """
+    Result of a child step (tag), iterates the same as the original select generator,
+    but lets the next predicate look up its elements in the attribute index by parents and tag
+    """
+    __slots__ = ('select', 'context', 'parents', 'tag', 'iterator')
+
+    def __init__(self, select, context, parents, tag):
+        self.select = select
+        self.context = context
+        self.parents = parents
+        self.tag = tag
+        self.iterator = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.iterator is None:
+            self.iterator = self.select(self.context, self.parents)
+        return next(self.iterator)
+
+
+def prepare_child(next, token):
+    select = ElementPath.prepare_child(next, token)
+    tag = token[1]
+    if tag == '*' or '{' in tag:
+        return select
+
+    def select_child(context, result):
+        if context.root in ATTRIB_INDEXES:
+            return ChildSelection(select, context, result, tag)
+        return select(context, result)
+    return select_child
+
+
 def prepare_predicate(next, token):
     # this is the original function from xml.etree.ElementPath 
     # FIXME: replace with real parser!!! refs:
@@ -48,16 +204,27 @@ def prepare_predicate(next, token):
         value = predicate[-1]
 
         # allow some custom searching by regex and by space separated list of values
+        # (compiled once here, selectors are cached by ElementPath)
+        # elements without the attribute don't match
+        regex = None
         if value.startswith('^'):
             # [@attribute='^regexpattern.*$']
-            cmp_fn = lambda el_val: re.match(value, el_val)
+            regex = re.compile(value)
+            regex_match = regex.match
+            cmp_fn = lambda el_val: el_val is not None and regex_match(el_val) is not None
         elif value.startswith('['):
             # tag[@attribute='[val1 val3]']  matches <tag attribute="val1 val2 val3">
-            val_set = {v.strip() for v in value.strip(' []').split(' ')}
-            cmp_fn = lambda el_val: not val_set - set(el_val.strip().split(' '))
+            val_set = frozenset(v.strip() for v in value.strip(' []').split(' '))
+            cmp_fn = lambda el_val: el_val is not None and val_set <= tag_set(el_val)
         else:
             cmp_fn = lambda el_val: value == el_val
         def select(context, result):
+            index = ATTRIB_INDEXES.get(context.root) if isinstance(result, ChildSelection) else None
+            if index is not None and not value.startswith('['):
+                root = context.root
+                els = index.lookup_regex(root, key, regex) if regex else index.lookup(root, key).get(value, ())
+                yield from index.select_children(result.parents, result.tag, els)
+                return
             for elem in result:
                 el_val = elem.get(key)
                 if cmp_fn(el_val):
@@ -126,6 +293,7 @@ def prepare_predicate(next, token):
     
 # This overrides the original prepare_predicate in the ElementPathh.ops dict (which is mutable)
 ElementTree.ElementPath.ops["["] = prepare_predicate
+ElementTree.ElementPath.ops[""] = prepare_child
 
 # clearing cache just in case some searches already happened before the patch
 ElementTree.ElementPath._cache.clear()
@@ -2,6 +2,7 @@ import logging
 import sys
 import os
 import os.path
+import re
 from copy import deepcopy
 from xml.etree import ElementTree
 import csv
@@ -24,6 +25,52 @@ def get_config():
     return config
 
 
+def glob_to_regex(pattern):
+    """
+    Translate a glob pattern (as used by glob.glob(..., recursive=True)) into a compiled regex
+    - `*` and `?` don't match `/`, `**/` matches zero or more directories, `[...]`/`[!...]` are char classes
+    :param pattern: (str) glob pattern
+    :return: (re.Pattern) regex matching the full path
+    """
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            out.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            out.append('[^/]')
+            i += 1
+        elif pattern[i] == '[':
+            j = i + 1
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                out.append(re.escape('['))
+                i += 1
+            else:
+                chars = pattern[i + 1:j]
+                negate = chars.startswith('!')
+                # escape what is special in a regex char class (or a possible nested set/set operation)
+                # except '-' of ranges
+                chars = re.sub(r'([\\\[\]^&~|])', r'\\\1', chars[1:] if negate else chars)
+                out.append('[{}{}]'.format('^' if negate else '', chars))
+                i = j + 1
+        else:
+            out.append(re.escape(pattern[i]))
+            i += 1
+    return re.compile(''.join(out) + r'\Z')
+
+
 class ModUtilMixin(object):
 
     @classmethod
@@ -2,29 +2,87 @@
 
 """
 Pack mods/{mod name}/* mod files into {game dir}/extensions/{mod name}/* (cat+dat)
-Use: python3 pack_mod.py {mod name}
+Use: python3 pack_mod.py {mod name} <--incremental> <--split-dirs> <--dedup>
+Report mod files identical to game files: python3 pack_mod.py {mod name} --report-duplicates
 """
 
 import sys
+import glob
+import os.path
 import logging
 from lib.x4lib import get_config, require_python_version
-from pack_x4 import pack_path
+from extract_x4 import CatIndexCache
+from pack_x4 import pack_path, collect_files, find_duplicates, find_content_duplicates
 
 require_python_version(3, 5)
 logger = logging.getLogger('x4.' + __name__)
 
 
-def pack_mod(mod_name, config):
+def load_game_index(config):
+    """
+    :param config: config
+    :return: (CatIndexCache) index of game cat files
+    """
+    return CatIndexCache.load('{}/cache/cats.idx'.format(config.PWD), glob.iglob('{}/*.cat'.format(config.X4)))
+
+
+def load_extensions_index(config):
+    """
+    :param config: config
+    :return: (CatIndexCache) index of the cat files of the game extensions (ego_dlc_*)
+    """
+    return CatIndexCache.load('{}/cache/cats_extensions.idx'.format(config.PWD),
+                              glob.iglob('{}/extensions/ego_dlc_*/*.cat'.format(config.X4)))
+
+
+def pack_mod(mod_name, config, incremental=False, volume_size=None, split_dirs=False, timestamp=None, dedup=False):
     pack_path(src='{}/{}/'.format(config.MODS, mod_name),
-              dst='{}/extensions/{}/'.format(config.X4, mod_name))
+              dst='{}/extensions/{}/'.format(config.X4, mod_name),
+              incremental=incremental,
+              volume_size=volume_size,
+              split_dirs=split_dirs,
+              timestamp=timestamp,
+              game_index=load_game_index(config) if dedup else None,
+              state_path='{}/cache/pack_{}.json'.format(config.PWD, mod_name))
+
+
+def report_duplicates(mod_name, config):
+    """
+    Report mod files identical to the game files they replace (these can be dropped from the mod, see pack --dedup),
+    and mod files with the content of a game file at another path, in the base game or an extension
+    (eg. unchanged compiled macros)
+    :param mod_name: (str) mod name
+    :param config: config
+    :return: (list) of (rel_filename, src_filename, cat_filename) of duplicate files,
+             (list) of (rel_filename, src_filename, cat_filename, game_filename) of other files with game content
+    """
+    files = collect_files('{}/{}/'.format(config.MODS, mod_name))
+    game_index = load_game_index(config)
+    duplicates = find_duplicates(files, game_index)
+    for rel_filename, src_filename, cat_filename in duplicates:
+        logger.info('%s is identical to %s in %s', src_filename, rel_filename, cat_filename)
+    size = sum(os.path.getsize(src_filename) for rel_filename, src_filename, cat_filename in duplicates)
+    logger.warning('%s: %d of %d files (%.1f MB) are identical to game files',
+                   mod_name, len(duplicates), len(files), size / 1024 / 1024)
+
+    duplicate_filenames = {rel_filename for rel_filename, src_filename, cat_filename in duplicates}
+    matches = [match for match in find_content_duplicates(files, [game_index, load_extensions_index(config)])
+               if match[0] not in duplicate_filenames]
+    for rel_filename, src_filename, cat_filename, game_filename in matches:
+        logger.info('%s has the same content as %s in %s', src_filename, game_filename, cat_filename)
+    logger.warning('%s: %d more files have the same content as game files at other paths', mod_name, len(matches))
+    return duplicates, matches
 
 
 if __name__ == '__main__':
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.INFO)
 
-    args = sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
     if len(args) < 1:
-        logger.info("%s <mod_name>", sys.argv[0])
+        logger.info("%s <mod_name> <--incremental> <--split-dirs> <--dedup> <--report-duplicates>", sys.argv[0])
+    elif '--report-duplicates' in sys.argv:
+        report_duplicates(mod_name=args[0], config=get_config())
     else:
-        pack_mod(mod_name=args[0], config=get_config())
+        pack_mod(mod_name=args[0], config=get_config(), incremental='--incremental' in sys.argv,
+                 split_dirs='--split-dirs' in sys.argv, dedup='--dedup' in sys.argv)
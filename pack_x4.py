@@ -2,50 +2,415 @@
 
 """
 Pack {src} mod files into {dst} (cat+dat)
-Use: python3 pack_x4.py {src} {dst}
+Use: python3 pack_x4.py {src} {dst} <--incremental> <--volume-size=MB> <--split-dirs>
+Cat timestamps are set to SOURCE_DATE_EPOCH (if set in env) instead of file mtimes for reproducible packs
 """
 
 import os
+import re
 import sys
+import json
 import os.path
 import hashlib
 import shutil
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from extract_x4 import CatParser, CatEntry
 
 logger = logging.getLogger('x4.' + __name__)
+HASH_CHUNK_SIZE = 1024 * 1024
+VOLUME_RE = re.compile(r'^ext_(\d+)\.cat$')
 
 
-def pack_path(src, dst):
-    os.makedirs(dst, exist_ok=True)
-    with open('{}ext_01.cat'.format(dst), 'wb') as cat_file,\
-         open('{}ext_01.dat'.format(dst), 'wb') as dat_file:
-        src_offset = len(src)
-        for src_path, dirs, files in os.walk(src):
-            path = src_path[src_offset:]
-            for filename in files:
-                src_filename = os.path.join(src_path, filename)
-                if not path:
+def collect_files(src, dst=None):
+    """
+    Walk src dir, copy files in the src root dir (eg. content.xml) into dst, and collect the files to pack
+    :param src: (str) src path (with trailing /)
+    :param dst: (str) dst path (with trailing /), None: don't copy root files
+    :return: (list) of (rel_filename, src_filename) sorted by rel_filename
+    """
+    files = []
+    src_offset = len(src)
+    for src_path, dirs, filenames in os.walk(src):
+        path = src_path[src_offset:]
+        for filename in filenames:
+            src_filename = os.path.join(src_path, filename)
+            if not path:
+                if dst is not None:
                     dst_filename = os.path.join(dst.rstrip('/'), filename)
                     shutil.copy(src_filename, dst_filename)
-                else:
-                    file_data = open(src_filename, 'rb').read()
-                    digest = hashlib.md5(file_data).hexdigest()
-                    rel_filename = os.path.join(path, filename)
-                    stat = os.stat(src_filename)
-                    cat_file.write('{} {} {} {}\n'.format(rel_filename, len(file_data),
-                                                          int(stat.st_mtime), digest).encode('utf-8'))
-                    dat_file.write(file_data)
+            else:
+                files.append((os.path.join(path, filename), src_filename))
+    return sorted(files)
+
+
+def read_cat(cat_filename):
+    """
+    Read entries of a previously packed cat file
+    :param cat_filename: (str) file/path of cat file
+    :return: (list) of CatEntry (empty if the cat file doesn't exist)
+    """
+    if not os.path.exists(cat_filename):
+        return []
+    return list(CatParser.cat_entries_iterator(cat_filename))
+
+
+def file_md5(filename, size):
+    """
+    Compute md5 of a file, reading it in fixed size chunks into one buffer (constant memory)
+    :param filename: (str) file/path
+    :param size: (int) number of bytes to hash (file size when it was stat'ed)
+    :return: (str) md5 hex digest of file content
+    """
+    md5 = hashlib.md5()
+    buffer = memoryview(bytearray(min(HASH_CHUNK_SIZE, size) or 1))
+    with open(filename, 'rb', buffering=0) as src_file:
+        while size:
+            count = src_file.readinto(buffer[:min(len(buffer), size)])
+            if not count:
+                break
+            md5.update(buffer[:count])
+            size -= count
+    return md5.hexdigest()
+
+
+def get_entries(files, previous=(), mtimes=None):
+    """
+    Get cat entries for files, reusing md5 of previous entries when a file's size and mtime didn't change
+    :param files: (list) of (rel_filename, src_filename)
+    :param previous: (list) of CatEntry of the previous pack
+    :param mtimes: (dict) of rel_filename: [mtime, md5hex] of the files of the previous pack, when its cat has
+                   a fixed timestamp instead of file mtimes (see load_state), None: mtimes are the cat timestamps
+    :return: (list) of CatEntry with file mtimes (md5hex is None for files that need to be hashed)
+    """
+    previous = {entry.filename: entry for entry in previous}
+    entries = []
+    offset = 0
+    for rel_filename, src_filename in files:
+        stat = os.stat(src_filename)
+        size, mtime = stat.st_size, int(stat.st_mtime)
+        entry = previous.get(rel_filename)
+        if entry is not None and mtimes is not None:
+            previous_mtime, md5hex = mtimes.get(rel_filename, (None, None))
+            if md5hex != entry.md5hex:
+                previous_mtime = None
+        else:
+            previous_mtime = entry and entry.timestamp
+        if entry is not None and entry.size == size and previous_mtime == mtime:
+            md5hex = entry.md5hex
+        else:
+            md5hex = None
+        entries.append(CatEntry(rel_filename, offset, size, mtime, md5hex))
+        offset += size
+    return entries
+
+
+def write_pack(cat_filename, dat_filename, files, entries, jobs):
+    """
+    Write cat/dat files
+    File data is copied into the dat file in constant memory (see CatParser.copy_range), while the md5 of the
+    files that need hashing is computed ahead on a thread pool, so reading, hashing and dat writes overlap.
+    :param cat_filename: (str) file/path of cat file
+    :param dat_filename: (str) file/path of dat file
+    :param files: (list) of (rel_filename, src_filename)
+    :param entries: (list) of CatEntry for files (md5hex None if not known)
+    :param jobs: (int) number of hashing threads
+    :return: (list) of CatEntry written
+    """
+    written = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor,\
+         open(cat_filename, 'wb') as cat_file,\
+         open(dat_filename, 'wb', buffering=0) as dat_file:
+        digests = [entry.md5hex or executor.submit(file_md5, src_filename, entry.size)
+                   for (rel_filename, src_filename), entry in zip(files, entries)]
+        for (rel_filename, src_filename), entry, digest in zip(files, entries, digests):
+            with open(src_filename, 'rb') as src_file:
+                copied = CatParser.copy_range(src_file.fileno(), dat_file.fileno(), 0, entry.size)
+            if copied != entry.size:
+                raise IOError('{} changed while packing'.format(src_filename))
+            entry = entry._replace(md5hex=digest if isinstance(digest, str) else digest.result())
+            cat_file.write(cat_line(entry))
+            written.append(entry)
+    return written
+
+
+def cat_line(entry):
+    """
+    :param entry: (CatEntry) cat entry
+    :return: (bytes) cat file line of entry
+    """
+    return '{} {} {} {}\n'.format(entry.filename, entry.size, entry.timestamp, entry.md5hex).encode('utf-8')
+
+
+def find_duplicates(files, game_index, jobs=4):
+    """
+    Find files identical to the game file with the same path (same size and md5 as in the game cat),
+    packing these only duplicates what the game already ships.
+    Only files with the same size as the game file are hashed.
+    :param files: (list) of (rel_filename, src_filename)
+    :param game_index: (CatIndex or CatIndexCache) index of game cat files
+    :param jobs: (int) number of hashing threads
+    :return: (list) of (rel_filename, src_filename, cat_filename) of duplicate files
+    """
+    candidates = []
+    for rel_filename, src_filename in files:
+        found = game_index.lookup(rel_filename)
+        if found is not None and found[1].size == os.path.getsize(src_filename):
+            candidates.append((rel_filename, src_filename) + found)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        digests = executor.map(lambda candidate: file_md5(candidate[1], candidate[3].size), candidates)
+        return [(rel_filename, src_filename, cat_filename)
+                for (rel_filename, src_filename, cat_filename, entry), md5hex in zip(candidates, digests)
+                if md5hex == entry.md5hex]
+
+
+def find_content_duplicates(files, game_indexes, jobs=4):
+    """
+    Find files with the same content (size and md5) as any game file, at any path (eg. compiled macros a yaml
+    pattern matched but didn't change), these can't be dropped from the mod (see find_duplicates), only reported.
+    Only files with the size of a game file are hashed.
+    :param files: (list) of (rel_filename, src_filename)
+    :param game_indexes: (list) of CatIndex or CatIndexCache (eg. of the base game and of the ego_dlc_* extensions)
+    :param jobs: (int) number of hashing threads
+    :return: (list) of (rel_filename, src_filename, cat_filename, game_filename) of files with the content
+             of game_filename in cat_filename
+    """
+    game_files = {}
+    for game_index in game_indexes:
+        for cat_filename, entry in game_index:
+            game_files[entry.size, entry.md5hex] = cat_filename, entry.filename
+    sizes = {size for size, md5hex in game_files}
+
+    candidates = [(rel_filename, src_filename, os.path.getsize(src_filename)) for rel_filename, src_filename in files]
+    candidates = [candidate for candidate in candidates if candidate[2] in sizes]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        digests = executor.map(lambda candidate: file_md5(candidate[1], candidate[2]), candidates)
+        return [(rel_filename, src_filename) + game_files[size, md5hex]
+                for (rel_filename, src_filename, size), md5hex in zip(candidates, digests)
+                if (size, md5hex) in game_files]
+
+
+def split_volumes(files, volume_size=None, split_dirs=False, previous=()):
+    """
+    Split files into volumes (ext_01, ext_02, ...)
+    :param files: (list) of (rel_filename, src_filename)
+    :param volume_size: (int) max size of a volume in bytes (a bigger file gets a volume of its own), None: no limit
+    :param split_dirs: (bool) put each top level dir (eg. index/, libraries/, assets/) into its own volume(s)
+    :param previous: (list) of volumes of the previous pack, (list) of rel_filename
+                     with volume_size or split_dirs files stay in their previous volume while it has room, other files
+                     are added to the last volume of their dir (or an emptied or new one), so a new dir or a new or
+                     grown file doesn't renumber all following volumes (emptied volumes are kept as empty cat/dat
+                     unless they are the last ones)
+    :return: (list) of volumes, (list) of (rel_filename, src_filename)
+    """
+    # without volume_size and split_dirs all files go into one volume anyway
+    volume_count = len(previous) if volume_size or split_dirs else 0
+    previous_volumes = {rel_filename: n for n, volume in enumerate(previous[:volume_count]) for rel_filename in volume}
+    volumes, sizes, keys = [[] for n in range(volume_count)], [0] * volume_count, [None] * volume_count
+
+    remaining = []
+    for position, (rel_filename, src_filename) in enumerate(files):
+        key = rel_filename.split('/', 1)[0] if split_dirs else ''
+        file_size = os.path.getsize(src_filename) if volume_size else 0
+        n = previous_volumes.get(rel_filename)
+        if n is not None and keys[n] in (None, key) and \
+                (not volumes[n] or not volume_size or sizes[n] + file_size <= volume_size):
+            volumes[n].append((position, rel_filename, src_filename))
+            sizes[n] += file_size
+            keys[n] = key
+        else:
+            remaining.append((key, file_size, position, rel_filename, src_filename))
+
+    last_volumes = {key: n for n, key in enumerate(keys) if key is not None}
+    empty_volumes = [n for n, key in enumerate(keys) if key is None]
+    for key, file_size, position, rel_filename, src_filename in sorted(remaining, key=lambda file: file[0]):
+        n = last_volumes.get(key)
+        if n is None or volume_size and sizes[n] + file_size > volume_size:
+            if empty_volumes:
+                n = empty_volumes.pop(0)
+            else:
+                n = len(volumes)
+                volumes.append([])
+                sizes.append(0)
+                keys.append(None)
+            last_volumes[key], keys[n] = n, key
+        volumes[n].append((position, rel_filename, src_filename))
+        sizes[n] += file_size
+    while volumes and not volumes[-1]:
+        volumes.pop()
+    return [[(rel_filename, src_filename) for position, rel_filename, src_filename in sorted(volume)]
+            for volume in volumes]
+
+
+def read_volumes(dst):
+    """
+    Read file names of the cat volumes of a previous pack
+    :param dst: (str) dst path (with trailing /)
+    :return: (list) of volumes, (list) of rel_filename
+    """
+    volumes = []
+    while os.path.exists('{}ext_{:02d}.cat'.format(dst, len(volumes) + 1)):
+        volumes.append([entry.filename for entry in read_cat('{}ext_{:02d}.cat'.format(dst, len(volumes) + 1))])
+    return volumes
+
+
+def pack_volume(cat_filename, dat_filename, files, incremental, jobs, timestamp=None, mtimes=None):
+    """
+    Pack files into cat/dat volume
+    :param cat_filename: (str) file/path of cat file
+    :param dat_filename: (str) file/path of dat file
+    :param files: (list) of (rel_filename, src_filename)
+    :param incremental: (bool) reuse md5 hashes of the previous pack for unchanged files,
+                        and don't rewrite cat/dat if nothing changed
+    :param jobs: (int) number of hashing threads
+    :param timestamp: (int) timestamp to use for all cat entries instead of file mtime
+    :param mtimes: (dict) of rel_filename: [mtime, md5hex] of the previous pack, needed to reuse md5 hashes with
+                   timestamp (see get_entries), updated with the files of the volume
+    :return: (bool) True if cat/dat were written, False if they were up to date, (list) of CatEntry of volume
+    """
+    previous = read_cat(cat_filename) if incremental else []
+    entries = get_entries(files, previous, {} if timestamp is not None and mtimes is None else mtimes)
+    file_mtimes = [entry.timestamp for entry in entries]
+    if timestamp is not None:
+        entries = [entry._replace(timestamp=timestamp) for entry in entries]
+
+    if incremental:
+        logger.info('%s: %d files, %d to hash', cat_filename, len(entries),
+                    sum(1 for entry in entries if entry.md5hex is None))
+    up_to_date = incremental and entries == previous and os.path.exists(dat_filename) and \
+        os.path.getsize(dat_filename) == sum(entry.size for entry in entries)
+    if up_to_date:
+        logger.info('%s is up to date', cat_filename)
+    else:
+        entries = write_pack(cat_filename, dat_filename, files, entries, jobs)
+    if mtimes is not None:
+        mtimes.update((entry.filename, [mtime, entry.md5hex]) for entry, mtime in zip(entries, file_mtimes))
+    return not up_to_date, entries
+
+
+def load_state(state_filename):
+    """
+    Load mtimes of the files of the previous pack (cat entries only have the fixed timestamp of reproducible packs)
+    :param state_filename: (str) file/path of pack state (outside of dst, so it isn't published with the mod)
+    :return: (dict) of rel_filename: [mtime, md5hex]
+    """
+    try:
+        with open(state_filename) as state_file:
+            return json.load(state_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(state_filename, mtimes):
+    os.makedirs(os.path.dirname(state_filename) or '.', exist_ok=True)
+    with open(state_filename + '.tmp', 'w') as state_file:
+        json.dump(mtimes, state_file, sort_keys=True)
+    os.replace(state_filename + '.tmp', state_filename)
+
+
+def remove_volumes(dst, count):
+    """
+    Remove cat/dat volumes left over from a previous pack that had more volumes
+    :param dst: (str) dst path (with trailing /)
+    :param count: (int) number of volumes of current pack
+    :return: None
+    """
+    for filename in os.listdir(dst):
+        match = VOLUME_RE.match(filename)
+        if match and int(match.group(1)) > count:
+            logger.info('removing stale volume %s%s', dst, filename)
+            os.remove(dst + filename)
+            dat_filename = '{}{}.dat'.format(dst, filename[:-4])
+            if os.path.exists(dat_filename):
+                os.remove(dat_filename)
+
+
+def pack_hash(volumes, root_files):
+    """
+    Content hash of a pack: cat lines of all volumes (file names, sizes, timestamps and md5s) and root files
+    :param volumes: (list) of (cat_filename, list of CatEntry)
+    :param root_files: (list) of (filename, file/path) copied to dst root (eg. content.xml)
+    :return: (str) sha256 hex digest
+    """
+    digest = hashlib.sha256()
+    for cat_filename, entries in volumes:
+        digest.update('{}\n'.format(os.path.basename(cat_filename)).encode('utf-8'))
+        for entry in entries:
+            digest.update(cat_line(entry))
+    for filename, path in root_files:
+        with open(path, 'rb') as root_file:
+            data = root_file.read()
+        digest.update('{} {}\n'.format(filename, len(data)).encode('utf-8'))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def pack_path(src, dst, incremental=False, jobs=4, volume_size=None, split_dirs=False, timestamp=None,
+              game_index=None, state_path=None):
+    """
+    Pack files in src sub dirs into dst ext_01.cat/ext_01.dat (ext_02, ... volumes when splitting),
+    files in src root dir are copied to dst.
+    Files are packed in sorted path order, with timestamp (or SOURCE_DATE_EPOCH from env) instead of file mtimes
+    the output only depends on the content, and the pack hash (see pack_hash) is logged.
+    :param src: (str) src path (with trailing /)
+    :param dst: (str) dst path (with trailing /)
+    :param incremental: (bool) reuse md5 hashes of the previous pack for unchanged files,
+                        and don't rewrite cat/dat volumes if nothing changed in them
+                        (files are kept in their previous volumes, see split_volumes)
+    :param jobs: (int) number of hashing threads
+    :param volume_size: (int) max size of a volume in bytes, None: no limit
+    :param split_dirs: (bool) put each top level dir into its own volume(s)
+    :param timestamp: (int) timestamp to use for all cat entries instead of file mtime
+    :param game_index: (CatIndex or CatIndexCache) index of game cat files, files identical to game files
+                       are not packed (see find_duplicates), None: pack all files
+    :param state_path: (str) file/path to keep file mtimes in for incremental packs with timestamp
+                       (see load_state), None: all files are hashed again
+    :return: (int) number of cat/dat volumes written (0 if all were up to date)
+    """
+    if timestamp is None and 'SOURCE_DATE_EPOCH' in os.environ:
+        timestamp = int(os.environ['SOURCE_DATE_EPOCH'])
+    os.makedirs(dst, exist_ok=True)
+    files = collect_files(src, dst)
+    if game_index is not None:
+        duplicates = {rel_filename for rel_filename, src_filename, cat_filename
+                      in find_duplicates(files, game_index, jobs)}
+        logger.info('%s: %d files identical to game files not packed', src, len(duplicates))
+        files = [(rel_filename, src_filename) for rel_filename, src_filename in files
+                 if rel_filename not in duplicates]
+    volumes = split_volumes(files, volume_size, split_dirs, read_volumes(dst) if incremental else ())
+    # cat entries of reproducible packs have timestamp instead of file mtimes, keep those for the next pack
+    mtimes = load_state(state_path) if incremental and timestamp is not None and state_path else None
+
+    written = 0
+    packed = []
+    for n, volume_files in enumerate(volumes, 1):
+        cat_filename = '{}ext_{:02d}.cat'.format(dst, n)
+        dat_filename = '{}ext_{:02d}.dat'.format(dst, n)
+        volume_written, entries = pack_volume(cat_filename, dat_filename, volume_files, incremental, jobs, timestamp,
+                                              mtimes)
+        written += volume_written
+        packed.append((cat_filename, entries))
+    remove_volumes(dst, len(volumes))
+    if mtimes is not None:
+        save_state(state_path, {rel_filename: mtimes[rel_filename] for rel_filename, src_filename in files})
+
+    root_files = sorted((filename, src + filename) for filename in os.listdir(src) if os.path.isfile(src + filename))
+    logger.warning('%s pack hash: %s', dst, pack_hash(packed, root_files))
+    return written
 
 
 if __name__ == '__main__':
     logger.addHandler(logging.StreamHandler())
     logger.setLevel(logging.INFO)
 
-    args = sys.argv[1:]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
     if len(args) < 2:
-        logger.info("%s <src> <dst>", sys.argv[0])
+        logger.info("%s <src> <dst> <--incremental> <--volume-size=MB> <--split-dirs>", sys.argv[0])
     else:
+        volume_size = [int(arg.split('=', 1)[1]) * 1024 * 1024 for arg in sys.argv if arg.startswith('--volume-size=')]
         pack_path(src=args[0].rstrip('/') + '/',
-             dst=args[1].rstrip('/') + '/')
-
-
+                  dst=args[1].rstrip('/') + '/',
+                  incremental='--incremental' in sys.argv,
+                  volume_size=volume_size[-1] if volume_size else None,
+                  split_dirs='--split-dirs' in sys.argv)
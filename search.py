@@ -2,9 +2,9 @@
 
 pre-load data:
     parse src/base/t/0001-l044.xml   (* need to add this)
-    parse src/base/libraries/wares.xml   (* need to add this)
-    merge src/ego_dlc_split/libraries/wares.xml   (* need to add this)
-    merge src/ego_dlc_terran/libraries/wares.xml   (* need to add this)
+    parse src/base/libraries/wares.xml
+    merge src/ego_dlc_split/libraries/wares.xml
+    merge src/ego_dlc_terran/libraries/wares.xml
 
 parse mod:
     clone ship or equipment
@@ -24,19 +24,20 @@ import sys
 import glob
 import re
 from lib.x4lib import get_config
-from lib.patched_element_tree import ElementTree
-from lib.patch_xml import patch
+from lib.patched_element_tree import ElementTree, index_attribs
+from lib.game_data import resolve
 
 logger = logging.getLogger('x4.' + __name__)
 cache = {}
 
 
-def search_macros(src_path, macro_id):
-    for filename in sorted(glob.glob(f'{src_path}/*/index/macros.xml')):
-        xml = cache.setdefault(filename, ElementTree.parse(filename))
-        entry = xml.find(f'./entry[@name="{macro_id}"]')
-        if entry is not None:
-            return entry.get('value')
+def search_macros(src_path, macro_id, cache_path=None):
+    if 'macros' not in cache:
+        cache['macros'] = resolve(src_path, 'index/macros.xml', cache_path)
+        index_attribs(cache['macros'])
+    entry = cache['macros'].find(f'./entry[@name="{macro_id}"]')
+    if entry is not None:
+        return entry.get('value')
 
 
 
@@ -63,20 +64,20 @@ def resolve_t(src_path, t_id_str):
     return text and text.replace('\\', '')
 
 
-def preload_wares(src_path):
+def preload_wares(src_path, cache_path=None):
+    """
+    cache_path: dir of resolved game data (see lib.game_data.resolve), None: merge dlc wares on each start
+    """
     if 'wares' in cache:
         return cache['wares']
-    cache['wares'] = wares_xml = ElementTree.parse(f'{src_path}/base/libraries/wares.xml')
-    #for patch_filename in sorted(glob.glob(f'{src_path}/ego_dlc_*/libraries/wares.xml')):
-    #    patch_xml = ElementTree.parse(patch_filename)
-    #    patch(wares_xml, patch_xml)
-
+    cache['wares'] = wares_xml = resolve(src_path, 'libraries/wares.xml', cache_path)
+    index_attribs(wares_xml)
     return wares_xml
 
 
-def search_wares(src_path, ware_id_str):
+def search_wares(src_path, ware_id_str, cache_path=None):
     print(f'Searching: {ware_id_str}')
-    wares_xml = preload_wares(src_path)
+    wares_xml = preload_wares(src_path, cache_path)
     for ware in wares_xml.findall(f'./ware[@id="{ware_id_str}"]'):
         ware_id = ware.get('id')
         ware_name = resolve_t(src_path, ware.get('name'))
@@ -87,7 +88,7 @@ def search_wares(src_path, ware_id_str):
         ware_tags = ware.get('tags')
         comp_el = ware.find('./component')
         macro_id = comp_el.get('ref') if comp_el is not None else None
-        macro_path = search_macros(src_path, macro_id) if macro_id else None
+        macro_path = search_macros(src_path, macro_id, cache_path) if macro_id else None
         print(f'{ware_id:32} | {str(ware_name):30} | {ware_group} | {ware_transport} | {ware_volume} | {ware_tags} | {macro_path}')
 
 
@@ -104,7 +105,7 @@ if __name__ == '__main__':
 
     config=get_config()
     print(f'Searching: {args}')
-    search_wares(src_path=config.SRC, ware_id_str=args[0])
+    search_wares(src_path=config.SRC, ware_id_str=args[0], cache_path=f'{config.PWD}/cache/resolved')
     
 
 
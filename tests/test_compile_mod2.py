@@ -0,0 +1,267 @@
+"""
+Run tests
+Use: ./run_tests.sh
+"""
+
+import os
+import glob
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from compile_mod2 import SrcIndex, Task, apply_yaml, run_tasks, compile_mod, compile_modifiers, apply_plan, \
+    parse_modifier, modify_attrib_value, Selector, SelectorTrie, plan_batches, diff_filename
+from lib.patched_element_tree import ElementTree
+
+
+class SrcIndexUnitTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src_path = self.tmp_dir.name
+        for path in ['assets/units/size_s/macros', 'assets/units/size_m/macros', 'libraries', '.hidden']:
+            os.makedirs(f'{self.src_path}/{path}')
+            for filename in ['ship_arg_s_fighter_01_macro.xml', 'ship_par_m_frigate_01_macro.xml',
+                             'engine_arg_s_01_macro.xml', 'wares.xml', '.hidden_macro.xml']:
+                open(f'{self.src_path}/{path}/{filename}', 'w').close()
+        open(f'{self.src_path}/ship_root_macro.xml', 'w').close()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_glob(self):
+        index = SrcIndex(self.src_path)
+        for pat in ['ship_*_macro.xml', '*_macro.xml', 'wares.xml', 'libraries/wares.xml', 'size_s/macros/ship_*',
+                    'units/**/ship_arg_*', 'ship_[ap]??_[sm]_*', '*', 'missing.xml']:
+            files = sorted(filename for filename in glob.glob(f'{self.src_path}/**/{pat}', recursive=True)
+                           if os.path.isfile(filename))
+            self.assertEqual(index.glob(pat), files, pat)
+
+
+
+class ModifierPlanUnitTest(TestCase):
+
+    def test_parse_modifier(self):
+        self.assertEqual(parse_modifier('=abc'), ('=', 'abc'))
+        self.assertEqual(parse_modifier('*1.5'), ('*', 1.5))
+        self.assertEqual(parse_modifier('-2'), ('-', 2.0))
+        self.assertEqual(parse_modifier('[?mk1 +mk2 -missile]'), ('[', (('?', 'mk1'), ('+', 'mk2'), ('-', 'missile'))))
+        with self.assertRaises(Exception):
+            parse_modifier('%2')
+
+    def test_modify_attrib_value(self):
+        self.assertEqual(modify_attrib_value('=abc', '1'), 'abc')
+        self.assertEqual(modify_attrib_value('+1', '1'), '2.0')
+        self.assertEqual(modify_attrib_value('-1', '1'), '0.0')
+        self.assertEqual(modify_attrib_value('*1.5', '2'), '3.0')
+        self.assertEqual(modify_attrib_value('/2', '3'), '1.5')
+        self.assertEqual(modify_attrib_value('*2', None), None)
+        self.assertEqual(modify_attrib_value('[+mk2 -missile]', 'small weapon missile'), 'small weapon mk2')
+        self.assertEqual(modify_attrib_value('[?mk1 +mk2]', 'small weapon'), 'small weapon')
+
+    def test_compile_modifiers(self):
+        modifiers = [
+            {'connections/connection[@tags="[small shield]"]@tags': '[+mk2]'},
+            {'connections': [{'CLONE-2': [{'connection[@tags="[small shield]"]': [
+                {'.@name': '=con_xtra_{i:02}a', 'offset/position@x': '-1'},
+                {'.@name': '=con_xtra_{i:02}b', 'offset/position@x': '+1'},
+            ]}]}]},
+        ]
+        plan = compile_modifiers(modifiers)
+        self.assertEqual(plan, [
+            ('attrib', './connections/connection[@tags="[small shield]"]', 'tags', [('[', (('+', 'mk2'),))]),
+            ('nested', './connections', [
+                ('clone', 2, [('./connection[@tags="[small shield]"]', [
+                    [('attrib', './.', 'name', [(None, '=con_xtra_{i:02}a')]),
+                     ('attrib', './offset/position', 'x', [('-', 1.0)])],
+                    [('attrib', './.', 'name', [(None, '=con_xtra_{i:02}b')]),
+                     ('attrib', './offset/position', 'x', [('+', 1.0)])],
+                ])]),
+            ]),
+        ])
+
+        xml = ElementTree.fromstring('<component><connections><connection name="con" tags="small shield">'
+                                     '<offset><position x="1" /></offset></connection></connections></component>')
+        apply_plan(xml, plan)
+        self.assertEqual(
+            [(el.get('name'), el.get('tags'), el.find('offset/position').get('x')) for el in xml.iter('connection')],
+            [('con', 'small shield mk2', '1'), ('con_xtra_01a', 'small shield mk2', '0.0'),
+             ('con_xtra_02b', 'small shield mk2', '2.0')])
+
+
+    def test_selector(self):
+        selector = Selector('./component/connections/connection[@tags="[small shield]"][@name]')
+        self.assertTrue(selector.supported)
+        self.assertEqual(selector.steps, [('component', ()), ('connections', ()),
+                                          ('connection', ('[@tags="[small shield]"]', '[@name]'))])
+        self.assertEqual(selector.attribs, {'tags', 'name'})
+        self.assertEqual(Selector('./.').steps, [])
+        for path in ['./connections//connection', './connection/..', './connection[2]', './connection[last()]']:
+            self.assertFalse(Selector(path).supported, path)
+
+    def test_selector_trie(self):
+        xml = ElementTree.fromstring('<component><connections><connection name="a" tags="small shield" />'
+                                     '<connection name="b" tags="small weapon" /><connection name="c" />'
+                                     '</connections></component>')
+        paths = ['./connections/connection', './connections/connection[@tags="[shield]"]', './connections/*',
+                 './connections/connection[2]', './connections/missing', './.', './/connection[@name="c"]', './',
+                 './connections/', '']
+        trie = SelectorTrie([Selector(path) for path in paths])
+        self.assertEqual(trie.match(xml), [xml.findall(path) for path in paths])
+        self.assertEqual(trie.match(ElementTree.ElementTree(xml)), [xml.findall(path) for path in paths])
+
+    def test_plan_batches(self):
+        plan = compile_modifiers([
+            {'connections/connection[@tags="[shield]"]@tags': '[+mk2]'},
+            {'connections/connection[@name="a"]@name': '=b'},
+            {'connections/connection[@tags="[mk2]"]@name': '=c'},
+            {'connections': [{'CLONE-1': [{'connection': [{'.@name': '=d'}]}]}]},
+            {'connections/connection@name': '=e'},
+            {'connections/connection[1]@name': '=f'},
+        ])
+        self.assertEqual([[plan.index(step) for step in steps] for steps, trie in plan_batches(plan)],
+                         [[0, 1], [2, 3], [4], [5]])
+        self.assertIs(plan_batches(plan), plan_batches(plan))
+
+    def test_apply_plan_single_pass(self):
+        src = ('<component><connections>'
+               '<connection name="a" tags="small shield"><offset><position x="1" /></offset></connection>'
+               '<connection name="b" tags="small weapon"><offset><position x="2" /></offset></connection>'
+               '</connections></component>')
+        plan = compile_modifiers([
+            {'connections/connection[@tags="[shield]"]@tags': '[+weapon]'},
+            {'connections/connection[@tags="[weapon]"]/offset/position@x': '*10'},
+            {'connections/connection[@name="b"]@name': '=c'},
+            {'connections': [{'CLONE-1': [{'connection[@name="c"]': [{'.@name': '=d'}]}]}]},
+            {'connections/connection[@name="d"]/offset/position@x': '+1'},
+        ])
+        results = []
+        for single_pass in [False, True]:
+            xml = ElementTree.fromstring(src)
+            apply_plan(xml, plan, single_pass=single_pass)
+            results.append(ElementTree.tostring(xml))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(
+            [(el.get('name'), el.find('offset/position').get('x')) for el in xml.iter('connection')],
+            [('a', '10.0'), ('c', '20.0'), ('d', '21.0')])
+
+
+class ApplyYamlUnitTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src_path = f'{self.tmp_dir.name}/src'
+        self.mod_path = f'{self.tmp_dir.name}/mods/test_mod'
+        os.makedirs(f'{self.src_path}/assets/macros')
+        for name, hull in [('ship_a_macro', 100), ('ship_b_macro', 200)]:
+            with open(f'{self.src_path}/assets/macros/{name}.xml', 'w') as xml_file:
+                xml_file.write(f'<macros><macro name="{name}"><properties><hull max="{hull}" /></properties>'
+                               f'</macro></macros>')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def read_out(self, filename):
+        with open(f'{self.mod_path}/macros/{filename}') as xml_file:
+            return xml_file.read()
+
+    def test_apply_yaml_tasks(self):
+        entries, tasks = set(), {}
+        yaml_data = [
+            {'ship_*_macro.xml': {'macro/properties/hull@max': '*2'}},
+            {'ship_b_macro.xml': {'macro/properties/hull@max': '+1'}},
+        ]
+        apply_yaml(entries, yaml_data, self.src_path, self.mod_path, tasks=tasks)
+        self.assertEqual(entries, {
+            ('ship_a_macro', 'extensions\\test_mod\\macros\\ship_a_macro'),
+            ('ship_b_macro', 'extensions\\test_mod\\macros\\ship_b_macro'),
+        })
+        # the later modification of ship_b replaces the earlier one, same as when applied serially
+        self.assertEqual(tasks, {
+            f'{self.mod_path}/macros/ship_a_macro.xml': Task(
+                f'{self.src_path}/assets/macros/ship_a_macro.xml', yaml_data[0]['ship_*_macro.xml'],
+                None, 'ship_*_macro.xml', [('attrib', './macro/properties/hull', 'max', [('*', 2.0)])]),
+            f'{self.mod_path}/macros/ship_b_macro.xml': Task(
+                f'{self.src_path}/assets/macros/ship_b_macro.xml', yaml_data[1]['ship_b_macro.xml'],
+                None, 'ship_b_macro.xml', [('attrib', './macro/properties/hull', 'max', [('+', 1.0)])]),
+        })
+        self.assertEqual(list(tasks), [f'{self.mod_path}/macros/ship_a_macro.xml',
+                                       f'{self.mod_path}/macros/ship_b_macro.xml'])
+
+        for jobs in [1, 2]:
+            self.assertEqual(sorted(run_tasks(tasks, jobs=jobs)), sorted(tasks))
+            self.assertIn('<hull max="200.0"/>', self.read_out('ship_a_macro.xml'))
+            self.assertIn('<hull max="201.0"/>', self.read_out('ship_b_macro.xml'))
+
+    def test_apply_yaml_diff(self):
+        self.assertEqual(diff_filename('src', 'mod', 'src/base/assets/macros/ship_macro.xml'),
+                         'mod/assets/macros/ship_macro.xml')
+        self.assertEqual(diff_filename('src', 'mod', 'src/ego_dlc_split/assets/macros/ship_macro.xml'),
+                         'mod/extensions/ego_dlc_split/assets/macros/ship_macro.xml')
+
+        os.renames(f'{self.src_path}/assets', f'{self.src_path}/base/assets')
+        entries = set()
+        apply_yaml(entries, {'ship_a_macro.xml': {'macro/properties/hull@max': '*2'}}, self.src_path, self.mod_path,
+                   as_diff=True)
+        self.assertEqual(entries, set())
+        with open(f'{self.mod_path}/assets/macros/ship_a_macro.xml') as xml_file:
+            self.assertEqual(xml_file.read(), '<?xml version="1.0"?>\n<diff>\n'
+                             '<replace sel="/macros/macro/properties/hull/@max">200.0</replace>\n</diff>')
+
+    def test_compile_mod_diff_unchanged(self):
+        # modifiers that change nothing don't write empty diff patches or index files
+        deps_filename = f'{self.tmp_dir.name}/cache/compile_test_mod.json'
+        os.renames(f'{self.src_path}/assets', f'{self.src_path}/base/assets')
+        os.makedirs(self.mod_path)
+        self.write_yaml('ship_*_macro.xml:\n  macro[@name="ship_b_macro"]/properties/hull@max: "*2"\n')
+        out_filenames = [f'{self.mod_path}/assets/macros/ship_a_macro.xml',
+                         f'{self.mod_path}/assets/macros/ship_b_macro.xml']
+        for filename in [None, deps_filename, deps_filename]:
+            with patch('compile_mod2.run_tasks', wraps=run_tasks) as patch_run_tasks:
+                compile_mod(self.src_path, self.mod_path, None, deps_filename=filename, as_diff=True)
+            self.assertEqual([os.path.exists(out_filename) for out_filename in out_filenames], [False, True])
+            self.assertFalse(os.path.exists(f'{self.mod_path}/index'))
+        # unchanged file isn't transformed again in incremental compiles
+        self.assertEqual(patch_run_tasks.call_args[0][0], {})
+
+        # a previous patch is removed when its modifiers don't change anything anymore
+        apply_yaml(set(), {'ship_*_macro.xml': {'macro[@name="ship_c_macro"]/properties/hull@max': '*2'}},
+                   self.src_path, self.mod_path, as_diff=True)
+        self.assertEqual([os.path.exists(out_filename) for out_filename in out_filenames], [False, False])
+
+    def write_yaml(self, data):
+        with open(f'{self.mod_path}/mod_test.yaml', 'w') as yaml_file:
+            yaml_file.write(data)
+
+    def test_compile_mod_incremental(self):
+        deps_filename = f'{self.tmp_dir.name}/cache/compile_test_mod.json'
+        os.makedirs(self.mod_path)
+        self.write_yaml('ship_*_macro.xml:\n  macro/properties/hull@max: "*2"\n')
+
+        with patch('compile_mod2.run_tasks', wraps=run_tasks) as patch_run_tasks:
+            compile_mod(self.src_path, self.mod_path, None, deps_filename=deps_filename)
+            self.assertEqual(sorted(patch_run_tasks.call_args[0][0]), [f'{self.mod_path}/macros/ship_a_macro.xml',
+                                                                       f'{self.mod_path}/macros/ship_b_macro.xml'])
+            self.assertTrue(os.path.exists(f'{self.mod_path}/index/macros.xml'))
+
+            # nothing changed (a touched src file is only hashed again)
+            os.utime(f'{self.src_path}/assets/macros/ship_a_macro.xml', ns=(0, 0))
+            compile_mod(self.src_path, self.mod_path, None, deps_filename=deps_filename)
+            self.assertEqual(patch_run_tasks.call_args[0][0], {})
+
+            # src file changed
+            with open(f'{self.src_path}/assets/macros/ship_b_macro.xml', 'w') as xml_file:
+                xml_file.write('<macros><macro name="ship_b_macro"><properties><hull max="300" /></properties>'
+                               '</macro></macros>')
+            compile_mod(self.src_path, self.mod_path, None, deps_filename=deps_filename)
+            self.assertEqual(list(patch_run_tasks.call_args[0][0]), [f'{self.mod_path}/macros/ship_b_macro.xml'])
+            self.assertIn('<hull max="600.0"/>', self.read_out('ship_b_macro.xml'))
+
+            # yaml changed, ship_a isn't produced anymore
+            self.write_yaml('ship_b_macro.xml:\n  macro/properties/hull@max: "*3"\n')
+            compile_mod(self.src_path, self.mod_path, None, deps_filename=deps_filename)
+            self.assertEqual(list(patch_run_tasks.call_args[0][0]), [f'{self.mod_path}/macros/ship_b_macro.xml'])
+            self.assertIn('<hull max="900.0"/>', self.read_out('ship_b_macro.xml'))
+            self.assertFalse(os.path.exists(f'{self.mod_path}/macros/ship_a_macro.xml'))
+            with open(f'{self.mod_path}/index/macros.xml') as xml_file:
+                self.assertNotIn('ship_a_macro', xml_file.read())
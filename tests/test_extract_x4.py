@@ -3,9 +3,12 @@ Run tests
 Use: ./run_tests.sh
 """
 
+import os
+import hashlib
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch, call, MagicMock
-from extract_x4 import extract_x4,CatParser
+from extract_x4 import extract_x4, verify_cats, CatParser, CatEntry, CatIndex, CatIndexCache, CatFS
 
 
 class ExtractX4UnitTest(TestCase):
@@ -14,11 +17,20 @@ class ExtractX4UnitTest(TestCase):
         ('some path/filename1.xml.sig', 101, 210),
         ('some path/filename2.xmf', 101 + 210, 300),
     ]
+    CAT_ENTRIES = [
+        CatEntry('some path/filename1.xml', 0, 101, 15512345, '1234567890abcdef'),
+        CatEntry('some path/filename1.xml.sig', 101, 210, 15512345, '1234567890abcdef'),
+        CatEntry('some path/filename2.xmf', 101 + 210, 300, 15512346, 'fedcba0987654321'),
+    ]
 
     def test_parse_line(self):
         self.assertEqual(CatParser.parse_line('file name 543210 15512345 1234567890abcdef'),
                          ('file name', 543210))
 
+    def test_parse_line_full(self):
+        self.assertEqual(CatParser.parse_line_full('file name 543210 15512345 1234567890abcdef\n'),
+                         ('file name', 543210, 15512345, '1234567890abcdef'))
+
     def test_parse_line_fail(self):
         with self.assertRaises(ValueError):
             CatParser.parse_line('invalid-line')
@@ -51,18 +63,134 @@ class ExtractX4UnitTest(TestCase):
         patch_open.assert_called_once_with('path/to/catfile.cat', 'r')
 
     @patch('builtins.open')
+    def test_cat_entries_iterator(self, patch_open):
+        patch_open.return_value.__enter__.return_value.__iter__.return_value = [
+            'some path/filename1.xml 101 15512345 1234567890abcdef\n',
+            'some path/filename1.xml.sig 210 15512345 1234567890abcdef\n',
+            'some path/filename2.xmf 300 15512346 fedcba0987654321\n',
+        ]
+        rows = list(CatParser.cat_entries_iterator('path/to/catfile.cat'))
+        self.assertEqual(rows, self.CAT_ENTRIES)
+        patch_open.assert_called_once_with('path/to/catfile.cat', 'r')
+
+    @patch('builtins.open')
+    @patch('extract_x4.CatParser.copy_range')
     @patch('extract_x4.os')
-    def test_extract_file(self, patch_os, patch_open):
-        dat_file = MagicMock()
+    def test_extract_file(self, patch_os, patch_copy_range, patch_open):
+        dat_fd = 3
         out_file_path = 'dst/path/filename'
         offset = 123
         size = 456
-        CatParser.extract_file(dat_file, out_file_path, offset, size)
+        CatParser.extract_file(dat_fd, out_file_path, offset, size)
         patch_os.makedirs.assert_called_once_with('dst/path', exist_ok=True)
-        dat_file.seek.assert_called_once_with(offset)
-        dat_file.read.assert_called_once_with(size)
-        patch_open.assert_called_once_with(out_file_path, 'wb')
-        patch_open.return_value.__enter__.return_value.write.assert_called_once_with(dat_file.read.return_value)
+        patch_open.assert_called_once_with(out_file_path, 'wb', buffering=0)
+        patch_copy_range.assert_called_once_with(
+            dat_fd, patch_open.return_value.__enter__.return_value.fileno.return_value, offset, size)
+
+    @patch('builtins.open')
+    @patch('extract_x4.CatParser.copy_range')
+    @patch('extract_x4.os')
+    def test_extract_file_no_make_dirs(self, patch_os, patch_copy_range, patch_open):
+        CatParser.extract_file(3, 'dst/path/filename', 123, 456, make_dirs=False)
+        patch_os.makedirs.assert_not_called()
+        patch_copy_range.assert_called_once()
+
+    @patch('extract_x4.os')
+    def test_make_dirs(self, patch_os):
+        parser = CatParser(out_path='some/out/path')
+        parser.make_dirs(self.CAT_ENTRIES)
+        patch_os.makedirs.assert_called_once_with('some/out/path/some path', exist_ok=True)
+        parser.make_dirs([CatEntry('other/filename3.xml', 611, 10, 15512345, '1234567890abcdef')] + self.CAT_ENTRIES)
+        self.assertEqual(patch_os.makedirs.call_count, 2)
+        patch_os.makedirs.assert_called_with('some/out/path/other', exist_ok=True)
+        self.assertEqual(parser.stats['makedirs'], 2)
+        self.assertEqual(parser.stats['makedirs_saved'], 5)
+
+    def copy_range(self, dat_data, offset, size):
+        with tempfile.TemporaryFile() as dat_file, tempfile.TemporaryFile() as out_file:
+            dat_file.write(dat_data)
+            dat_file.flush()
+            out_file.write(b'head:')
+            out_file.flush()
+            self.assertEqual(CatParser.copy_range(dat_file.fileno(), out_file.fileno(), offset, size),
+                             min(size, len(dat_data) - offset))
+            out_file.seek(0)
+            return out_file.read()
+
+    def test_copy_range(self):
+        self.assertEqual(self.copy_range(b'0123456789', 2, 5), b'head:23456')
+
+    @patch('extract_x4.os.copy_file_range', side_effect=OSError, create=True)
+    def test_copy_range_sendfile(self, patch_copy_file_range):
+        self.assertEqual(self.copy_range(b'0123456789', 2, 5), b'head:23456')
+        patch_copy_file_range.assert_called_once()
+
+    @patch('extract_x4.os.sendfile', side_effect=OSError, create=True)
+    @patch('extract_x4.os.copy_file_range', side_effect=OSError, create=True)
+    @patch('extract_x4.CatParser.COPY_BUFFER_SIZE', 2)
+    def test_copy_range_buffer(self, patch_copy_file_range, patch_sendfile):
+        self.assertEqual(self.copy_range(b'0123456789', 2, 5), b'head:23456')
+        patch_sendfile.assert_called_once()
+
+    @patch('extract_x4.logger')
+    def test_copy_range_short_dat(self, patch_logger):
+        self.assertEqual(self.copy_range(b'0123456789', 8, 5), b'head:89')
+        patch_logger.error.assert_called_once()
+
+    @patch('extract_x4.CatParser.extract_file')
+    @patch('extract_x4.os')
+    def test_extract_worker(self, patch_os, patch_extract_file):
+        entries = [self.CAT_ENTRIES[0], self.CAT_ENTRIES[2]]
+        self.assertEqual(CatParser.extract_worker('path/to/catfile.dat', 'some/out/path', entries), (2, 401))
+        patch_os.open.assert_called_once_with('path/to/catfile.dat', patch_os.O_RDONLY)
+        patch_extract_file.assert_has_calls([
+            call(patch_os.open.return_value, 'some/out/path/some path/filename1.xml', 0, 101, make_dirs=False),
+            call(patch_os.open.return_value, 'some/out/path/some path/filename2.xmf', 311, 300, make_dirs=False),
+        ])
+        patch_os.close.assert_called_once_with(patch_os.open.return_value)
+
+    def test_split_entries(self):
+        self.assertEqual(CatParser.split_entries(self.CAT_ENTRIES, 2), [self.CAT_ENTRIES[:2], self.CAT_ENTRIES[2:]])
+
+    def test_split_entries_more_jobs_than_entries(self):
+        self.assertEqual(CatParser.split_entries(self.CAT_ENTRIES[:1], 4), [self.CAT_ENTRIES[:1]])
+
+    def test_is_selected_include(self):
+        parser = CatParser(scripts_only=False, include=['*_main-lod0.xmf', '^assets/props/.*\\.xml$'])
+        self.assertTrue(parser.is_selected('assets/units/size_s/ship_arg_s_fighter_01_main-lod0.xmf'))
+        self.assertTrue(parser.is_selected('ship_main-lod0.xmf'))
+        self.assertFalse(parser.is_selected('assets/units/size_s/ship_arg_s_fighter_01_main-lod1.xmf'))
+        self.assertTrue(parser.is_selected('assets/props/engines/engine_macro.xml'))
+        self.assertFalse(parser.is_selected('assets/props/engines/engine_macro.xml.sig'))
+        self.assertFalse(parser.is_selected('libraries/assets/props/wares.xml'))
+
+    def test_is_selected_include_path_glob(self):
+        parser = CatParser(include=['assets/units/**/macros/*.xml'])
+        self.assertTrue(parser.is_selected('assets/units/size_s/macros/ship_macro.xml'))
+        self.assertFalse(parser.is_selected('assets/units/size_s/ship.xml'))
+        self.assertFalse(parser.is_selected('libraries/assets/units/size_s/macros/ship_macro.xml'))
+
+    def test_is_selected_exclude(self):
+        parser = CatParser(exclude=['**/size_xl/**', '^libraries/'])
+        self.assertTrue(parser.is_selected('assets/units/size_s/macros/ship_macro.xml'))
+        self.assertFalse(parser.is_selected('assets/units/size_xl/macros/ship_macro.xml'))
+        self.assertFalse(parser.is_selected('libraries/wares.xml'))
+
+    def test_is_selected_include_exclude(self):
+        parser = CatParser(scripts_only=False, include=['*.xmf'], exclude=['*-lod[1-9].xmf'])
+        self.assertTrue(parser.is_selected('assets/ship-lod0.xmf'))
+        self.assertFalse(parser.is_selected('assets/ship-lod1.xmf'))
+        self.assertFalse(parser.is_selected('assets/ship.xml'))
+
+    @patch('builtins.open')
+    def test_extract_filtered(self, patch_open):
+        parser = CatParser(out_path='some/out/path', scripts_only=False, signatures=True, include=['*.xm?'])
+        parser.cat_entries_iterator = MagicMock(return_value=self.CAT_ENTRIES)
+        parser.extract_file = MagicMock()
+        parser.make_dirs = MagicMock()
+        parser.extract(cat_filename='path/to/catfile.cat')
+        parser.make_dirs.assert_called_once_with([self.CAT_ENTRIES[0], self.CAT_ENTRIES[2]])
+        self.assertEqual(parser.extract_file.call_count, 2)
 
     @patch('extract_x4.logger')
     def test_list_scripts(self, patch_logger):
@@ -100,69 +228,357 @@ class ExtractX4UnitTest(TestCase):
     @patch('builtins.open')
     def test_extract_scripts(self, patch_open):
         parser = CatParser(out_path='some/out/path')
-        parser.cat_files_iterator = MagicMock(return_value=self.CAT_FILES)
+        parser.cat_entries_iterator = MagicMock(return_value=self.CAT_ENTRIES)
         parser.extract_file = MagicMock()
+        parser.make_dirs = MagicMock()
         parser.extract(cat_filename='path/to/catfile.cat')
-        parser.cat_files_iterator.assert_called_once_with('path/to/catfile.cat')
+        parser.cat_entries_iterator.assert_called_once_with('path/to/catfile.cat')
         patch_open.assert_called_once_with('path/to/catfile.dat', 'rb')
-        parser.extract_file.assert_called_once_with(patch_open.return_value.__enter__.return_value,
-                                                    'some/out/path/some path/filename1.xml', 0, 101)
+        dat_fd = patch_open.return_value.__enter__.return_value.fileno.return_value
+        parser.extract_file.assert_called_once_with(dat_fd, 'some/out/path/some path/filename1.xml', 0, 101,
+                                                    make_dirs=False)
 
     @patch('builtins.open')
     def test_extract_all_no_sig(self, patch_open):
         parser = CatParser(out_path='some/out/path', scripts_only=False)
-        parser.cat_files_iterator = MagicMock(return_value=self.CAT_FILES)
+        parser.cat_entries_iterator = MagicMock(return_value=self.CAT_ENTRIES)
         parser.extract_file = MagicMock()
+        parser.make_dirs = MagicMock()
         parser.extract(cat_filename='path/to/catfile.cat')
-        parser.cat_files_iterator.assert_called_once_with('path/to/catfile.cat')
+        parser.cat_entries_iterator.assert_called_once_with('path/to/catfile.cat')
         patch_open.assert_called_once_with('path/to/catfile.dat', 'rb')
         self.assertEqual(parser.extract_file.call_count, 2)
+        dat_fd = patch_open.return_value.__enter__.return_value.fileno.return_value
         parser.extract_file.assert_has_calls([
-            call(patch_open.return_value.__enter__.return_value, 'some/out/path/some path/filename1.xml', 0, 101),
-            call(patch_open.return_value.__enter__.return_value, 'some/out/path/some path/filename2.xmf', 311, 300),
+            call(dat_fd, 'some/out/path/some path/filename1.xml', 0, 101, make_dirs=False),
+            call(dat_fd, 'some/out/path/some path/filename2.xmf', 311, 300, make_dirs=False),
         ])
 
     @patch('builtins.open')
     def test_extract_all_inc_sig(self, patch_open):
         parser = CatParser(out_path='some/out/path', scripts_only=False, signatures=True)
-        parser.cat_files_iterator = MagicMock(return_value=self.CAT_FILES)
+        parser.cat_entries_iterator = MagicMock(return_value=self.CAT_ENTRIES)
         parser.extract_file = MagicMock()
+        parser.make_dirs = MagicMock()
         parser.extract(cat_filename='path/to/catfile.cat')
-        parser.cat_files_iterator.assert_called_once_with('path/to/catfile.cat')
+        parser.cat_entries_iterator.assert_called_once_with('path/to/catfile.cat')
         patch_open.assert_called_once_with('path/to/catfile.dat', 'rb')
         self.assertEqual(parser.extract_file.call_count, 3)
+        dat_fd = patch_open.return_value.__enter__.return_value.fileno.return_value
         parser.extract_file.assert_has_calls([
-            call(patch_open.return_value.__enter__.return_value, 'some/out/path/some path/filename1.xml', 0, 101),
-            call(patch_open.return_value.__enter__.return_value, 'some/out/path/some path/filename1.xml.sig', 101, 210),
-            call(patch_open.return_value.__enter__.return_value, 'some/out/path/some path/filename2.xmf', 311, 300),
+            call(dat_fd, 'some/out/path/some path/filename1.xml', 0, 101, make_dirs=False),
+            call(dat_fd, 'some/out/path/some path/filename1.xml.sig', 101, 210, make_dirs=False),
+            call(dat_fd, 'some/out/path/some path/filename2.xmf', 311, 300, make_dirs=False),
         ])
 
+    @patch('builtins.open')
+    def test_extract_all_jobs(self, patch_open):
+        parser = CatParser(out_path='some/out/path', scripts_only=False, signatures=True, jobs=2)
+        parser.cat_entries_iterator = MagicMock(return_value=self.CAT_ENTRIES)
+        parser.extract_worker = MagicMock(side_effect=[(2, 311), (1, 300)])
+        parser.make_dirs = MagicMock()
+        parser.extract(cat_filename='path/to/catfile.cat')
+        patch_open.assert_not_called()
+        self.assertEqual(parser.extract_worker.call_count, 2)
+        parser.extract_worker.assert_has_calls([
+            call('path/to/catfile.dat', 'some/out/path', self.CAT_ENTRIES[:2]),
+            call('path/to/catfile.dat', 'some/out/path', self.CAT_ENTRIES[2:]),
+        ], any_order=True)
+        self.assertEqual(parser.stats['files'], 3)
+        self.assertEqual(parser.stats['bytes'], 611)
+
+    @patch('builtins.open')
+    def test_extract_incremental(self, patch_open):
+        parser = CatParser(out_path='some/out/path', scripts_only=False, incremental=True)
+        parser.cat_entries_iterator = MagicMock(return_value=self.CAT_ENTRIES)
+        parser.extract_file = MagicMock()
+        parser.make_dirs = MagicMock()
+        parser.load_manifest = MagicMock(return_value={
+            'some path/filename1.xml': [101, 15512345, '1234567890abcdef'],
+            'some path/filename2.xmf': [300, 15512345, '1234567890abcdef'],
+        })
+        parser.save_manifest = MagicMock()
+        with patch('extract_x4.os.stat', return_value=MagicMock(st_size=101)) as patch_stat:
+            parser.extract(cat_filename='path/to/catfile.cat')
+        patch_stat.assert_called_once_with('some/out/path/some path/filename1.xml')
+        dat_fd = patch_open.return_value.__enter__.return_value.fileno.return_value
+        parser.extract_file.assert_called_once_with(dat_fd, 'some/out/path/some path/filename2.xmf', 311, 300,
+                                                    make_dirs=False)
+        self.assertEqual(parser.manifest['some path/filename2.xmf'], [300, 15512346, 'fedcba0987654321'])
+        parser.save_manifest.assert_called_once_with()
+        self.assertEqual(parser.stats['skipped'], 1)
+        self.assertEqual(parser.stats['files'], 1)
+
+    @patch('builtins.open')
+    def test_extract_incremental_file_missing(self, patch_open):
+        parser = CatParser(out_path='some/out/path', incremental=True)
+        parser.cat_entries_iterator = MagicMock(return_value=self.CAT_ENTRIES)
+        parser.extract_file = MagicMock()
+        parser.make_dirs = MagicMock()
+        parser.load_manifest = MagicMock(return_value={
+            'some path/filename1.xml': [101, 15512345, '1234567890abcdef'],
+        })
+        parser.save_manifest = MagicMock()
+        with patch('extract_x4.os.stat', side_effect=FileNotFoundError):
+            parser.extract(cat_filename='path/to/catfile.cat')
+        dat_fd = patch_open.return_value.__enter__.return_value.fileno.return_value
+        parser.extract_file.assert_called_once_with(dat_fd, 'some/out/path/some path/filename1.xml', 0, 101,
+                                                    make_dirs=False)
+        self.assertEqual(parser.stats['skipped'], 0)
+
     @patch('extract_x4.CatParser')
     @patch('extract_x4.os')
     def test_extract_x4_list(self, patch_os, patch_parser):
-        config = MagicMock(X4='path/to/x4', SRC='path/to/src')
         scripts_only = MagicMock()
         signatures = MagicMock()
         patch_os.listdir.return_value = ['somefile1', 'catfile2.cat', 'catfile2.dat', 'catfile1.cat', 'catfile1.dat']
-        extract_x4(config=config, extract=False, scripts_only=scripts_only, signatures=signatures)
-        patch_parser.assert_called_once_with(out_path=config.SRC, scripts_only=scripts_only, signatures=signatures)
+        extract_x4(cat_path='path/to/x4', out_path='path/to/src', extract=False,
+                   scripts_only=scripts_only, signatures=signatures)
+        patch_parser.assert_called_once_with(out_path='path/to/src', scripts_only=scripts_only,
+                                             signatures=signatures, jobs=1, incremental=False,
+                                             include=(), exclude=())
         self.assertEqual(patch_parser.return_value.list.call_count, 2)
         patch_parser.return_value.list.assert_has_calls([
             call(cat_filename='path/to/x4/catfile1.cat'),
             call(cat_filename='path/to/x4/catfile2.cat'),
         ])
 
+    @patch('extract_x4.CatIndex')
     @patch('extract_x4.CatParser')
     @patch('extract_x4.os')
-    def test_extract_x4_extract(self, patch_os, patch_parser):
-        config = MagicMock(X4='path/to/x4', SRC='path/to/src')
+    def test_extract_x4_extract(self, patch_os, patch_parser, patch_index):
         scripts_only = MagicMock()
         signatures = MagicMock()
-        patch_os.listdir.return_value = ['somefile1', 'catfile2.cat', 'catfile2.dat', 'catfile1.cat', 'catfile1.dat']
-        extract_x4(config=config, extract=True, scripts_only=scripts_only, signatures=signatures)
-        patch_parser.assert_called_once_with(out_path=config.SRC, scripts_only=scripts_only, signatures=signatures)
-        self.assertEqual(patch_parser.return_value.extract.call_count, 2)
-        patch_parser.return_value.extract.assert_has_calls([
-            call(cat_filename='path/to/x4/catfile1.cat'),
-            call(cat_filename='path/to/x4/catfile2.cat'),
-        ])
\ No newline at end of file
+        patch_os.listdir.return_value = ['somefile1', '10.cat', '10.dat', '09.cat', '09.dat']
+        patch_index.load_order_key = CatIndex.load_order_key
+        stats = extract_x4(cat_path='path/to/x4', out_path='path/to/src', extract=True,
+                           scripts_only=scripts_only, signatures=signatures, jobs=4)
+        patch_parser.assert_called_once_with(out_path='path/to/src', scripts_only=scripts_only,
+                                             signatures=signatures, jobs=4, incremental=False,
+                                             include=(), exclude=())
+        self.assertEqual(list(patch_index.from_cats.call_args[0][0]), ['path/to/x4/09.cat', 'path/to/x4/10.cat'])
+        patch_parser.return_value.extract_index.assert_called_once_with(patch_index.from_cats.return_value)
+        self.assertEqual(stats, patch_parser.return_value.stats)
+
+
+class VerifyUnitTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cat_filename = f'{self.tmp_dir.name}/01.cat'
+        files = [
+            ('a.xml', b'<a />', None),
+            ('empty.xml', b'', '00000000000000000000000000000000'),
+            ('b.xml', b'<b />' * 1000, 'bad0bad0bad0bad0bad0bad0bad0bad0'),
+            ('c.xml', b'<c />', None),
+        ]
+        with open(self.cat_filename, 'w') as cat_file, open(self.cat_filename[:-4] + '.dat', 'wb') as dat_file:
+            for filename, data, md5hex in files:
+                md5hex = md5hex or hashlib.md5(data).hexdigest()
+                cat_file.write(f'{filename} {len(data)} 15512345 {md5hex}\n')
+                dat_file.write(data)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @patch('extract_x4.CatParser.COPY_BUFFER_SIZE', 7)
+    def test_verify_cat(self):
+        self.assertEqual(CatParser.verify_cat(self.cat_filename), [
+            ('b.xml', 'bad0bad0bad0bad0bad0bad0bad0bad0', hashlib.md5(b'<b />' * 1000).hexdigest()),
+        ])
+
+    def test_verify_cat_truncated(self):
+        with open(self.cat_filename[:-4] + '.dat', 'r+b') as dat_file:
+            dat_file.truncate(10)
+        self.assertEqual(CatParser.verify_cat(self.cat_filename), [
+            ('b.xml', 'bad0bad0bad0bad0bad0bad0bad0bad0', 'truncated'),
+            ('c.xml', hashlib.md5(b'<c />').hexdigest(), 'truncated'),
+        ])
+
+    def test_verify_cats(self):
+        self.assertEqual(verify_cats([self.cat_filename], jobs=1), {
+            self.cat_filename: [
+                ('b.xml', 'bad0bad0bad0bad0bad0bad0bad0bad0', hashlib.md5(b'<b />' * 1000).hexdigest()),
+            ]
+        })
+
+
+class CatIndexUnitTest(TestCase):
+
+    def test_load_order_key(self):
+        self.assertEqual(
+            sorted(['path/10.cat', 'path/9.cat', 'path/02.cat', 'path/ext_01.cat'], key=CatIndex.load_order_key),
+            ['path/02.cat', 'path/9.cat', 'path/10.cat', 'path/ext_01.cat'])
+
+    @patch('extract_x4.CatParser.cat_entries_iterator')
+    def test_from_cats(self, patch_iterator):
+        entries = {
+            'path/01.cat': [
+                CatEntry('a.xml', 0, 10, 1, 'hash-a1'),
+                CatEntry('b.xml', 10, 20, 1, 'hash-b1'),
+                CatEntry('c.xml', 30, 30, 1, 'hash-c1'),
+            ],
+            'path/02.cat': [
+                CatEntry('b.xml', 0, 21, 2, 'hash-b2'),
+            ],
+            'path/10.cat': [
+                CatEntry('c.xml', 0, 5, 3, 'hash-c3'),
+                CatEntry('a.xml', 5, 11, 3, 'hash-a3'),
+                CatEntry('d.xml', 16, 40, 3, 'hash-d3'),
+            ],
+        }
+        patch_iterator.side_effect = lambda cat_filename: entries[cat_filename]
+        index = CatIndex.from_cats(['path/10.cat', 'path/02.cat', 'path/01.cat'])
+        self.assertEqual(index.cat_filenames, ['path/01.cat', 'path/02.cat', 'path/10.cat'])
+        self.assertEqual(index.overridden, 3)
+        self.assertEqual(index.which('a.xml'), 'path/10.cat')
+        self.assertEqual(index.which('b.xml'), 'path/02.cat')
+        self.assertEqual(index.which('missing.xml'), None)
+        self.assertEqual(index.lookup('b.xml'), ('path/02.cat', entries['path/02.cat'][0]))
+        self.assertEqual(index.lookup('missing.xml'), None)
+        self.assertEqual(list(index.entries_by_cat()), [
+            ('path/02.cat', [entries['path/02.cat'][0]]),
+            ('path/10.cat', entries['path/10.cat']),
+        ])
+
+    def test_extract_index(self):
+        entries = [
+            CatEntry('a.xml', 0, 10, 1, 'hash-a1'),
+            CatEntry('a.xml.sig', 10, 10, 1, 'hash-a1'),
+        ]
+        index = MagicMock()
+        index.entries_by_cat.return_value = [('path/01.cat', entries)]
+        parser = CatParser(out_path='out/path')
+        parser.extract_entries = MagicMock()
+        parser.extract_index(index)
+        parser.extract_entries.assert_called_once_with('path/01.cat', entries[:1])
+
+
+class CatIndexCacheUnitTest(TestCase):
+    MD5 = '0123456789abcdef0123456789abcdef'
+
+    def write_cat(self, name, filenames):
+        with open(f'{self.tmp_dir.name}/{name}', 'w') as cat_file:
+            for filename, size in filenames:
+                cat_file.write(f'{filename} {size} 15512345 {self.MD5}\n')
+        return f'{self.tmp_dir.name}/{name}'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_filename = f'{self.tmp_dir.name}/cache/cats.idx'
+        self.cats = [
+            self.write_cat('02.cat', [('b.xml', 5), ('a.xml', 6)]),
+            self.write_cat('01.cat', [('a.xml', 1), ('b.xml', 2), ('dir/c d.xml', 3)]),
+        ]
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_load(self):
+        cache = CatIndexCache.load(self.cache_filename, self.cats)
+        self.assertTrue(os.path.exists(self.cache_filename))
+        self.assertEqual(len(cache), 5)
+        self.assertEqual(list(cache), [
+            (self.cats[1], CatEntry('a.xml', 0, 1, 15512345, self.MD5)),
+            (self.cats[1], CatEntry('b.xml', 1, 2, 15512345, self.MD5)),
+            (self.cats[1], CatEntry('dir/c d.xml', 3, 3, 15512345, self.MD5)),
+            (self.cats[0], CatEntry('b.xml', 0, 5, 15512345, self.MD5)),
+            (self.cats[0], CatEntry('a.xml', 5, 6, 15512345, self.MD5)),
+        ])
+        cache.close()
+
+    def test_lookup(self):
+        cache = CatIndexCache.load(self.cache_filename, self.cats)
+        self.assertEqual(cache.lookup('a.xml'), (self.cats[0], CatEntry('a.xml', 5, 6, 15512345, self.MD5)))
+        self.assertEqual(cache.lookup('dir/c d.xml'), (self.cats[1], CatEntry('dir/c d.xml', 3, 3, 15512345, self.MD5)))
+        self.assertEqual(cache.lookup('missing.xml'), None)
+        self.assertEqual(cache.which('b.xml'), self.cats[0])
+        self.assertEqual(cache.which('missing.xml'), None)
+        cache.close()
+
+    def test_load_cached(self):
+        CatIndexCache.load(self.cache_filename, self.cats).close()
+        with patch('extract_x4.CatIndexCache.build') as patch_build:
+            cache = CatIndexCache.load(self.cache_filename, self.cats)
+        patch_build.assert_not_called()
+        self.assertEqual(len(cache), 5)
+        cache.close()
+
+    def test_load_stale(self):
+        CatIndexCache.load(self.cache_filename, self.cats).close()
+        os.utime(self.cats[0], ns=(0, 0))
+        self.write_cat('03.cat', [('a.xml', 7)])
+        self.assertFalse(CatIndexCache(self.cache_filename, self.cats).open())
+        cache = CatIndexCache.load(self.cache_filename, self.cats + [f'{self.tmp_dir.name}/03.cat'])
+        self.assertEqual(cache.which('a.xml'), f'{self.tmp_dir.name}/03.cat')
+        cache.close()
+
+
+class CatFSUnitTest(TestCase):
+
+    @staticmethod
+    def write_cat(path, name, files):
+        os.makedirs(path, exist_ok=True)
+        with open(f'{path}/{name}.cat', 'w') as cat_file, open(f'{path}/{name}.dat', 'wb') as dat_file:
+            for filename, data in files:
+                cat_file.write(f'{filename} {len(data)} 15512345 1234567890abcdef\n')
+                dat_file.write(data)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.game_path = self.tmp_dir.name
+        self.write_cat(self.game_path, '01', [
+            ('libraries/wares.xml', b'<wares />'),
+            ('index/macros.xml', b'<index />'),
+            ('assets/units/size_s/macros/ship_arg_s_fighter_01_a_macro.xml', b'<macros />'),
+        ])
+        self.write_cat(self.game_path, '02', [
+            ('libraries/wares.xml', b'<wares>02</wares>'),
+            ('empty.txt', b''),
+        ])
+        self.write_cat(f'{self.game_path}/extensions/ego_dlc_split', 'ext_01', [
+            ('libraries/wares.xml', b'<diff />'),
+        ])
+        self.fs = CatFS.from_game(self.game_path)
+
+    def tearDown(self):
+        self.fs.close()
+        self.tmp_dir.cleanup()
+
+    def test_read(self):
+        self.assertEqual(self.fs.read('base/index/macros.xml'), b'<index />')
+        self.assertEqual(self.fs.read('ego_dlc_split/libraries/wares.xml'), b'<diff />')
+        self.assertEqual(self.fs.read('base/empty.txt'), b'')
+
+    def test_read_later_archive_wins(self):
+        self.assertEqual(self.fs.read('base/libraries/wares.xml'), b'<wares>02</wares>')
+
+    def test_read_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            self.fs.read('base/missing.xml')
+
+    def test_read_load_order(self):
+        # 10.cat is loaded after 9.cat
+        self.write_cat(self.game_path, '9', [('libraries/wares.xml', b'<wares>09</wares>')])
+        self.write_cat(self.game_path, '10', [('libraries/wares.xml', b'<wares>10</wares>')])
+        fs = CatFS.from_game(self.game_path)
+        self.assertEqual(fs.read('base/libraries/wares.xml'), b'<wares>10</wares>')
+        fs.close()
+
+    def test_open(self):
+        self.assertEqual(self.fs.open('base/index/macros.xml').read(), b'<index />')
+
+    def test_exists_getsize(self):
+        self.assertTrue(self.fs.exists('base/index/macros.xml'))
+        self.assertFalse(self.fs.exists('base/index/components.xml'))
+        self.assertEqual(self.fs.getsize('base/libraries/wares.xml'), 17)
+
+    def test_glob(self):
+        self.assertEqual(self.fs.glob('*/libraries/wares.xml'), [
+            'base/libraries/wares.xml',
+            'ego_dlc_split/libraries/wares.xml',
+        ])
+        self.assertEqual(self.fs.glob('**/ship_*_macro.xml'), [
+            'base/assets/units/size_s/macros/ship_arg_s_fighter_01_a_macro.xml',
+        ])
+        self.assertEqual(self.fs.glob('base/*.xml'), [])
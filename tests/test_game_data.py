@@ -0,0 +1,79 @@
+"""
+Run tests
+Use: ./run_tests.sh
+"""
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from lib.game_data import extensions, input_filenames, merge, resolve, resolve_all
+
+
+class GameDataUnitTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src_path = f'{self.tmp_dir.name}/src'
+        self.cache_path = f'{self.tmp_dir.name}/cache/resolved'
+        self.write('base/libraries/wares.xml', '<wares><ware id="ware_a"><price max="10" /></ware></wares>')
+        self.write('ego_dlc_split/libraries/wares.xml', '<diff><add sel="/wares"><ware id="ware_split" /></add>'
+                                                        '<replace sel="/wares/ware[@id=\'ware_a\']/price/@max">20'
+                                                        '</replace></diff>')
+        self.write('ego_dlc_terran/libraries/wares.xml', '<diff><add sel="/wares"><ware id="ware_terran" /></add>'
+                                                         '</diff>')
+        self.write('a_mod/libraries/wares.xml', '<diff><remove sel="/wares/ware[@id=\'ware_split\']" /></diff>')
+        self.write('base/t/0001-l044.xml', '<language id="44"><page id="1" /></language>')
+        self.write('ego_dlc_split/t/0001-l044.xml', '<language id="44"><page id="2" /></language>')
+        self.write('base/index/macros.xml', '<index><entry name="a" /></index>')
+        self.write('ego_dlc_split/libraries/split_only.xml', '<diff><add sel="/x" /></diff>')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write(self, rel_path, data):
+        os.makedirs(os.path.dirname(f'{self.src_path}/{rel_path}'), exist_ok=True)
+        with open(f'{self.src_path}/{rel_path}', 'w') as xml_file:
+            xml_file.write(data)
+
+    def test_extensions(self):
+        self.assertEqual(extensions(self.src_path), ['ego_dlc_split', 'ego_dlc_terran', 'a_mod'])
+        self.assertEqual(input_filenames(self.src_path, 't/0001-l044.xml'),
+                         [f'{self.src_path}/base/t/0001-l044.xml', f'{self.src_path}/ego_dlc_split/t/0001-l044.xml'])
+
+    def test_merge(self):
+        xml = merge(input_filenames(self.src_path, 'libraries/wares.xml'))
+        self.assertEqual([ware.get('id') for ware in xml.getroot()], ['ware_a', 'ware_terran'])
+        self.assertEqual(xml.find('ware/price').get('max'), '20')
+        xml = merge(input_filenames(self.src_path, 't/0001-l044.xml'))
+        self.assertEqual([page.get('id') for page in xml.getroot()], ['1', '2'])
+        with self.assertLogs('x4.lib.game_data'):
+            self.assertIsNone(merge(input_filenames(self.src_path, 'libraries/split_only.xml')))
+
+    def test_resolve(self):
+        with patch('lib.game_data.merge', wraps=merge) as patch_merge:
+            xml = resolve(self.src_path, 'libraries/wares.xml', self.cache_path)
+            self.assertEqual([ware.get('id') for ware in xml.getroot()], ['ware_a', 'ware_terran'])
+            self.assertTrue(os.path.exists(f'{self.cache_path}/libraries/wares.xml'))
+            self.assertEqual(patch_merge.call_count, 1)
+
+            # inputs didn't change, merged file is loaded
+            xml = resolve(self.src_path, 'libraries/wares.xml', self.cache_path)
+            self.assertEqual([ware.get('id') for ware in xml.getroot()], ['ware_a', 'ware_terran'])
+            self.assertEqual(patch_merge.call_count, 1)
+
+            # an input changed
+            self.write('a_mod/libraries/wares.xml', '<diff />')
+            xml = resolve(self.src_path, 'libraries/wares.xml', self.cache_path)
+            self.assertEqual([ware.get('id') for ware in xml.getroot()], ['ware_a', 'ware_split', 'ware_terran'])
+            self.assertEqual(patch_merge.call_count, 2)
+
+        self.assertEqual(resolve(self.src_path, 'index/macros.xml', self.cache_path).getroot()[0].get('name'), 'a')
+        self.assertFalse(os.path.exists(f'{self.cache_path}/index/macros.xml'))
+        self.assertIsNone(resolve(self.src_path, 'libraries/missing.xml', self.cache_path))
+
+    def test_resolve_all(self):
+        self.assertEqual(resolve_all(self.src_path, self.cache_path),
+                         ['index/macros.xml', 'libraries/split_only.xml', 'libraries/wares.xml', 't/0001-l044.xml'])
+        self.assertEqual(sorted(os.listdir(self.cache_path)), ['libraries', 'resolved.json', 't'])
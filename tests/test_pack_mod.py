@@ -5,14 +5,91 @@ Use: ./run_tests.sh
 
 from unittest import TestCase
 from unittest.mock import patch, MagicMock
-from pack_mod import pack_mod
+from pack_mod import pack_mod, report_duplicates
 
 
 class PackModUnitTest(TestCase):
 
     @patch('pack_mod.pack_path')
     def test_pack(self, patch_pack_path):
-        config = MagicMock(MODS='mods/path', X4='x4/path')
+        config = MagicMock(MODS='mods/path', X4='x4/path', PWD='pwd')
         pack_mod(mod_name='blah', config=config)
         patch_pack_path.assert_called_once_with(src='mods/path/blah/',
-                                                dst='x4/path/extensions/blah/')
\ No newline at end of file
+                                                dst='x4/path/extensions/blah/',
+                                                incremental=False,
+                                                volume_size=None,
+                                                split_dirs=False,
+                                                timestamp=None,
+                                                game_index=None,
+                                                state_path='pwd/cache/pack_blah.json')
+
+    @patch('pack_mod.pack_path')
+    def test_pack_incremental(self, patch_pack_path):
+        config = MagicMock(MODS='mods/path', X4='x4/path', PWD='pwd')
+        pack_mod(mod_name='blah', config=config, incremental=True)
+        patch_pack_path.assert_called_once_with(src='mods/path/blah/',
+                                                dst='x4/path/extensions/blah/',
+                                                incremental=True,
+                                                volume_size=None,
+                                                split_dirs=False,
+                                                timestamp=None,
+                                                game_index=None,
+                                                state_path='pwd/cache/pack_blah.json')
+
+    @patch('pack_mod.pack_path')
+    def test_pack_volumes(self, patch_pack_path):
+        config = MagicMock(MODS='mods/path', X4='x4/path', PWD='pwd')
+        pack_mod(mod_name='blah', config=config, volume_size=1024, split_dirs=True)
+        patch_pack_path.assert_called_once_with(src='mods/path/blah/',
+                                                dst='x4/path/extensions/blah/',
+                                                incremental=False,
+                                                volume_size=1024,
+                                                split_dirs=True,
+                                                timestamp=None,
+                                                game_index=None,
+                                                state_path='pwd/cache/pack_blah.json')
+    @patch('pack_mod.load_game_index')
+    @patch('pack_mod.pack_path')
+    def test_pack_dedup(self, patch_pack_path, patch_load_game_index):
+        config = MagicMock(MODS='mods/path', X4='x4/path', PWD='pwd')
+        pack_mod(mod_name='blah', config=config, dedup=True)
+        patch_load_game_index.assert_called_once_with(config)
+        patch_pack_path.assert_called_once_with(src='mods/path/blah/',
+                                                dst='x4/path/extensions/blah/',
+                                                incremental=False,
+                                                volume_size=None,
+                                                split_dirs=False,
+                                                timestamp=None,
+                                                game_index=patch_load_game_index.return_value,
+                                                state_path='pwd/cache/pack_blah.json')
+
+    @patch('pack_mod.os.path.getsize', return_value=1024 * 1024)
+    @patch('pack_mod.find_content_duplicates')
+    @patch('pack_mod.find_duplicates')
+    @patch('pack_mod.collect_files')
+    @patch('pack_mod.load_extensions_index')
+    @patch('pack_mod.load_game_index')
+    def test_report_duplicates(self, patch_load_game_index, patch_load_extensions_index, patch_collect_files,
+                               patch_find_duplicates, patch_find_content_duplicates, patch_getsize):
+        config = MagicMock(MODS='mods/path', X4='x4/path', PWD='pwd')
+        patch_collect_files.return_value = [('index/a.xml', 'mods/path/blah/index/a.xml'),
+                                            ('index/b.xml', 'mods/path/blah/index/b.xml'),
+                                            ('macros/c.xml', 'mods/path/blah/macros/c.xml')]
+        patch_find_duplicates.return_value = [('index/a.xml', 'mods/path/blah/index/a.xml', 'x4/path/01.cat')]
+        patch_find_content_duplicates.return_value = [
+            ('index/a.xml', 'mods/path/blah/index/a.xml', 'x4/path/01.cat', 'index/a.xml'),
+            ('macros/c.xml', 'mods/path/blah/macros/c.xml', 'x4/path/02.cat', 'assets/c_macro.xml'),
+        ]
+        with self.assertLogs('x4.pack_mod', level='WARNING') as logs:
+            self.assertEqual(report_duplicates(mod_name='blah', config=config),
+                             (patch_find_duplicates.return_value, patch_find_content_duplicates.return_value[1:]))
+        patch_collect_files.assert_called_once_with('mods/path/blah/')
+        patch_find_duplicates.assert_called_once_with(patch_collect_files.return_value,
+                                                      patch_load_game_index.return_value)
+        patch_find_content_duplicates.assert_called_once_with(
+            patch_collect_files.return_value,
+            [patch_load_game_index.return_value, patch_load_extensions_index.return_value])
+        self.assertEqual(logs.output, [
+            'WARNING:x4.pack_mod:blah: 1 of 3 files (1.0 MB) are identical to game files',
+            'WARNING:x4.pack_mod:blah: 1 more files have the same content as game files at other paths',
+        ])
@@ -3,10 +3,15 @@ Run tests
 Use: ./run_tests.sh
 """
 
+import os
+import shutil
+import hashlib
+import tempfile
 from unittest import TestCase
 from unittest.mock import patch, call, MagicMock
 
-from pack_x4 import pack_path
+from pack_x4 import pack_path, get_entries, file_md5, split_volumes, find_duplicates, find_content_duplicates
+from extract_x4 import CatEntry, CatIndex
 
 
 class PackX4UnitTest(TestCase):
@@ -14,8 +19,9 @@ class PackX4UnitTest(TestCase):
     @patch('builtins.open')
     @patch('pack_x4.os')
     @patch('pack_x4.shutil')
-    @patch('pack_x4.hashlib')
-    def test_pack(self, patch_hashlib, patch_shutil, patch_os, patch_open):
+    @patch('pack_x4.file_md5')
+    @patch('pack_x4.CatParser.copy_range')
+    def test_pack(self, patch_copy_range, patch_file_md5, patch_shutil, patch_os, patch_open):
         src = 'src/path/'
         dst = 'dst/path/'
         catfile, datfile, file1, file2, file3, file4 = patch_open.side_effect = [
@@ -26,31 +32,28 @@ class PackX4UnitTest(TestCase):
             MagicMock(),
             MagicMock(),
         ]
-        file1.read.return_value = b'file1 content 1'
-        file2.read.return_value = b'file2 content 12'
-        file3.read.return_value = b'file3 content 123'
-        file4.read.return_value = b'file4 content 1234'
         patch_os.path.join = lambda a, b: a+'/'+b
         patch_os.walk.return_value = [
             ('src/path', [], ['cp-file']),
             ('src/path/dir_a', [], ['file1', 'file2']),
             ('src/path/dir_b', [], ['file3', 'file4']),
         ]
-        patch_hashlib.md5.return_value.hexdigest.side_effect = ['hash1', 'hash2', 'hash3', 'hash4']
+        patch_file_md5.side_effect = ['hash1', 'hash2', 'hash3', 'hash4']
+        patch_copy_range.side_effect = lambda src_fd, dat_fd, offset, size: size
         patch_os.stat.side_effect = [
-            MagicMock(st_mtime=1001),
-            MagicMock(st_mtime=1002),
-            MagicMock(st_mtime=1003),
-            MagicMock(st_mtime=1004),
+            MagicMock(st_size=15, st_mtime=1001),
+            MagicMock(st_size=16, st_mtime=1002),
+            MagicMock(st_size=17, st_mtime=1003),
+            MagicMock(st_size=18, st_mtime=1004),
         ]
 
-        pack_path(src, dst)
+        pack_path(src, dst, jobs=1)
 
         # verify the correct calls are made
         patch_os.makedirs.assert_called_once_with(dst, exist_ok=True)
         patch_open.assert_has_calls([
             call('dst/path/ext_01.cat', 'wb'),
-            call('dst/path/ext_01.dat', 'wb'),
+            call('dst/path/ext_01.dat', 'wb', buffering=0),
             call('src/path/dir_a/file1', 'rb'),
             call('src/path/dir_a/file2', 'rb'),
             call('src/path/dir_b/file3', 'rb'),
@@ -60,15 +63,11 @@ class PackX4UnitTest(TestCase):
         patch_shutil.copy.assert_has_calls([
             call('src/path/cp-file', 'dst/path/cp-file'),
         ])
-        patch_hashlib.md5.assert_has_calls([
-            call(file1.read.return_value),
-            call().hexdigest(),
-            call(file2.read.return_value),
-            call().hexdigest(),
-            call(file3.read.return_value),
-            call().hexdigest(),
-            call(file4.read.return_value),
-            call().hexdigest(),
+        patch_file_md5.assert_has_calls([
+            call('src/path/dir_a/file1', 15),
+            call('src/path/dir_a/file2', 16),
+            call('src/path/dir_b/file3', 17),
+            call('src/path/dir_b/file4', 18),
         ])
 
         patch_os.stat.assert_has_calls([
@@ -86,10 +85,273 @@ class PackX4UnitTest(TestCase):
             call(b'dir_b/file4 18 1004 hash4\n'),
         ])
 
-        # verify the correct data is written to dat file
-        datfile.__enter__.return_value.write.assert_has_calls([
-            call(file1.read.return_value),
-            call(file2.read.return_value),
-            call(file3.read.return_value),
-            call(file4.read.return_value),
-        ])
\ No newline at end of file
+        # verify file data is copied into dat file
+        dat_fd = datfile.__enter__.return_value.fileno.return_value
+        patch_copy_range.assert_has_calls([
+            call(file1.__enter__.return_value.fileno.return_value, dat_fd, 0, 15),
+            call(file2.__enter__.return_value.fileno.return_value, dat_fd, 0, 16),
+            call(file3.__enter__.return_value.fileno.return_value, dat_fd, 0, 17),
+            call(file4.__enter__.return_value.fileno.return_value, dat_fd, 0, 18),
+        ])
+
+    @patch('pack_x4.CatParser.copy_range', return_value=10)
+    def test_pack_file_changed(self, patch_copy_range):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(f'{tmp_dir}/src/index')
+            with open(f'{tmp_dir}/src/index/macros.xml', 'wb') as src_file:
+                src_file.write(b'<index>changed</index>')
+            with self.assertRaises(IOError):
+                pack_path(f'{tmp_dir}/src/', f'{tmp_dir}/dst/')
+
+    def test_file_md5(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            filename = f'{tmp_dir}/file'
+            with open(filename, 'wb') as src_file:
+                src_file.write(b'0123456789' * 1000)
+            with patch('pack_x4.HASH_CHUNK_SIZE', 64):
+                self.assertEqual(file_md5(filename, 10000), hashlib.md5(b'0123456789' * 1000).hexdigest())
+                self.assertEqual(file_md5(filename, 5), hashlib.md5(b'01234').hexdigest())
+            self.assertEqual(file_md5(filename, 0), hashlib.md5(b'').hexdigest())
+
+
+class PackX4IncrementalUnitTest(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.src = f'{self.tmp_dir.name}/src/'
+        self.dst = f'{self.tmp_dir.name}/dst/'
+        self.write_file('content.xml', b'<content />')
+        self.write_file('index/macros.xml', b'<index />')
+        self.write_file('assets/ship_macro.xml', b'<macros />')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def write_file(self, filename, data, mtime=1000):
+        os.makedirs(os.path.dirname(self.src + filename), exist_ok=True)
+        with open(self.src + filename, 'wb') as src_file:
+            src_file.write(data)
+        os.utime(self.src + filename, (mtime, mtime))
+
+    def read_dst(self, filename):
+        with open(self.dst + filename, 'rb') as dst_file:
+            return dst_file.read()
+
+    def test_get_entries(self):
+        files = [
+            ('index/macros.xml', self.src + 'index/macros.xml'),
+            ('assets/ship_macro.xml', self.src + 'assets/ship_macro.xml'),
+        ]
+        previous = [
+            CatEntry('assets/ship_macro.xml', 0, 10, 1000, 'cached-md5'),
+            CatEntry('index/macros.xml', 10, 9, 999, 'old-md5'),
+        ]
+        self.assertEqual(get_entries(files, previous), [
+            CatEntry('index/macros.xml', 0, 9, 1000, None),
+            CatEntry('assets/ship_macro.xml', 9, 10, 1000, 'cached-md5'),
+        ])
+
+    def test_pack_incremental(self):
+        self.assertTrue(pack_path(self.src, self.dst, incremental=True))
+        self.assertEqual(self.read_dst('content.xml'), b'<content />')
+        cat = self.read_dst('ext_01.cat')
+        self.assertEqual(sorted(cat.decode('utf-8').splitlines()), [
+            'assets/ship_macro.xml 10 1000 {}'.format(hashlib.md5(b'<macros />').hexdigest()),
+            'index/macros.xml 9 1000 {}'.format(hashlib.md5(b'<index />').hexdigest()),
+        ])
+
+        with patch('pack_x4.file_md5') as patch_file_md5:
+            self.assertFalse(pack_path(self.src, self.dst, incremental=True))
+        patch_file_md5.assert_not_called()
+        self.assertEqual(self.read_dst('ext_01.cat'), cat)
+
+    def test_pack_incremental_changed(self):
+        pack_path(self.src, self.dst, incremental=True)
+        self.write_file('index/macros.xml', b'<index>changed</index>', mtime=2000)
+        with patch('pack_x4.file_md5', side_effect=lambda filename, size: 'new-md5') as patch_file_md5:
+            self.assertTrue(pack_path(self.src, self.dst, incremental=True))
+        patch_file_md5.assert_called_once_with(self.src + 'index/macros.xml', 22)
+        self.assertIn(b'index/macros.xml 22 2000 new-md5\n', self.read_dst('ext_01.cat'))
+        self.assertIn(b'<index>changed</index>', self.read_dst('ext_01.dat'))
+
+    def test_pack_incremental_timestamp(self):
+        # cat entries have the fixed timestamp, file mtimes are kept in the state file to reuse md5 hashes
+        state_path = f'{self.tmp_dir.name}/cache/pack_mod.json'
+        pack_path(self.src, self.dst, incremental=True, timestamp=0, state_path=state_path)
+        self.assertIn(b'index/macros.xml 9 0 ', self.read_dst('ext_01.cat'))
+        self.assertEqual(sorted(os.listdir(self.dst)), ['content.xml', 'ext_01.cat', 'ext_01.dat'])
+        with patch('pack_x4.file_md5') as patch_file_md5:
+            self.assertFalse(pack_path(self.src, self.dst, incremental=True, timestamp=0, state_path=state_path))
+        patch_file_md5.assert_not_called()
+
+        self.write_file('index/macros.xml', b'<index>changed</index>', mtime=2000)
+        with patch('pack_x4.file_md5', side_effect=lambda filename, size: 'new-md5') as patch_file_md5:
+            self.assertTrue(pack_path(self.src, self.dst, incremental=True, timestamp=0, state_path=state_path))
+        patch_file_md5.assert_called_once_with(self.src + 'index/macros.xml', 22)
+        self.assertIn(b'index/macros.xml 22 0 new-md5\n', self.read_dst('ext_01.cat'))
+
+        # without the state all files are hashed again
+        with patch('pack_x4.file_md5', side_effect=lambda filename, size: 'new-md5') as patch_file_md5:
+            pack_path(self.src, self.dst, incremental=True, timestamp=0)
+        self.assertEqual(patch_file_md5.call_count, 2)
+        self.assertEqual(sorted(os.listdir(self.dst)), ['content.xml', 'ext_01.cat', 'ext_01.dat'])
+
+    def test_pack_incremental_dat_missing(self):
+        pack_path(self.src, self.dst, incremental=True)
+        os.remove(self.dst + 'ext_01.dat')
+        self.assertTrue(pack_path(self.src, self.dst, incremental=True))
+        self.assertEqual(len(self.read_dst('ext_01.dat')), 19)
+
+    def test_split_volumes(self):
+        files = [
+            ('index/macros.xml', self.src + 'index/macros.xml'),
+            ('assets/ship_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('assets/ship2_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('assets/ship3_macro.xml', self.src + 'assets/ship_macro.xml'),
+        ]
+        self.assertEqual(split_volumes(files), [files])
+        self.assertEqual(split_volumes(files, volume_size=20), [files[:2], files[2:]])
+        self.assertEqual(split_volumes(files, volume_size=5), [[f] for f in files])
+        self.assertEqual(split_volumes(files, split_dirs=True), [files[1:], files[:1]])
+        self.assertEqual(split_volumes(files, volume_size=20, split_dirs=True), [files[1:3], files[3:], files[:1]])
+
+    def test_split_volumes_previous(self):
+        files = [
+            ('assets/ship1_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('assets/ship2_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('assets/ship3_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('assets/ship4_macro.xml', self.src + 'assets/ship_macro.xml'),
+        ]
+        previous = [[files[1][0], files[2][0]], [files[3][0]]]
+        # new file is added to the last volume with room instead of shifting all files by one
+        self.assertEqual(split_volumes(files, volume_size=20), [files[:2], files[2:]])
+        self.assertEqual(split_volumes(files, volume_size=20, previous=previous), [files[1:3], [files[0], files[3]]])
+        # files that don't fit anymore overflow into a new volume, emptied volumes are kept (unless last)
+        self.assertEqual(split_volumes(files[1:], volume_size=10, previous=previous),
+                         [files[1:2], files[3:], files[2:3]])
+        self.assertEqual(split_volumes(files[3:], volume_size=20, previous=previous), [[], files[3:]])
+        self.assertEqual(split_volumes(files[:2], volume_size=20, previous=previous), [files[:2]])
+        # without volume size and split dirs the previous volumes are ignored
+        self.assertEqual(split_volumes(files, previous=previous), [files])
+
+    def test_split_volumes_previous_dirs(self):
+        files = [
+            ('aiscripts/a.xml', self.src + 'index/macros.xml'),
+            ('assets/ship_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('index/macros.xml', self.src + 'index/macros.xml'),
+            ('libraries/wares.xml', self.src + 'index/macros.xml'),
+        ]
+        previous = [[files[1][0]], [files[2][0]], [files[3][0]]]
+        self.assertEqual(split_volumes(files, split_dirs=True), [[f] for f in files])
+        # a new dir gets a new volume instead of renumbering the following ones
+        self.assertEqual(split_volumes(files, split_dirs=True, previous=previous), [[f] for f in files[1:] + files[:1]])
+        # a removed dir leaves an empty volume, which is reused by a new dir
+        self.assertEqual(split_volumes(files[2:], split_dirs=True, previous=previous), [[], files[2:3], files[3:]])
+        self.assertEqual(split_volumes(files[:1] + files[2:], split_dirs=True, previous=previous),
+                         [files[:1], files[2:3], files[3:]])
+
+    def test_pack_volumes(self):
+        self.assertEqual(pack_path(self.src, self.dst, incremental=True, split_dirs=True), 2)
+        self.assertEqual(self.read_dst('ext_01.dat'), b'<macros />')
+        self.assertEqual(self.read_dst('ext_02.dat'), b'<index />')
+
+        self.write_file('index/macros.xml', b'<index>changed</index>', mtime=2000)
+        ext_01_mtime = os.stat(self.dst + 'ext_01.cat').st_mtime_ns
+        self.assertEqual(pack_path(self.src, self.dst, incremental=True, split_dirs=True), 1)
+        self.assertEqual(os.stat(self.dst + 'ext_01.cat').st_mtime_ns, ext_01_mtime)
+        self.assertEqual(self.read_dst('ext_02.dat'), b'<index>changed</index>')
+
+        # a new file doesn't shift the files of the following volumes
+        self.assertEqual(pack_path(self.src, self.dst, incremental=True, volume_size=20), 0)
+        self.write_file('assets/a_macro.xml', b'<a />')
+        self.assertEqual(pack_path(self.src, self.dst, incremental=True, volume_size=20), 1)
+        self.assertEqual(self.read_dst('ext_01.dat'), b'<macros />')
+        self.assertEqual(self.read_dst('ext_02.dat'), b'<index>changed</index>')
+        self.assertEqual(self.read_dst('ext_03.dat'), b'<a />')
+        os.remove(self.src + 'assets/a_macro.xml')
+
+        # a new dir doesn't renumber the volumes of the other dirs
+        self.write_file('aiscripts/a.xml', b'<aiscript />')
+        # (into the volume emptied by removing assets/a_macro.xml)
+        self.assertEqual(pack_path(self.src, self.dst, incremental=True, split_dirs=True), 1)
+        self.assertEqual(self.read_dst('ext_01.dat'), b'<macros />')
+        self.assertEqual(self.read_dst('ext_02.dat'), b'<index>changed</index>')
+        self.assertEqual(self.read_dst('ext_03.dat'), b'<aiscript />')
+        shutil.rmtree(self.src + 'aiscripts')
+
+        # back to a single volume, stale volumes are removed
+        self.assertEqual(pack_path(self.src, self.dst, incremental=True), 1)
+        self.assertFalse(os.path.exists(self.dst + 'ext_02.cat'))
+        self.assertFalse(os.path.exists(self.dst + 'ext_02.dat'))
+
+    def test_pack_reproducible(self):
+        other = f'{self.tmp_dir.name}/other/'
+        for filename in ['assets/ship_macro.xml', 'content.xml', 'index/macros.xml']:
+            os.makedirs(os.path.dirname(other + filename), exist_ok=True)
+            shutil.copy(self.src + filename, other + filename)
+
+        with self.assertLogs('x4.pack_x4', level='WARNING') as logs:
+            pack_path(self.src, self.dst, timestamp=0)
+        cat, dat = self.read_dst('ext_01.cat'), self.read_dst('ext_01.dat')
+        self.assertEqual(cat.decode('utf-8').splitlines(), [
+            'assets/ship_macro.xml 10 0 {}'.format(hashlib.md5(b'<macros />').hexdigest()),
+            'index/macros.xml 9 0 {}'.format(hashlib.md5(b'<index />').hexdigest()),
+        ])
+
+        with patch.dict('pack_x4.os.environ', {'SOURCE_DATE_EPOCH': '0'}), \
+                self.assertLogs('x4.pack_x4', level='WARNING') as other_logs:
+            pack_path(other, self.dst)
+        self.assertEqual(self.read_dst('ext_01.cat'), cat)
+        self.assertEqual(self.read_dst('ext_01.dat'), dat)
+        self.assertEqual(logs.output[0].split()[-1], other_logs.output[0].split()[-1])
+
+        self.write_file('content.xml', b'<content version="2" />')
+        with self.assertLogs('x4.pack_x4', level='WARNING') as changed_logs:
+            pack_path(self.src, self.dst, timestamp=0)
+        self.assertNotEqual(logs.output[0].split()[-1], changed_logs.output[0].split()[-1])
+
+    def game_index(self):
+        index = CatIndex()
+        index.files = {
+            'index/macros.xml': ('game/01.cat', CatEntry('index/macros.xml', 0, 9, 1,
+                                                         hashlib.md5(b'<index />').hexdigest())),
+            'assets/ship_macro.xml': ('game/01.cat', CatEntry('assets/ship_macro.xml', 9, 10, 1, 'other-md5')),
+        }
+        return index
+
+    def test_find_duplicates(self):
+        files = [
+            ('index/macros.xml', self.src + 'index/macros.xml'),
+            ('assets/ship_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('content.xml', self.src + 'content.xml'),
+        ]
+        self.assertEqual(find_duplicates(files, self.game_index()), [
+            ('index/macros.xml', self.src + 'index/macros.xml', 'game/01.cat'),
+        ])
+
+    def test_find_content_duplicates(self):
+        self.write_file('macros/ship_macro.xml', b'<index />')
+        self.write_file('macros/other_macro.xml', b'<other />')
+        extensions_index = CatIndex()
+        extensions_index.files = {
+            'assets/dlc_macro.xml': ('game/extensions/ego_dlc_split/ext_01.cat',
+                                     CatEntry('assets/dlc_macro.xml', 0, 10, 1, hashlib.md5(b'<macros />').hexdigest()))
+        }
+        files = [
+            ('assets/ship_macro.xml', self.src + 'assets/ship_macro.xml'),
+            ('index/macros.xml', self.src + 'index/macros.xml'),
+            ('macros/other_macro.xml', self.src + 'macros/other_macro.xml'),
+            ('macros/ship_macro.xml', self.src + 'macros/ship_macro.xml'),
+        ]
+        self.assertEqual(find_content_duplicates(files, [self.game_index(), extensions_index]), [
+            ('assets/ship_macro.xml', self.src + 'assets/ship_macro.xml', 'game/extensions/ego_dlc_split/ext_01.cat',
+             'assets/dlc_macro.xml'),
+            ('index/macros.xml', self.src + 'index/macros.xml', 'game/01.cat', 'index/macros.xml'),
+            ('macros/ship_macro.xml', self.src + 'macros/ship_macro.xml', 'game/01.cat', 'index/macros.xml'),
+        ])
+
+    def test_pack_dedup(self):
+        pack_path(self.src, self.dst, game_index=self.game_index())
+        self.assertEqual(self.read_dst('ext_01.cat').decode('utf-8').splitlines(), [
+            'assets/ship_macro.xml 10 1000 {}'.format(hashlib.md5(b'<macros />').hexdigest()),
+        ])
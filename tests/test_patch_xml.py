@@ -0,0 +1,181 @@
+"""
+Run tests
+Use: ./run_tests.sh
+"""
+
+import copy
+from unittest import TestCase
+
+from lib.patch_xml import diff, diff_selector, patch, parse_selector, PatchTarget, batch_ops
+from lib.patched_element_tree import ElementTree
+
+
+class PatchUnitTest(TestCase):
+    base = ('<wares><ware id="ware_a"><price max="10" /><owner faction="argon" /><owner faction="teladi" /></ware>'
+            '<ware id="ware_b" tags="economy"><price max="20" /></ware></wares>')
+
+    def patched(self, diff_xml, base=None):
+        base_xml = ElementTree.ElementTree(ElementTree.fromstring(base or self.base))
+        patch(base_xml, ElementTree.fromstring(f'<diff>{diff_xml}</diff>'))
+        return ElementTree.tostring(base_xml.getroot()).decode()
+
+    def test_parse_selector(self):
+        self.assertEqual(parse_selector("/wares/ware[@id='ware_a']/owner[2]/@faction"),
+                         ([('wares', ()), ('ware', (('@', 'id', 'ware_a'),)), ('owner', (('#', 1),))], 'faction'))
+        self.assertEqual(parse_selector('/wares/ware[@tags][last()]'),
+                         ([('wares', ()), ('ware', (('@', 'tags', None), ('#', -1)))], None))
+        self.assertEqual(parse_selector('/wares/'), ([('wares', ())], None))
+        self.assertEqual(parse_selector('//ware/@id'), (None, 'id'))
+        self.assertEqual(parse_selector('/wares/ware[not(@tags)]'), (None, None))
+
+    def test_add(self):
+        self.assertEqual(
+            self.patched('<add sel="/wares"><ware id="ware_c" /></add><add sel="/wares"><ware id="ware_d" /></add>'
+                         '<add sel="/wares/ware[@id=\'ware_a\']/owner[@faction=\'argon\']" pos="after">'
+                         '<owner faction="split" /></add>'
+                         '<add sel="/wares/ware[@id=\'ware_a\']" pos="prepend"><production /></add>'
+                         '<add sel="/wares/ware[1]" pos="before"><ware id="ware_0" /></add>'
+                         '<add sel="/wares/ware[@id=\'ware_b\']/price" type="@min">5</add>'),
+            '<wares><ware id="ware_0" /><ware id="ware_a"><production /><price max="10" /><owner faction="argon" />'
+            '<owner faction="split" /><owner faction="teladi" /></ware><ware id="ware_b" tags="economy">'
+            '<price max="20" min="5" /></ware><ware id="ware_c" /><ware id="ware_d" /></wares>')
+
+    def test_replace_remove(self):
+        self.assertEqual(
+            self.patched('<replace sel="/wares/ware[@id=\'ware_a\']/price/@max">15</replace>'
+                         '<replace sel="/wares/ware[@id=\'ware_b\']/price"><price min="1" /></replace>'
+                         '<remove sel="/wares/ware[@id=\'ware_a\']/owner[last()]" />'
+                         '<remove sel="/wares/ware[@id=\'ware_b\']/@tags" />'
+                         '<replace sel="/wares/ware[@id=\'ware_b\']/@id">ware_c</replace>'
+                         '<replace sel="//ware[@id=\'ware_c\']/price/@min">2</replace>'),
+            '<wares><ware id="ware_a"><price max="15" /><owner faction="argon" /></ware>'
+            '<ware id="ware_c"><price min="2" /></ware></wares>')
+        self.assertEqual(self.patched('<replace sel="/wares"><wares /></replace>'), '<wares />')
+
+    def test_failed_ops(self):
+        with self.assertLogs('x4.lib.patch_xml', level='INFO') as logs:
+            self.assertEqual(
+                self.patched('<add sel="/wares/ware[@id=\'ware_x\']"><owner /></add>'
+                             '<add sel="/wares/ware[@id=\'ware_x\']" silent="1"><owner /></add>'
+                             '<remove sel="/wares/ware" />'
+                             '<remove sel="/wares" />'
+                             '<add sel="/wares/ware[@id=\'ware_b\']" type="@tags">x</add>'
+                             '<remove sel="/wares/ware[@id=\'ware_b\']/price/@min" />'
+                             '<replace sel="/wares/ware[@id=\'ware_b\']/price" />'
+                             '<copy sel="/wares" />'
+                             '<remove sel="/wares/ware[@id=\'ware_b\']" />'),
+                '<wares><ware id="ware_a"><price max="10" /><owner faction="argon" /><owner faction="teladi" />'
+                '</ware></wares>')
+        self.assertEqual([record.levelname for record in logs.records], ['ERROR', 'INFO'] + ['ERROR'] * 6)
+
+    def test_target_indexes(self):
+        base_xml = ElementTree.ElementTree(ElementTree.fromstring(self.base))
+        target = PatchTarget(base_xml)
+        patch(base_xml, ElementTree.fromstring('<diff><replace sel="/wares/ware[@id=\'ware_a\']/@id">ware_c'
+                                               '</replace></diff>'), target)
+        patch(base_xml, ElementTree.fromstring('<diff><add sel="/wares/ware[@id=\'ware_c\']"><owner /></add>'
+                                               '<remove sel="/wares/ware[@id=\'ware_b\']" /></diff>'), target)
+        self.assertEqual(target.find("/wares/ware[@id='ware_a']"), ([], None))
+        self.assertEqual([(parent, el.get('id')) for parent, el in target.find('/wares/ware')[0]],
+                         [(base_xml.getroot(), 'ware_c')])
+        self.assertEqual(len(base_xml.find('ware')), 4)
+
+    def test_batch_ops(self):
+        ops = ElementTree.fromstring('<diff><add sel="/a"><b /></add><add sel="/a"><c /></add>'
+                                     '<add sel="/a" pos="prepend"><d /></add><add sel="/a" silent="1"><e /></add>'
+                                     '<add sel="/a" type="@x">1</add><add sel="/a" type="@x">2</add>'
+                                     '<remove sel="/a/b" /><remove sel="/a/b" /></diff>')
+        self.assertEqual([len(batch) for batch in batch_ops(ops)], [2, 1, 1, 1, 1, 1, 1])
+        ops = ElementTree.fromstring('<diff><add sel="/a" pos="prepend"><b /></add><add sel="/a" pos="prepend"><c />'
+                                     '</add></diff>')
+        self.assertEqual([len(batch) for batch in batch_ops(ops)], [1, 1])
+
+    def test_batch_ops_pos(self):
+        # batched ops give the same result as applying them one at a time
+        base = '<a><b id="x" /><c /></a>'
+        for sel, pos in [('/a', None), ('/a', 'prepend'), ("/a/b[@id='x']", 'before'), ("/a/b[@id='x']", 'after')]:
+            pos_attrib = f' pos="{pos}"' if pos else ''
+            ops = [f'<add sel="{sel}"{pos_attrib}><n{n} /></add>' for n in range(1, 4)]
+            one_by_one = base
+            for op in ops:
+                one_by_one = self.patched(op, one_by_one)
+            self.assertEqual(self.patched(''.join(ops), base), one_by_one, pos)
+        self.assertEqual(one_by_one, '<a><b id="x" /><n3 /><n2 /><n1 /><c /></a>')
+
+    def test_diff_patch(self):
+        base_xml = ElementTree.fromstring(DiffUnitTest.base)
+        new_xml = copy.deepcopy(base_xml)
+        new_xml.find('macro').set('name', 'ship_macro_2')
+        new_xml.find('macro/properties/hull').set('threshold', '0.5')
+        new_xml.findall('macro/connections/connection')[2].set('ref', 'con_c')
+        new_xml.find('macro/connections').append(ElementTree.Element('connection', ref='con_d'))
+        del new_xml.find('macro/properties/people').attrib['capacity']
+        expected = ElementTree.tostring(new_xml)
+        self.assertEqual(self.patched(''.join(ElementTree.tostring(op).decode() for op in diff(base_xml, new_xml)
+                                              .getroot()), DiffUnitTest.base).encode(), expected)
+
+    def test_diff_patch_key_attribs(self):
+        # changes of the attributes diff selectors match elements by
+        base = ('<connections><connection name="con_1" tags="small" /><connection name="con_2" tags="small" />'
+                '<connection name="con_3" /><connection name="con_4"><offset /></connection></connections>')
+        new_xml = ElementTree.fromstring(base)
+        connections = list(new_xml)
+        connections[0].set('name', 'con_1b')
+        connections[0].set('tags', 'medium')
+        connections[1].set('name', 'con_3')
+        connections[2].set('name', 'con_2')
+        del connections[3].attrib['name']
+        connections[3].set('tags', 'large')
+        connections[3][0].set('x', '1')
+        ops = ''.join(ElementTree.tostring(op).decode() for op in diff(ElementTree.fromstring(base), new_xml)
+                      .getroot())
+        self.assertEqual(self.patched(ops, base), ElementTree.tostring(new_xml).decode())
+
+
+class DiffUnitTest(TestCase):
+    base = ('<macros><macro name="ship_macro" class="ship_s"><properties><hull max="100" /><people capacity="2" />'
+            '</properties><connections><connection ref="con_a" /><connection ref="con_b" /><connection ref="con_b" />'
+            '</connections></macro></macros>')
+
+    def ops(self, new_xml):
+        return [(op.tag, dict(op.attrib), op.text, [ElementTree.tostring(el) for el in op])
+                for op in diff(ElementTree.fromstring(self.base), new_xml).getroot()]
+
+    def test_diff_selector(self):
+        connections = ElementTree.fromstring(self.base).find('macro/connections')
+        siblings = list(connections)
+        self.assertEqual(diff_selector('/c', siblings, siblings[0]), "/c/connection[@ref='con_a']")
+        self.assertEqual(diff_selector('/c', siblings, siblings[2]), '/c/connection[3]')
+        siblings[1].set('name', "it's")
+        self.assertEqual(diff_selector('/c', siblings, siblings[1]), '/c/connection[@name="it\'s"]')
+        self.assertEqual(diff_selector('/c', [connections], connections), '/c/connections')
+
+    def test_diff_same(self):
+        self.assertEqual(self.ops(ElementTree.fromstring(self.base)), [])
+
+    def test_diff_attribs(self):
+        new_xml = ElementTree.fromstring(self.base)
+        new_xml.find('macro').set('name', 'ship_macro_2')
+        new_xml.find('macro/properties/hull').set('max', '200')
+        new_xml.find('macro/properties/hull').set('threshold', '0.5')
+        del new_xml.find('macro/properties/people').attrib['capacity']
+        new_xml.findall('macro/connections/connection')[2].set('ref', 'con_c')
+        self.assertEqual(self.ops(new_xml), [
+            ('replace', {'sel': "/macros/macro/properties/hull/@max"}, '200', []),
+            ('add', {'sel': "/macros/macro/properties/hull", 'type': '@threshold'}, '0.5', []),
+            ('remove', {'sel': "/macros/macro/properties/people/@capacity"}, None, []),
+            ('replace', {'sel': "/macros/macro/connections/connection[3]/@ref"}, 'con_c', []),
+            # after the changes of its descendants, their selectors could depend on it
+            ('replace', {'sel': "/macros/macro/@name"}, 'ship_macro_2', []),
+        ])
+
+    def test_diff_elements(self):
+        new_xml = ElementTree.fromstring(self.base)
+        connections = new_xml.find('macro/connections')
+        connections.append(copy.deepcopy(connections[0]))
+        connections[-1].set('ref', 'con_d')
+        new_xml.find('macro/properties').remove(new_xml.find('macro/properties/people'))
+        self.assertEqual(self.ops(ElementTree.ElementTree(new_xml)), [
+            ('replace', {'sel': '/macros/macro/properties'}, None, [b'<properties><hull max="100" /></properties>']),
+            ('add', {'sel': '/macros/macro/connections'}, None, [b'<connection ref="con_d" />']),
+        ])
@@ -0,0 +1,90 @@
+"""
+Run tests
+Use: ./run_tests.sh
+"""
+
+import weakref
+from unittest import TestCase
+
+from lib.patched_element_tree import ElementTree, index_attribs, invalidate_attribs, regex_prefix, tag_set, \
+    ATTRIB_INDEXES
+from lib.patch_xml import patch
+
+
+class PredicateUnitTest(TestCase):
+    src = ('<connections><connection name="con_01" tags="small shield standard" />'
+           '<connection name="con_02" tags=" small  weapon " /><connection name="con_03" />'
+           '<connection tags="medium shield" /></connections>')
+
+    def names(self, path):
+        return [el.get('name') for el in ElementTree.fromstring(self.src).findall(path)]
+
+    def test_regex(self):
+        self.assertEqual(self.names('connection[@name="^con_0[12]"]'), ['con_01', 'con_02'])
+        self.assertEqual(self.names('connection[@name="^.*"]'), ['con_01', 'con_02', 'con_03'])
+
+    def test_tags(self):
+        tag_set.cache_clear()
+        self.assertEqual(self.names('connection[@tags="[shield]"]'), ['con_01', None])
+        self.assertEqual(self.names('connection[@tags="[small weapon]"]'), ['con_02'])
+        self.assertEqual(self.names('connection[@tags="[standard shield small]"]'), ['con_01'])
+        self.assertEqual(tag_set.cache_info().currsize, 3)
+        self.assertEqual(tag_set(' small  weapon '), frozenset(['small', '', 'weapon']))
+
+
+class AttribIndexUnitTest(TestCase):
+    src = ('<wares><ware id="ship_arg_s_scout_01" tags="ship"><owner faction="argon" /><owner faction="antigone" />'
+           '</ware><ware id="ship_par_s_fighter_01" tags="ship"><owner faction="paranid" /></ware>'
+           '<ware id="ship_arg_s_fighter_01" tags="ship small"><owner faction="argon" /></ware>'
+           '<group id="ship_arg_s_scout_01" /></wares>')
+    paths = ['./ware[@id="ship_arg_s_fighter_01"]', 'ware[@id="ship_arg_s_scout_01"]', './ware[@id="missing"]',
+             'ware[@id="^ship_arg_"]', 'ware[@id="^ship_.+_fighter"]', 'ware[@id="^ship_ar?"]',
+             'ware/owner[@faction="argon"]', 'ware[@tags="ship"]/owner[@faction="argon"]', './/owner[@faction="^a"]',
+             'ware[@tags="[small]"]', '*[@id="ship_arg_s_scout_01"]', 'ware[@id="^ship_arg_"][2]']
+
+    def test_regex_prefix(self):
+        self.assertEqual(regex_prefix('^ship_.+_scout_'), 'ship_')
+        self.assertEqual(regex_prefix('^ship_ar?'), 'ship_a')
+        self.assertEqual(regex_prefix('^ship_a+'), 'ship_a')
+        self.assertEqual(regex_prefix('^ship_(arg)'), 'ship_')
+        self.assertEqual(regex_prefix('^ship_(arg|par)'), '')
+        self.assertEqual(regex_prefix('^ship_arg|ship_par'), '')
+        self.assertEqual(regex_prefix('^\\w+'), '')
+
+    def test_index(self):
+        xml = ElementTree.ElementTree(ElementTree.fromstring(self.src))
+        expected = [[el.get('id') or el.get('faction') for el in xml.findall(path)] for path in self.paths]
+        index = index_attribs(xml)
+        self.assertIs(index_attribs(xml.getroot()), index)
+        self.assertEqual([[el.get('id') or el.get('faction') for el in xml.findall(path)] for path in self.paths],
+                         expected)
+        self.assertEqual(sorted(index.values), ['faction', 'id', 'tags'])
+        self.assertEqual(xml.find('ware[@id="^ship_arg_"]').get('id'), 'ship_arg_s_scout_01')
+        self.assertEqual(xml.getroot()[0].find('owner[@faction="argon"]'), xml.getroot()[0][0])
+
+    def test_invalidate(self):
+        xml = ElementTree.ElementTree(ElementTree.fromstring(self.src))
+        index = index_attribs(xml)
+        self.assertEqual(len(xml.findall('ware[@id="^ship_"]')), 3)
+
+        xml.getroot().append(ElementTree.Element('ware', id='ship_tel_s_scout_01'))
+        invalidate_attribs(xml)
+        self.assertEqual(len(xml.findall('ware[@id="^ship_"]')), 4)
+
+        xml.getroot()[0].set('id', 'ship_tel_s_scout_02')
+        invalidate_attribs(xml, 'faction')
+        self.assertIn('id', index.values)
+        invalidate_attribs(xml, 'id')
+        self.assertNotIn('id', index.values)
+        self.assertEqual(xml.find('ware[@id="ship_tel_s_scout_02"]'), xml.getroot()[0])
+
+        patch(xml, ElementTree.fromstring('<diff><remove sel="/wares/ware[@id=\'ship_tel_s_scout_02\']" />'
+                                          '<replace sel="/wares/ware[@id=\'ship_par_s_fighter_01\']/@id">ship_x'
+                                          '</replace></diff>'))
+        self.assertEqual([el.get('id') for el in xml.findall('ware[@id="^ship_"]')],
+                         ['ship_x', 'ship_arg_s_fighter_01', 'ship_tel_s_scout_01'])
+
+        root = weakref.ref(xml.getroot())
+        self.assertIn(root(), ATTRIB_INDEXES)
+        del xml
+        self.assertIsNone(root())
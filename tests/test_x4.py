@@ -6,7 +6,9 @@ Use: ./run_tests.sh
 from unittest import TestCase
 from unittest.mock import call, patch, MagicMock
 import logging
-from x4 import setup_logging, cmd_extract_x4, cmd_compile_mod, cmd_pack_mod, get_parser, VERBOSITY
+from extract_x4 import CatEntry
+from x4 import setup_logging, cmd_extract_x4, cmd_verify, cmd_compile_mod, cmd_pack_mod, cmd_dedup, cmd_resolve, \
+    get_parser, VERBOSITY
 
 
 class PackModUnitTest(TestCase):
@@ -26,13 +28,14 @@ class PackModUnitTest(TestCase):
         setup_logging(verbosity)
         patch_get_logger.return_value.setLevel.assert_called_once_with(logging.WARNING)
 
+    @patch('x4.log_throughput')
     @patch('x4.CatParser')
     @patch('x4.get_config')
     @patch('x4.setup_logging')
-    def test_cmd_extract_x4_file(self, patch_setup_logging, patch_get_config, patch_cat_parser):
+    def test_cmd_extract_x4_file(self, patch_setup_logging, patch_get_config, patch_cat_parser, patch_log_throughput):
         patch_get_config.return_value.PWD = '/path/to/pwd'
         patch_get_config.return_value.X4 = '/path/to/game-dir'
-        args = MagicMock(file='path/to/cat-file.cat', list=False)
+        args = MagicMock(file='path/to/cat-file.cat', which=None, list=False, stats=False)
 
         cmd_extract_x4(args)
 
@@ -41,22 +44,26 @@ class PackModUnitTest(TestCase):
             out_path='/path/to/pwd/custom',
             scripts_only=args.scripts,
             signatures=args.signatures,
+            jobs=args.jobs,
+            incremental=args.incremental,
+            include=args.include,
+            exclude=args.exclude,
         )
         patch_cat_parser.return_value.extract.assert_called_once_with(cat_filename='path/to/cat-file.cat')
+        patch_log_throughput.assert_called_once_with(patch_cat_parser.return_value.stats)
 
     @patch('x4.glob')
+    @patch('x4.CatIndex')
+    @patch('x4.log_stats')
+    @patch('x4.log_throughput')
     @patch('x4.CatParser')
     @patch('x4.get_config')
     @patch('x4.setup_logging')
-    def test_cmd_extract_x4_extract(self, patch_setup_logging, patch_get_config, patch_cat_parser, patch_glob):
-        patch_glob.iglob.return_value = [
-            'path/to/02.cat',
-            'path/to/01.cat',
-            'path/to/03.cat',
-        ]
+    def test_cmd_extract_x4_extract(self, patch_setup_logging, patch_get_config, patch_cat_parser,
+                                    patch_log_throughput, patch_log_stats, patch_cat_index, patch_glob):
         patch_get_config.return_value.SRC = '/path/to/src'
         patch_get_config.return_value.X4 = '/path/to/game-dir'
-        args = MagicMock(file=None, list=False)
+        args = MagicMock(file=None, which=None, list=False, stats=True)
 
         cmd_extract_x4(args)
 
@@ -65,14 +72,96 @@ class PackModUnitTest(TestCase):
             out_path=patch_get_config.return_value.SRC,
             scripts_only=args.scripts,
             signatures=args.signatures,
+            jobs=args.jobs,
+            incremental=args.incremental,
+            include=args.include,
+            exclude=args.exclude,
         )
-        self.assertEqual(patch_cat_parser.return_value.extract.call_count, 3)
-        patch_cat_parser.return_value.extract.assert_has_calls([
-            call(cat_filename='path/to/01.cat'),
-            call(cat_filename='path/to/02.cat'),
-            call(cat_filename='path/to/03.cat'),
-        ])
         patch_glob.iglob.assert_called_once_with('/path/to/game-dir/*.cat')
+        patch_cat_index.from_cats.assert_called_once_with(patch_glob.iglob.return_value)
+        patch_cat_parser.return_value.extract_index.assert_called_once_with(patch_cat_index.from_cats.return_value)
+        patch_log_throughput.assert_called_once_with(patch_cat_parser.return_value.stats)
+        patch_log_stats.assert_called_once_with(patch_cat_parser.return_value.stats)
+
+    @patch('x4.glob')
+    @patch('x4.CatIndexCache')
+    @patch('x4.CatParser')
+    @patch('x4.get_config')
+    @patch('x4.setup_logging')
+    def test_cmd_extract_x4_list(self, patch_setup_logging, patch_get_config, patch_cat_parser, patch_cache,
+                                 patch_glob):
+        patch_get_config.return_value.PWD = '/path/to/pwd'
+        patch_get_config.return_value.X4 = '/path/to/game-dir'
+        patch_cache.load.return_value.__iter__.return_value = [
+            ('path/to/01.cat', CatEntry('file1.xml', 0, 10, 1, 'md5-1')),
+            ('path/to/02.cat', CatEntry('file2.xml', 0, 20, 1, 'md5-2')),
+        ]
+        args = MagicMock(file=None, which=None, list=True)
+
+        cmd_extract_x4(args)
+
+        patch_glob.iglob.assert_called_once_with('/path/to/game-dir/*.cat')
+        patch_cache.load.assert_called_once_with('/path/to/pwd/cache/cats.idx', patch_glob.iglob.return_value)
+        patch_cat_parser.return_value.list_files.assert_called_once()
+        self.assertEqual(list(patch_cat_parser.return_value.list_files.call_args[0][0]), [
+            ('file1.xml', 0, 10),
+            ('file2.xml', 0, 20),
+        ])
+
+    @patch('x4.logger')
+    @patch('x4.glob')
+    @patch('x4.CatIndexCache')
+    @patch('x4.CatParser')
+    @patch('x4.get_config')
+    @patch('x4.setup_logging')
+    def test_cmd_extract_x4_which(self, patch_setup_logging, patch_get_config, patch_cat_parser, patch_cache,
+                                  patch_glob, patch_logger):
+        patch_get_config.return_value.PWD = '/path/to/pwd'
+        patch_get_config.return_value.X4 = '/path/to/game-dir'
+        patch_cache.load.return_value.which.return_value = '/path/to/game-dir/02.cat'
+        args = MagicMock(file=None, which='libraries/wares.xml', list=False)
+
+        cmd_extract_x4(args)
+
+        patch_cache.load.assert_called_once_with('/path/to/pwd/cache/cats.idx', patch_glob.iglob.return_value)
+        patch_cache.load.return_value.which.assert_called_once_with('libraries/wares.xml')
+        patch_logger.warning.assert_called_once_with('%s: %s', 'libraries/wares.xml', '/path/to/game-dir/02.cat')
+        patch_cat_parser.return_value.extract_index.assert_not_called()
+
+    @patch('x4.glob')
+    @patch('x4.verify_cats')
+    @patch('x4.get_config')
+    @patch('x4.setup_logging')
+    def test_cmd_verify(self, patch_setup_logging, patch_get_config, patch_verify_cats, patch_glob):
+        patch_get_config.return_value.X4 = '/path/to/game-dir'
+        patch_glob.glob.side_effect = [
+            ['/path/to/game-dir/01.cat'],
+            ['/path/to/game-dir/extensions/ego_dlc_split/ext_01.cat'],
+        ]
+        patch_verify_cats.return_value = {}
+        args = MagicMock(file=None, jobs=4)
+
+        cmd_verify(args)
+
+        patch_setup_logging.assert_called_once_with(args.verbosity)
+        patch_glob.glob.assert_has_calls([
+            call('/path/to/game-dir/*.cat'),
+            call('/path/to/game-dir/extensions/ego_dlc_*/*.cat'),
+        ])
+        patch_verify_cats.assert_called_once_with(
+            ['/path/to/game-dir/01.cat', '/path/to/game-dir/extensions/ego_dlc_split/ext_01.cat'], jobs=4)
+
+    @patch('x4.verify_cats')
+    @patch('x4.get_config')
+    @patch('x4.setup_logging')
+    def test_cmd_verify_failed(self, patch_setup_logging, patch_get_config, patch_verify_cats):
+        patch_verify_cats.return_value = {'path/to/01.cat': [('a.xml', 'md5-1', 'md5-2')]}
+        args = MagicMock(file=['path/to/01.cat'], jobs=None)
+
+        with self.assertRaises(SystemExit):
+            cmd_verify(args)
+
+        patch_verify_cats.assert_called_once_with(['path/to/01.cat'], jobs=None)
 
     @patch('x4.X4ModCompiler')
     @patch('x4.get_config')
@@ -90,12 +179,38 @@ class PackModUnitTest(TestCase):
     @patch('x4.get_config')
     @patch('x4.setup_logging')
     def test_cmd_pack_mod(self, patch_setup_logging, patch_get_config, patch_pack_mod):
-        args = MagicMock()
+        args = MagicMock(volume_size=2)
 
         cmd_pack_mod(args)
 
         patch_setup_logging.assert_called_once_with(args.verbosity)
-        patch_pack_mod.assert_called_once_with(mod_name=args.mod_name, config=patch_get_config.return_value)
+        patch_pack_mod.assert_called_once_with(mod_name=args.mod_name, config=patch_get_config.return_value,
+                                               incremental=args.incremental, volume_size=2 * 1024 * 1024,
+                                               split_dirs=args.split_dirs, timestamp=args.timestamp,
+                                               dedup=args.dedup)
+
+    @patch('x4.report_duplicates')
+    @patch('x4.get_config')
+    @patch('x4.setup_logging')
+    def test_cmd_dedup(self, patch_setup_logging, patch_get_config, patch_report_duplicates):
+        args = MagicMock()
+
+        cmd_dedup(args)
+
+        patch_setup_logging.assert_called_once_with(args.verbosity)
+        patch_report_duplicates.assert_called_once_with(mod_name=args.mod_name, config=patch_get_config.return_value)
+
+    @patch('x4.resolve_all')
+    @patch('x4.get_config')
+    @patch('x4.setup_logging')
+    def test_cmd_resolve(self, patch_setup_logging, patch_get_config, patch_resolve_all):
+        args = MagicMock()
+        config = patch_get_config.return_value
+
+        cmd_resolve(args)
+
+        patch_setup_logging.assert_called_once_with(args.verbosity)
+        patch_resolve_all.assert_called_once_with(config.SRC, f'{config.PWD}/cache/resolved')
 
     def test_get_parser_extract_cat_file(self):
         parser = get_parser()
@@ -139,8 +254,43 @@ class PackModUnitTest(TestCase):
         self.assertEqual(args.scripts, True)
         self.assertEqual(args.list, False)
         self.assertEqual(args.signatures, False)
+        self.assertEqual(args.jobs, 1)
+        self.assertEqual(args.incremental, False)
+        self.assertEqual(args.stats, False)
+        self.assertEqual(args.include, [])
+        self.assertEqual(args.exclude, [])
         self.assertEqual(args.verbosity, 2)
 
+    def test_get_parser_extract_all_jobs(self):
+        parser = get_parser()
+        args = parser.parse_args(['x', '-a', '-j', '8', '--stats'])
+        self.assertEqual(args.func, cmd_extract_x4)
+        self.assertEqual(args.all, True)
+        self.assertEqual(args.jobs, 8)
+        self.assertEqual(args.stats, True)
+
+    def test_get_parser_extract_filters(self):
+        parser = get_parser()
+        args = parser.parse_args(['x', '-a', '--include', '*_main-lod0.xmf', '--include', '^assets/units/',
+                                  '--exclude', '**/size_xl/**'])
+        self.assertEqual(args.func, cmd_extract_x4)
+        self.assertEqual(args.include, ['*_main-lod0.xmf', '^assets/units/'])
+        self.assertEqual(args.exclude, ['**/size_xl/**'])
+
+    def test_get_parser_extract_incremental(self):
+        parser = get_parser()
+        args = parser.parse_args(['x', '-s', '-i'])
+        self.assertEqual(args.func, cmd_extract_x4)
+        self.assertEqual(args.scripts, True)
+        self.assertEqual(args.incremental, True)
+
+    def test_get_parser_extract_which(self):
+        parser = get_parser()
+        args = parser.parse_args(['x', '-w', 'libraries/wares.xml'])
+        self.assertEqual(args.func, cmd_extract_x4)
+        self.assertEqual(args.which, 'libraries/wares.xml')
+        self.assertEqual(args.all, False)
+
     def test_get_parser_extract_list(self):
         parser = get_parser()
         args = parser.parse_args(['x', '-l', '-v', '3'])
@@ -152,6 +302,14 @@ class PackModUnitTest(TestCase):
         self.assertEqual(args.signatures, False)
         self.assertEqual(args.verbosity, 3)
 
+    def test_get_parser_verify(self):
+        parser = get_parser()
+        args = parser.parse_args(['v', '-f', 'cat-file-1', '-f', 'cat-file-2', '-j', '2'])
+        self.assertEqual(args.func, cmd_verify)
+        self.assertEqual(args.file, ['cat-file-1', 'cat-file-2'])
+        self.assertEqual(args.jobs, 2)
+        self.assertEqual(args.verbosity, 1)
+
     def test_get_parser_compile(self):
         parser = get_parser()
         args = parser.parse_args(['c', 'mod-name', '-v', '3'])
@@ -164,4 +322,47 @@ class PackModUnitTest(TestCase):
         args = parser.parse_args(['p', 'mod-name', '-v', '2'])
         self.assertEqual(args.func, cmd_pack_mod)
         self.assertEqual(args.mod_name, 'mod-name')
+        self.assertEqual(args.incremental, False)
+        self.assertEqual(args.volume_size, None)
+        self.assertEqual(args.split_dirs, False)
+        self.assertEqual(args.timestamp, None)
+        self.assertEqual(args.dedup, False)
+        self.assertEqual(args.verbosity, 2)
+
+    def test_get_parser_resolve(self):
+        parser = get_parser()
+        args = parser.parse_args(['r', '-v', '2'])
+        self.assertEqual(args.func, cmd_resolve)
+        self.assertEqual(args.verbosity, 2)
+
+    def test_get_parser_pack_incremental(self):
+        parser = get_parser()
+        args = parser.parse_args(['p', 'mod-name', '-i'])
+        self.assertEqual(args.func, cmd_pack_mod)
+        self.assertEqual(args.incremental, True)
+
+    def test_get_parser_pack_volumes(self):
+        parser = get_parser()
+        args = parser.parse_args(['p', 'mod-name', '--volume-size', '64', '--split-dirs'])
+        self.assertEqual(args.func, cmd_pack_mod)
+        self.assertEqual(args.volume_size, 64)
+        self.assertEqual(args.split_dirs, True)
+
+    def test_get_parser_pack_timestamp(self):
+        parser = get_parser()
+        args = parser.parse_args(['p', 'mod-name', '--timestamp', '1700000000'])
+        self.assertEqual(args.func, cmd_pack_mod)
+        self.assertEqual(args.timestamp, 1700000000)
+
+    def test_get_parser_pack_dedup(self):
+        parser = get_parser()
+        args = parser.parse_args(['p', 'mod-name', '--dedup'])
+        self.assertEqual(args.func, cmd_pack_mod)
+        self.assertEqual(args.dedup, True)
+
+    def test_get_parser_dedup(self):
+        parser = get_parser()
+        args = parser.parse_args(['d', 'mod-name', '-v', '2'])
+        self.assertEqual(args.func, cmd_dedup)
+        self.assertEqual(args.mod_name, 'mod-name')
         self.assertEqual(args.verbosity, 2)
@@ -3,10 +3,11 @@ Run tests
 Use: ./run_tests.sh
 """
 
+import warnings
 from unittest import TestCase
 from unittest.mock import patch, call, MagicMock
 
-from lib.x4lib import require_python_version, get_config, ModUtilMixin
+from lib.x4lib import require_python_version, get_config, glob_to_regex, ModUtilMixin
 
 
 class X4LibUnitTest(TestCase):
@@ -39,6 +40,26 @@ class X4LibUnitTest(TestCase):
         patch_import.assert_called_once_with('config')
 
 
+    def test_glob_to_regex(self):
+        self.assertTrue(glob_to_regex('**/ship_*.xml').match('assets/units/ship_arg.xml'))
+        self.assertTrue(glob_to_regex('**/ship_*.xml').match('ship_arg.xml'))
+        self.assertFalse(glob_to_regex('**/ship_*.xml').match('assets/units/ship_arg.xml.sig'))
+        self.assertTrue(glob_to_regex('*/index/macros.xml').match('base/index/macros.xml'))
+        self.assertFalse(glob_to_regex('*/index/macros.xml').match('base/sub/index/macros.xml'))
+        self.assertTrue(glob_to_regex('size_?/[!x]*.xml').match('size_s/ship.xml'))
+        self.assertFalse(glob_to_regex('size_?/[!x]*.xml').match('size_s/xship.xml'))
+        self.assertTrue(glob_to_regex('a[.]b(c)').match('a.b(c)'))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            self.assertEqual(glob_to_regex('[[]x]').pattern, r'[\[]x\]\Z')
+            self.assertTrue(glob_to_regex('[[]x]').match('[x]'))
+            self.assertTrue(glob_to_regex('[]!^]').match('^'))
+            self.assertFalse(glob_to_regex('[!]a-c]').match('b'))
+            self.assertTrue(glob_to_regex('[!]a-c]').match('d'))
+            self.assertTrue(glob_to_regex('[&&~~||]').match('~'))
+            self.assertTrue(glob_to_regex('[\\]').match('\\'))
+
+
 class ModUtilMixinUnitTest(TestCase):
 
     @patch('lib.x4lib.deepcopy')
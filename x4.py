@@ -4,9 +4,10 @@ import logging
 import argparse
 import glob
 from lib.x4lib import get_config, require_python_version
-from extract_x4 import CatParser
+from extract_x4 import CatParser, CatIndex, CatIndexCache, log_throughput, log_stats, verify_cats
 from compile_mod import X4ModCompiler
-from pack_mod import pack_mod
+from pack_mod import pack_mod, report_duplicates
+from lib.game_data import resolve_all
 
 require_python_version(3, 7)
 logger = logging.getLogger('x4.' + __name__)
@@ -33,16 +34,48 @@ def cmd_extract_x4(args):
         out_path=out_path,
         scripts_only=args.scripts,
         signatures=args.signatures,
+        jobs=args.jobs,
+        incremental=args.incremental,
+        include=args.include,
+        exclude=args.exclude,
     )
 
     if args.file:
         parser.extract(cat_filename=args.file)
+        log_throughput(parser.stats)
+        if args.stats:
+            log_stats(parser.stats)
 
+    elif args.which:
+        cache = CatIndexCache.load(f'{config.PWD}/cache/cats.idx', glob.iglob(f'{config.X4}/*.cat'))
+        logger.warning('%s: %s', args.which, cache.which(args.which) or 'not found')
+
+    elif args.list:
+        cache = CatIndexCache.load(f'{config.PWD}/cache/cats.idx', glob.iglob(f'{config.X4}/*.cat'))
+        parser.list_files((entry.filename, entry.offset, entry.size) for cat_filename, entry in cache)
+
+    else:
+        cat_index = CatIndex.from_cats(glob.iglob(f'{config.X4}/*.cat'))
+        parser.extract_index(cat_index)
+        log_throughput(parser.stats)
+        if args.stats:
+            log_stats(parser.stats)
+
+
+def cmd_verify(args):
+    setup_logging(args.verbosity)
+    config = get_config()
+
+    if args.file:
+        cats = args.file
     else:
-        method = parser.list if args.list else parser.extract
-        cats = sorted(glob.iglob(f'{config.X4}/*.cat'))
-        for cat in cats:
-            method(cat_filename=cat)
+        cats = glob.glob(f'{config.X4}/*.cat') + glob.glob(f'{config.X4}/extensions/ego_dlc_*/*.cat')
+
+    failed = verify_cats(cats, jobs=args.jobs)
+    if failed:
+        logger.error('%d of %d cat files failed verification', len(failed), len(cats))
+        exit(1)
+    logger.warning('%d cat files verified', len(cats))
 
 
 def cmd_compile_mod(args):
@@ -53,7 +86,21 @@ def cmd_compile_mod(args):
 
 def cmd_pack_mod(args):
     setup_logging(args.verbosity)
-    pack_mod(mod_name=args.mod_name, config=get_config())
+    pack_mod(mod_name=args.mod_name, config=get_config(), incremental=args.incremental,
+             volume_size=args.volume_size * 1024 * 1024 if args.volume_size else None,
+             split_dirs=args.split_dirs, timestamp=args.timestamp, dedup=args.dedup)
+
+
+def cmd_dedup(args):
+    setup_logging(args.verbosity)
+    report_duplicates(mod_name=args.mod_name, config=get_config())
+
+
+def cmd_resolve(args):
+    setup_logging(args.verbosity)
+    config = get_config()
+    rel_paths = resolve_all(config.SRC, f'{config.PWD}/cache/resolved')
+    logger.warning('%d files resolved into %s/cache/resolved', len(rel_paths), config.PWD)
 
 
 def get_parser():
@@ -66,10 +113,25 @@ def get_parser():
     group.add_argument('-a', '--all', action='store_true', help='Extract all files')
     group.add_argument('-l', '--list', action='store_true', help='List only')
     group.add_argument('-f', '--file', help='Extract cab file')
+    group.add_argument('-w', '--which', help='Show which cat file supplies the given file path')
     parser_extract.add_argument('--signatures', action='store_true', help='Extract signatures also')
+    parser_extract.add_argument('-j', '--jobs', type=int, default=1, help='Number of extraction worker threads')
+    parser_extract.add_argument('-i', '--incremental', action='store_true',
+                                help='Only extract files changed since the last extraction')
+    parser_extract.add_argument('--stats', action='store_true', help='Show extraction stats summary')
+    parser_extract.add_argument('--include', action='append', default=[],
+                                help='Only list/extract files matching glob (or regex starting with ^), repeatable')
+    parser_extract.add_argument('--exclude', action='append', default=[],
+                                help='Skip files matching glob (or regex starting with ^), repeatable')
     parser_extract.add_argument('-v', '--verbosity', type=int, default=1, help='Verbose output')
     group.set_defaults(func=cmd_extract_x4)
 
+    parser_verify = subparsers.add_parser('verify', aliases=['v'], help='Verify game dat files against cat md5 hashes')
+    parser_verify.add_argument('-f', '--file', action='append', help='Verify cab file (default: all game cab files)')
+    parser_verify.add_argument('-j', '--jobs', type=int, default=None, help='Number of processes (default: cpu count)')
+    parser_verify.add_argument('-v', '--verbosity', type=int, default=1, help='Verbose output')
+    parser_verify.set_defaults(func=cmd_verify)
+
     parser_compile = subparsers.add_parser('compile', aliases=['c'], help='Compile cvs in mod dir into xml files from src')
     parser_compile.add_argument('mod_name', help='<mod name>')
     parser_compile.add_argument('-v', '--verbosity', type=int, default=1, help='Verbose output')
@@ -77,9 +139,28 @@ def get_parser():
 
     parser_pack = subparsers.add_parser('pack', aliases=['p'], help='Pack mod dir and put into game extensions dir')
     parser_pack.add_argument('mod_name', help='<mod name>')
+    parser_pack.add_argument('-i', '--incremental', action='store_true',
+                             help='Reuse hashes of unchanged files and skip packing if nothing changed')
+    parser_pack.add_argument('--volume-size', type=int, default=None, metavar='MB',
+                             help='Split pack into ext_01, ext_02, ... volumes of max MB size')
+    parser_pack.add_argument('--split-dirs', action='store_true',
+                             help='Pack each top level dir (index/, libraries/, assets/, ...) into its own volume(s)')
+    parser_pack.add_argument('--timestamp', type=int, default=None, metavar='EPOCH',
+                             help='Timestamp of packed files for reproducible packs (default: SOURCE_DATE_EPOCH/mtime)')
+    parser_pack.add_argument('--dedup', action='store_true', help='Don\'t pack files identical to game files')
     parser_pack.add_argument('-v', '--verbosity', type=int, default=1, help='Verbose output')
     parser_pack.set_defaults(func=cmd_pack_mod)
 
+    parser_dedup = subparsers.add_parser('dedup', aliases=['d'], help='Report mod files identical to game files')
+    parser_dedup.add_argument('mod_name', help='<mod name>')
+    parser_dedup.add_argument('-v', '--verbosity', type=int, default=1, help='Verbose output')
+    parser_dedup.set_defaults(func=cmd_dedup)
+
+    parser_resolve = subparsers.add_parser('resolve', aliases=['r'],
+                                           help='Merge dlc diffs into src library, index and t files (cache/resolved)')
+    parser_resolve.add_argument('-v', '--verbosity', type=int, default=1, help='Verbose output')
+    parser_resolve.set_defaults(func=cmd_resolve)
+
     parser.set_defaults(func=lambda a: parser.print_usage())
     return parser
 